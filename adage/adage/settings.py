@@ -220,3 +220,11 @@ TRIBE_LOGOUT_REDIRECT = CONFIG['tribe_logout_redirect']
 # saved to. tribe-client will also refer to this setting when it is
 # time to unpickle the genesets from these files and serve them.
 PUBLIC_GENESET_FOLDER = CONFIG['public_geneset_folder']
+
+# The data_cache_dir setting is the folder where precomputed copies of
+# large tables (such as the memory-mapped matrices built by
+# analyze/matrix_store.py) are saved. It is rebuilt by the import
+# management commands, so it does not need to be backed up.
+DATA_CACHE_DIR = CONFIG.get('data_cache_dir',
+                            os.path.join(os.path.dirname(BASE_DIR),
+                                         'data_cache'))
@@ -1,29 +1,347 @@
+import errno
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import uuid
+from io import BytesIO
+from django.conf import settings
 from django.conf.urls import url
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
-from django.http import HttpResponse
+from django.db.models import Q, Count, Case, When
+from django.http import (
+    HttpResponse, HttpResponseNotModified, StreamingHttpResponse, FileResponse)
+from django.http.response import HttpResponseBase
+from django.utils.cache import patch_vary_headers
+from django.utils.http import (
+    http_date, parse_http_date_safe, parse_etags, quote_etag)
+import numpy as np
 from organisms.api import OrganismResource
 from genes.api import GeneResource
+from genes.models import Gene
 from tastypie import fields, http
-from tastypie.resources import Resource, ModelResource, convert_post_to_VERB
+from tastypie.resources import (
+    Resource, ModelResource, convert_post_to_VERB, convert_post_to_put)
 from tastypie.utils import trailing_slash
 from tastypie.bundle import Bundle
-from tastypie.exceptions import BadRequest
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
 from haystack.query import SearchQuerySet
 from haystack.inputs import AutoQuery
 from models import (
     Experiment, Sample, SampleAnnotation, AnnotationType, MLModel, Signature,
     Activity, Edge, ParticipationType, Participation, ExpressionValue
 )
+from stats import (
+    welch_ttest, fdr_correction, hypergeometric_sf, nan_to_none)
+from matrix_store import (
+    ActivityMatrixStore, GeneNetworkStore, ExpressionMatrixStore,
+    records_to_columns)
+from similarity import (
+    SampleSimilarityStore, SignatureCorrelations, SignatureCorrelationStore)
+from data_version import get_data_version, ANNOTATIONS
 
 # Many helpful hints for this implementation came from:
 # https://michalcodes4life.wordpress.com/2013/11/26/custom-tastypie-resource-from-multiple-django-models/
 
 
+def json_float(value):
+    """
+    Return the JSON representation of the float "value": its repr(), or
+    null for NaN and infinite values, which JSON cannot represent.
+    """
+    if math.isnan(value) or math.isinf(value):
+        return 'null'
+    return repr(value)
+
+
+def staged_mlmodel_ids():
+    """
+    Return the IDs of the staged (unpublished) mlmodels.  Their records
+    are loaded into the same tables as those of the published ones, and
+    are hidden by the API until they are published (see the
+    "publish_ml_model" management command).  The large tables are
+    filtered by these IDs (and by those of staged_signature_ids()) instead
+    of being joined with the "MLModel" table.
+    """
+    return list(MLModel.objects.filter(published=False).values_list(
+        'id', flat=True))
+
+
+def staged_signature_ids():
+    """
+    Return the IDs of the signatures of the staged mlmodels (see
+    staged_mlmodel_ids()).
+    """
+    return list(Signature.objects.filter(
+        mlmodel__published=False).values_list('id', flat=True))
+
+
+class StreamingDispatchMixin(object):
+    """
+    Tastypie's Resource.dispatch() replaces any response that is not an
+    HttpResponse with "204 No Content", which rules out streaming a large
+    response with a StreamingHttpResponse.  This mixin overrides
+    dispatch() with the same logic (allowed methods, authentication and
+    throttling), except that any HttpResponseBase is passed through.
+    """
+    def dispatch(self, request_type, request, **kwargs):
+        allowed_methods = getattr(
+            self._meta, "%s_allowed_methods" % request_type, None)
+
+        if 'HTTP_X_HTTP_METHOD_OVERRIDE' in request.META:
+            request.method = request.META['HTTP_X_HTTP_METHOD_OVERRIDE']
+
+        request_method = self.method_check(request, allowed=allowed_methods)
+        method = getattr(self, "%s_%s" % (request_method, request_type), None)
+
+        if method is None:
+            raise ImmediateHttpResponse(response=http.HttpNotImplemented())
+
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        request = convert_post_to_put(request)
+        response = method(request, **kwargs)
+
+        self.log_throttled_access(request)
+
+        if not isinstance(response, HttpResponseBase):
+            return http.HttpNoContent()
+        return response
+
+
+class FlatValuesResource(StreamingDispatchMixin, ModelResource):
+    """
+    Base class of ModelResources whose records are flat tuples of numbers
+    (integer foreign key IDs and a float value), such as Activity.  Lists
+    of such records are built straight from a values_list() of the
+    filtered, sorted and paginated queryset, so no model instance, Bundle
+    or full_dehydrate() call is needed per row.  The filtering, ordering
+    and pagination semantics (and the JSON layout of the default format)
+    are the same as ModelResource's.
+
+    Besides the default JSON format, two opt-in list formats are
+    supported:
+      * format=columnar: a JSON object of parallel arrays (one per column)
+        plus "meta": {"total_count": <number of rows before pagination>};
+      * format=npy: a NumPy ".npy" file holding a 1-D structured array
+        with one field per column.
+    Other formats (e.g. XML) fall back to ModelResource.get_list().
+
+    A subclass defines "columns" as a tuple of (column name, model field
+    name, NumPy data type) triplets; JSON objects include the record's
+    "id" followed by these columns, so "columns" must match the fields
+    exposed by the resource, and include_resource_uri must be False.
+
+    A subclass may also override get_stored_columns() to read the rows of
+    a list from a matrix store (see analyze/matrix_store.py) instead of
+    the table whenever the request allows it.
+    """
+    columns = ()
+    # Number of values (or JSON objects) serialized per chunk.
+    json_chunk_size = 10000
+
+    def get_list(self, request, **kwargs):
+        list_format = request.GET.get('format', None)
+        if list_format == 'columnar':
+            return self.get_columnar_list(request, **kwargs)
+        elif list_format == 'npy':
+            return self.get_npy_list(request, **kwargs)
+        elif self.determine_format(request) == 'application/json':
+            return self.get_flat_list(request, **kwargs)
+        return super(FlatValuesResource, self).get_list(request, **kwargs)
+
+    def get_sorted_objects(self, request, **kwargs):
+        """
+        Return the queryset of a list request with the same filters and
+        ordering that ModelResource.get_list() applies.
+        """
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(
+            bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        return self.apply_sorting(objects, options=request.GET)
+
+    def get_stored_columns(self, request, **kwargs):
+        """
+        Return the rows of a list request as a list of NumPy arrays (the
+        record IDs followed by one array per column) if they can be read
+        without querying the table, or None.  (The list formats only call
+        it for requests that are not paginated.)
+        """
+        return None
+
+    def is_paginated(self, request):
+        return bool(request.GET.get('limit') or request.GET.get('offset'))
+
+    def paginate(self, request, objects):
+        """
+        Return the "meta" object and the page of "objects" requested by
+        the "limit" and "offset" params, as ModelResource.get_list() does.
+        """
+        paginator = self._meta.paginator_class(
+            request.GET, objects, resource_uri=self.get_resource_uri(),
+            limit=self._meta.limit, max_limit=self._meta.max_limit,
+            collection_name=self._meta.collection_name)
+        page = paginator.page()
+        return page['meta'], page[self._meta.collection_name]
+
+    def get_flat_list(self, request, **kwargs):
+        """
+        Return the default JSON list, streamed from values_list() tuples
+        (or stored columns) with a per-row string template.  Float values
+        are written by json_float().
+        """
+        names = ['id'] + [name for name, field, dtype in self.columns]
+        model_fields = ['id'] + [field for name, field, dtype in self.columns]
+        is_integer = [True] + [np.issubdtype(dtype, np.integer)
+                               for name, field, dtype in self.columns]
+        # Tastypie's JSON serializer sorts the keys of every object.
+        keys = sorted(zip(names, model_fields, is_integer))
+        row_template = '{%s}' % ', '.join(
+            '%s: %s' % (json.dumps(name), '%d' if integer else '%s')
+            for name, field, integer in keys)
+        model_fields = [field for name, field, integer in keys]
+        float_positions = [i for i, (name, field, integer) in enumerate(keys)
+                           if not integer]
+
+        stored = None
+        if not self.is_paginated(request):
+            stored = self.get_stored_columns(request, **kwargs)
+        if stored is not None:
+            arrays = [stored[names.index(name)] for name, field, integer
+                      in keys]
+            rows = zip(*[array.tolist() for array in arrays])
+            meta = {'limit': self._meta.limit, 'next': None, 'offset': 0,
+                    'previous': None, 'total_count': len(rows)}
+        else:
+            objects = self.get_sorted_objects(request, **kwargs)
+            meta, rows = self.paginate(request,
+                                       objects.values_list(*model_fields))
+            rows = rows.iterator()
+        chunk_size = self.json_chunk_size
+
+        def format_row(row):
+            row = list(row)
+            for i in float_positions:
+                row[i] = json_float(row[i])
+            return row_template % tuple(row)
+
+        def generate_json():
+            yield '{"meta": %s, %s: [' % (
+                json.dumps(meta, sort_keys=True),
+                json.dumps(self._meta.collection_name))
+            chunk = []
+            separator = ''
+            for row in rows:
+                chunk.append(format_row(row))
+                if len(chunk) == chunk_size:
+                    yield separator + ', '.join(chunk)
+                    chunk = []
+                    separator = ', '
+            if chunk:
+                yield separator + ', '.join(chunk)
+            yield ']}'
+
+        return StreamingHttpResponse(generate_json(),
+                                     content_type='application/json')
+
+    def get_column_arrays(self, request, **kwargs):
+        """
+        Apply the request's filters, ordering and pagination, and return
+        (total number of rows before pagination, list of NumPy arrays of
+        the selected rows, one per column).
+        """
+        stored = None
+        if not self.is_paginated(request):
+            stored = self.get_stored_columns(request, **kwargs)
+        if stored is not None:
+            return len(stored[0]), list(stored[1:])
+        objects = self.get_sorted_objects(request, **kwargs)
+        model_fields = [field for name, field, dtype in self.columns]
+        dtypes = [dtype for name, field, dtype in self.columns]
+        meta, rows = self.paginate(request,
+                                   objects.values_list(*model_fields))
+        return meta['total_count'], records_to_columns(rows.iterator(),
+                                                       dtypes)
+
+    def get_columnar_list(self, request, **kwargs):
+        total_count, arrays = self.get_column_arrays(request, **kwargs)
+        names = [name for name, field, dtype in self.columns]
+        chunk_size = self.json_chunk_size
+
+        def generate_json():
+            yield '{"meta": %s' % json.dumps({'total_count': total_count})
+            for name, array in zip(names, arrays):
+                yield ', %s: [' % json.dumps(name)
+                for start in xrange(0, len(array), chunk_size):
+                    chunk = array[start:start + chunk_size]
+                    if (np.issubdtype(chunk.dtype, np.floating) and
+                            not np.isfinite(chunk).all()):
+                        text = ', '.join(json_float(value)
+                                         for value in chunk.tolist())
+                    else:
+                        text = json.dumps(chunk.tolist())[1:-1]
+                    prefix = ', ' if start else ''
+                    yield prefix + text
+                yield ']'
+            yield '}'
+
+        return StreamingHttpResponse(generate_json(),
+                                     content_type='application/json')
+
+    def get_npy_list(self, request, **kwargs):
+        total_count, arrays = self.get_column_arrays(request, **kwargs)
+        dtype = []
+        for (name, field, field_dtype), array in zip(self.columns, arrays):
+            # Store integer IDs in 32 bits whenever they fit.
+            if (np.issubdtype(array.dtype, np.integer) and
+                    (len(array) == 0 or
+                     array.max() <= np.iinfo(np.int32).max)):
+                field_dtype = np.int32
+            dtype.append((str(name), field_dtype))
+        records = np.empty(len(arrays[0]), dtype=dtype)
+        for (name, field_dtype), array in zip(dtype, arrays):
+            records[name] = array
+
+        output = BytesIO()
+        np.save(output, records)
+        response = HttpResponse(output.getvalue(),
+                                content_type='application/octet-stream')
+        response['Content-Disposition'] = (
+            'attachment; filename="%s.npy"' % self._meta.resource_name)
+        return response
+
+
 class SearchItemObject(object):
     pass
 
 
+class SearchResultList(object):
+    """
+    A lazy list of SearchItemObjects backed by a SearchQuerySet.  Tastypie's
+    Paginator only calls count() and slices the list, so count() becomes a
+    single hit-count query in Elasticsearch and slicing fetches just the
+    requested page (converted by "build_items"), no matter how many
+    documents match.
+    """
+    def __init__(self, sqs, build_items):
+        self.sqs = sqs
+        self.build_items = build_items
+
+    def count(self):
+        return self.sqs.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self.build_items(self.sqs[k])
+        return self.build_items([self.sqs[k]])[0]
+
+
 class SearchResource(Resource):
     item_type = fields.CharField(attribute='item_type')
     pk = fields.CharField(attribute='pk')
@@ -58,33 +376,94 @@ class SearchResource(Resource):
             request = kwargs['bundle'].request
         return self.get_object_list(request)
 
+    # Models that can be searched, by the names accepted in "models" param.
+    search_models = {
+        'experiment': Experiment,
+        'sample': Sample,
+    }
+
     def get_object_list(self, request):
+        """
+        Return a SearchResultList, so that only the page of results that
+        is requested (see "limit" and "offset" params) is retrieved from
+        Elasticsearch, and meta.total_count is the hit count reported by
+        Elasticsearch.  The optional "models" param is a comma-separated
+        list of the item types ("experiment", "sample") to search.
+        """
         # unpack the query string from the request headers
         query_str = request.GET.get('q', '')
 
         # restrict our search to the Experiment and Sample models
-        sqs = SearchQuerySet().models(Experiment, Sample)
+        model_names = request.GET.get('models', '')
+        if model_names:
+            try:
+                models = [self.search_models[name.strip().lower()]
+                          for name in model_names.split(',')]
+            except KeyError as e:
+                raise BadRequest("Invalid model in models param: %s" % e)
+        else:
+            models = self.search_models.values()
+        sqs = SearchQuerySet().models(*models)
 
         # run the query and specify we want highlighted results
-        sqs = sqs.filter(content=AutoQuery(query_str)).load_all().highlight()
+        sqs = sqs.filter(content=AutoQuery(query_str)).highlight()
 
+        return SearchResultList(sqs, self.build_search_items)
+
+    @staticmethod
+    def get_related_items(results):
+        """
+        Return a dictionary of {(model name, pk): [related pk, ...]} that
+        maps every experiment in "results" to the IDs of its samples and
+        every sample to the accessions of its experiments.  All of them are
+        read by a single query on the Experiment-Sample relation table, so
+        the number of queries does not depend on the number of results.
+        """
+        experiment_pks, sample_pks = [], []
+        for result in results:
+            if result.model_name == 'experiment':
+                experiment_pks.append(result.pk)
+            elif result.model_name == 'sample':
+                sample_pks.append(int(result.pk))
+        related_items = {}
+        if not experiment_pks and not sample_pks:
+            return related_items
+        pairs = Sample.experiments.through.objects.filter(
+            Q(experiment_id__in=experiment_pks) | Q(sample_id__in=sample_pks)
+        ).order_by('id').values_list('experiment_id', 'sample_id')
+        experiment_pks, sample_pks = set(experiment_pks), set(sample_pks)
+        for experiment_pk, sample_pk in pairs:
+            if experiment_pk in experiment_pks:
+                related_items.setdefault(
+                    ('experiment', experiment_pk), []).append(sample_pk)
+            if sample_pk in sample_pks:
+                related_items.setdefault(
+                    ('sample', sample_pk), []).append(experiment_pk)
+        return related_items
+
+    def build_search_items(self, results):
+        """
+        Convert Haystack search results into SearchItemObjects.  Names come
+        from the search index and related items from get_related_items(),
+        so no query is run per result.
+        """
+        results = list(results)
+        related_items = self.get_related_items(results)
         object_list = []
-        for result in sqs:
+        for result in results:
             new_obj = SearchItemObject()
 
             new_obj.pk = result.pk
+            new_obj.item_type = result.model_name
             if result.model_name == 'experiment':
-                new_obj.item_type = result.model_name
-                new_obj.description = result.object.name
-                e = Experiment.objects.get(pk=result.pk)
-                new_obj.related_items = [s.pk for s in e.sample_set.all()]
+                new_obj.description = result.name
+                new_obj.related_items = related_items.get(
+                    ('experiment', result.pk), [])
             elif result.model_name == 'sample':
-                new_obj.item_type = result.model_name
-                new_obj.description = result.object.name
-                s = Sample.objects.get(pk=result.pk)
-                new_obj.related_items = [e.pk for e in s.experiments.all()]
+                new_obj.description = result.name
+                new_obj.related_items = related_items.get(
+                    ('sample', int(result.pk)), [])
             else:
-                new_obj.item_type = result.model_name
                 new_obj.description = result.verbose_name
                 new_obj.related_items = []
             new_obj.snippet = ' ...'.join(result.highlighted)
@@ -136,7 +515,21 @@ class AnnotationTypeResource(ModelResource):
         allowed_methods = ['get']
 
 
-class SampleResource(ModelResource):
+def iter_gzip_file(compressed_file, chunk_size=65536):
+    """
+    Generate the decompressed content of the open gzip file
+    "compressed_file" in chunks, and close it at the end.
+    """
+    with compressed_file, gzip.GzipFile(fileobj=compressed_file,
+                                        mode='rb') as gzip_file:
+        while True:
+            chunk = gzip_file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class SampleResource(StreamingDispatchMixin, ModelResource):
     annotations = fields.DictField(attribute='get_annotation_dict')
 
     class Meta:
@@ -144,6 +537,9 @@ class SampleResource(ModelResource):
         allowed_methods = ['get']
         experiments_allowed_methods = allowed_methods
         annotations_allowed_methods = allowed_methods
+        # Both GET and POST are accepted by "similar" because the list of
+        # query samples may be too long to fit in a URI.
+        similar_allowed_methods = ['get', 'post']
         filtering = {
             'id': ('in',),
             'experiment': ('exact', ),  # Implemented in apply_filters()
@@ -161,6 +557,16 @@ class SampleResource(ModelResource):
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('dispatch_annotations'),
                 name='api_get_annotations'),
+            url((r'^(?P<resource_name>%s)/'
+                 r'(?P<pk>[0-9]+)/similar%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_similar'),
+                name='api_sample_similar'),
+            url((r'^(?P<resource_name>%s)/'
+                 r'similar%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_similar'),
+                name='api_samples_similar'),
         ]
 
     def dispatch_experiments(self, request, **kwargs):
@@ -191,6 +597,94 @@ class SampleResource(ModelResource):
 
         return self.create_response(request, objects)
 
+    def dispatch_similar(self, request, **kwargs):
+        return self.dispatch('similar', request, **kwargs)
+
+    def get_similar(self, request, pk=None, **kwargs):
+        """
+        Return the k samples whose activity profiles (on the signatures
+        of a published mlmodel) are most similar to the profile of a
+        sample:
+          api/v0/sample/<id>/similar/?mlmodel=<id>[&k=<k>]
+        or of each of a batch of samples:
+          api/v0/sample/similar/?mlmodel=<id>&samples=<id1,id2,...>[&k=<k>]
+
+        The similarity of two samples is the Pearson correlation of their
+        activity profiles (see analyze/similarity.py), and k is 10 by
+        default.  A single sample's response is a list of objects with
+        the "sample" ID and "similarity" of each neighbor, sorted by
+        decreasing similarity; a batch response has one object per query
+        sample with its "sample" ID and that list as "similar" (samples
+        without activity in the mlmodel are left out).  The response is
+        "503 Service Unavailable" if the mlmodel's SampleSimilarityStore
+        has not been built (see build_activity_matrix).
+        """
+        mlmodel = request.GET.get('mlmodel', None)
+        if not mlmodel:
+            raise BadRequest("Required parameter mlmodel is missing")
+        try:
+            mlmodel_id = int(mlmodel)
+        except ValueError:
+            raise BadRequest("Invalid mlmodel ID: %s" % mlmodel)
+        if not MLModel.objects.filter(id=mlmodel_id,
+                                      published=True).exists():
+            raise BadRequest("Invalid mlmodel ID: %s" % mlmodel)
+
+        k = request.GET.get('k', '10')
+        try:
+            k = int(k)
+        except ValueError:
+            k = 0
+        if k < 1:
+            raise BadRequest("Invalid k: %s" % request.GET['k'])
+
+        if pk is not None:
+            sample_ids = [int(pk)]
+        else:
+            samples = request.GET.get('samples', '')
+            try:
+                sample_ids = sorted({int(id) for id in samples.split(',')
+                                     if id})
+            except ValueError:
+                raise BadRequest("Invalid sample IDs: %s" % samples)
+            if not sample_ids:
+                raise BadRequest("Required parameter samples is missing")
+
+        index = SampleSimilarityStore(mlmodel_id).load()
+        if index is None:
+            # Searching without the index would scan the whole activity
+            # of the model on every request.
+            return HttpResponse(
+                "The similarity index of mlmodel %d has not been built" %
+                mlmodel_id, status=503)
+        positions, found = index.positions(sample_ids)
+        if pk is not None and not found[0]:
+            return http.HttpNotFound()
+        positions = positions[found]
+        neighbors, similarities = index.search(index.vectors[positions], k,
+                                               exclude=positions)
+        results = [
+            [{'sample': int(index.ids[neighbor]), 'similarity': similarity}
+             for neighbor, similarity in zip(
+                 row, nan_to_none(row_similarities))]
+            for row, row_similarities in zip(neighbors, similarities)
+        ]
+        if pk is not None:
+            return self.create_response(request, {'objects': results[0]})
+        objects = [
+            {'sample': int(index.ids[position]), 'similar': similar}
+            for position, similar in zip(positions, results)
+        ]
+        return self.create_response(request, {'objects': objects})
+
+    def post_similar(self, request, **kwargs):
+        """
+        handle an incoming POST as a GET to work around URI length limitations
+        """
+        request.method = 'GET'  # override the incoming POST
+        converted_request = convert_post_to_VERB(request, 'GET')
+        return self.get_similar(converted_request, **kwargs)
+
     def dispatch_annotations(self, request, **kwargs):
         """
         This handler takes a URL request (see above) and dispatches it to the
@@ -209,6 +703,14 @@ class SampleResource(ModelResource):
         with Sample properties for each and all annotations (by default) or, if
         `annotation_types` is specified, return only those annotation types for
         each sample, and do so in the order specified.
+
+        The file is generated once per data version (see data_version.py)
+        and list of annotation types, and cached on disk gzip-compressed
+        (see open_annotations_file()).  Responses carry ETag and
+        Last-Modified headers, conditional requests (If-None-Match or
+        If-Modified-Since) get "304 Not Modified" when the file has not
+        changed, and the compressed file is sent as it is to clients that
+        accept gzip encoding.
         """
         if 'annotation_types' in kwargs:
             # an explicitly-passed annotation_types param takes precedence
@@ -222,23 +724,114 @@ class SampleResource(ModelResource):
                 at.typename
                 for at in AnnotationType.objects.order_by('typename')
             ]
-        rows = []
+        annotations_file, etag, last_modified = (
+            SampleResource.open_annotations_file(annotation_types))
+        etag = quote_etag(etag)
+        last_modified = http_date(last_modified)
+
+        if request and SampleResource.not_modified(request, etag,
+                                                   last_modified):
+            annotations_file.close()
+            response = HttpResponseNotModified()
+        elif request and re.search(r'\bgzip\b',
+                                   request.META.get('HTTP_ACCEPT_ENCODING',
+                                                    '')):
+            response = FileResponse(annotations_file,
+                                    content_type='text/tab-separated-values')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(
+                iter_gzip_file(annotations_file),
+                content_type='text/tab-separated-values')
+        if response.status_code == 200:
+            response['Content-Disposition'] = (
+                'attachment; filename="sample_annotations.tsv"')
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        patch_vary_headers(response, ('Accept-Encoding', ))
+        return response
+
+    @staticmethod
+    def not_modified(request, etag, last_modified):
+        """
+        Return True if the conditional headers of "request" show that the
+        client already has the version identified by "etag" and
+        "last_modified" (an HTTP date).
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return '*' in etags or etag.strip('"') in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return (if_modified_since is not None and
+                parse_http_date_safe(last_modified) <= if_modified_since)
+
+    @staticmethod
+    def open_annotations_file(annotation_types):
+        """
+        Return (open file, etag, last_modified timestamp) of the
+        gzip-compressed annotation file of "annotation_types" for the
+        current data version, generating the file first if it is not
+        cached yet.  Files of previous data versions are removed when a
+        new one is generated; since the file is returned open, a request
+        keeps reading its file even if another request removes it.
+        """
+        version, last_modified = get_data_version(ANNOTATIONS)
+        types_hash = hashlib.sha1(
+            u'\t'.join(annotation_types).encode('utf-8')).hexdigest()
+        etag = '%s-%s' % (version, types_hash)
+        cache_dir = os.path.join(settings.DATA_CACHE_DIR, 'annotations')
+        path = os.path.join(cache_dir, etag + '.tsv.gz')
+        try:
+            return open(path, 'rb'), etag, last_modified
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file first so that concurrent requests never
+        # read a partial file.
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with gzip.open(tmp_path, 'wb') as tsv_file:
+            for row in SampleResource.iter_annotation_rows(annotation_types):
+                tsv_file.write(row.encode('utf-8'))
+        # Open the file before publishing it, so that it cannot be removed
+        # before this request reads it.
+        annotations_file = open(tmp_path, 'rb')
+        os.rename(tmp_path, path)
+        for name in os.listdir(cache_dir):
+            if name.endswith('.tsv.gz') and not name.startswith(version):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass  # already removed by another process
+        return annotations_file, etag, last_modified
+
+    @staticmethod
+    def iter_annotation_rows(annotation_types):
+        """
+        Generate the rows of the annotation file of "annotation_types"
+        from a single ordered query (see
+        SampleAnnotationManager.iter_experiment_samples()), so that the
+        memory used does not depend on the number of samples.
+        """
+        type_ids = dict(AnnotationType.objects.filter(
+            typename__in=annotation_types).values_list('typename', 'id'))
+        column_type_ids = [type_ids.get(at) for at in annotation_types]
+
         # include a header as the first row
         headers = ['experiment', 'sample_name', 'ml_data_source']
         headers.extend(annotation_types)
-        rows.append(u'\t'.join(headers) + u'\n')
-        for e in Experiment.objects.all():
-            for s in e.sample_set.all():
-                sa = SampleAnnotation.objects.get_as_dict(s)
-                ml_data_source = s.ml_data_source if s.ml_data_source else ''
-                sa_cols = [e.accession, s.name, ml_data_source, ]
-                for at in annotation_types:
-                    sa_cols.append(sa.get(at, ''))
-                rows.append(u'\t'.join(sa_cols) + u'\n')
-        response = HttpResponse(rows, content_type='text/tab-separated-values')
-        response['Content-Disposition'] = (
-            'attachment; filename="sample_annotations.tsv"')
-        return response
+        yield u'\t'.join(headers) + u'\n'
+        samples = SampleAnnotation.objects.iter_experiment_samples(
+            type_ids.values())
+        for accession, name, ml_data_source, annotations in samples:
+            sa_cols = [accession, name, ml_data_source or '', ]
+            for type_id in column_type_ids:
+                sa_cols.append(annotations.get(type_id, ''))
+            yield u'\t'.join(sa_cols) + u'\n'
 
     def apply_filters(self, request, applicable_filters):
         """
@@ -264,7 +857,7 @@ class MLModelResource(ModelResource):
     organism = fields.ForeignKey(OrganismResource, "organism", full=True)
 
     class Meta:
-        queryset = MLModel.objects.all()
+        queryset = MLModel.objects.filter(published=True)
         allowed_methods = ['get']
 
 
@@ -273,10 +866,14 @@ class SignatureResource(ModelResource):
                                 full=True, full_list=False)
 
     class Meta:
-        queryset = Signature.objects.all()
+        queryset = Signature.objects.filter(mlmodel__published=True)
         resource_name = 'signature'
         allowed_methods = ['get']
         multiple_allowed_methods = ['post']
+        # Both GET and POST are accepted by "enrichment" because the gene
+        # list may be too long to fit in a URI.
+        enrichment_allowed_methods = ['get', 'post']
+        related_allowed_methods = ['get']
         filtering = {
             'name': ('exact', 'in', ),
             'heavy_genes': ('exact', ),  # New filter, see apply_filters().
@@ -291,11 +888,103 @@ class SignatureResource(ModelResource):
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('dispatch_multiple'),
                 name='api_post_multiple'),
+            url((r'^(?P<resource_name>%s)/'
+                 r'enrichment%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_enrichment'),
+                name='api_signature_enrichment'),
+            url((r'^(?P<resource_name>%s)/'
+                 r'(?P<pk>[0-9]+)/related%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_related'),
+                name='api_signature_related'),
         ]
 
     def dispatch_multiple(self, request, **kwargs):
         return self.dispatch('multiple', request, **kwargs)
 
+    def dispatch_enrichment(self, request, **kwargs):
+        return self.dispatch('enrichment', request, **kwargs)
+
+    def get_enrichment(self, request, **kwargs):
+        """
+        Test a gene list for enrichment in every signature of an mlmodel:
+          api/v0/signature/enrichment/?mlmodel=<id>&genes=<id1,id2,...>
+              [&participation_type=<id1,id2,...>]
+
+        The population is the set of genes of the mlmodel's organism, and
+        the genes of a signature are the genes that participate in it
+        (with one of the optional participation types).  Each object in
+        the response includes the signature's ID and name, "size" (its
+        number of genes), "overlap" (number of those genes in the list),
+        "pvalue" (one-sided hypergeometric test of an overlap at least
+        this large) and "adj_pvalue" (Benjamini-Hochberg FDR-adjusted
+        "pvalue"); the objects are sorted by "pvalue".  The overlaps of
+        all signatures are counted by a single aggregated query.
+        """
+        mlmodel = request.GET.get('mlmodel', None)
+        if not mlmodel:
+            raise BadRequest("Required parameter mlmodel is missing")
+        try:
+            mlmodel = MLModel.objects.get(id=int(mlmodel), published=True)
+        except (ValueError, MLModel.DoesNotExist):
+            raise BadRequest("Invalid mlmodel ID: %s" % mlmodel)
+
+        genes = request.GET.get('genes', '')
+        try:
+            gene_ids = {int(id) for id in genes.split(',') if id}
+        except ValueError:
+            raise BadRequest("Invalid gene IDs: %s" % genes)
+        # Genes of other organisms can't be drawn from the population.
+        organism_genes = Gene.objects.filter(organism=mlmodel.organism_id)
+        gene_ids = list(organism_genes.filter(
+            id__in=gene_ids).values_list('id', flat=True))
+        if not gene_ids:
+            raise BadRequest("At least one gene of the mlmodel's organism "
+                             "is required in genes")
+
+        condition = Q(participation__gene__isnull=False)
+        participation_type = request.GET.get('participation_type', None)
+        if participation_type:
+            try:
+                type_ids = {int(id) for id in participation_type.split(',')}
+            except ValueError:
+                raise BadRequest("Invalid participation type IDs: %s" %
+                                 participation_type)
+            condition &= Q(participation__participation_type__in=type_ids)
+
+        signatures = list(Signature.objects.filter(
+            mlmodel=mlmodel).annotate(
+                size=Count(Case(When(
+                    condition, then='participation__gene')), distinct=True),
+                overlap=Count(Case(When(
+                    condition & Q(participation__gene__in=gene_ids),
+                    then='participation__gene')), distinct=True),
+            ).values_list('id', 'name', 'size', 'overlap'))
+        if not signatures:
+            return self.create_response(request, {'objects': []})
+        sig_ids, names, sizes, overlaps = zip(*signatures)
+
+        pvalues = hypergeometric_sf(overlaps, sizes, len(gene_ids),
+                                    organism_genes.count())
+        adj_pvalues = fdr_correction(pvalues)
+        order = np.argsort(pvalues, kind='mergesort')
+        objects = [
+            {'signature': sig_ids[i], 'name': names[i], 'size': sizes[i],
+             'overlap': overlaps[i], 'pvalue': p, 'adj_pvalue': adj_p}
+            for i, p, adj_p in zip(order, nan_to_none(pvalues[order]),
+                                   nan_to_none(adj_pvalues[order]))
+        ]
+        return self.create_response(request, {'objects': objects})
+
+    def post_enrichment(self, request, **kwargs):
+        """
+        handle an incoming POST as a GET to work around URI length limitations
+        """
+        request.method = 'GET'  # override the incoming POST
+        converted_request = convert_post_to_VERB(request, 'GET')
+        return self.get_enrichment(converted_request, **kwargs)
+
     def post_multiple(self, request, **kwargs):
         """
         use POSTs for retrieving long lists of Signatures
@@ -308,7 +997,77 @@ class SignatureResource(ModelResource):
         kwargs[kwarg_name] = converted_request.body
         return self.get_multiple(converted_request, **kwargs)
 
+    def dispatch_related(self, request, **kwargs):
+        return self.dispatch('related', request, **kwargs)
+
+    def get_related(self, request, pk=None, **kwargs):
+        """
+        Return the k signatures of the same mlmodel that are most related
+        to a signature:
+          api/v0/signature/<id>/related/[?k=<k>&order_by=<measure>]
+
+        The signatures are sorted by decreasing "order_by" measure, which
+        is one of "pearson" (the default) or "spearman" (correlation of
+        the signatures' activity across samples) or "jaccard" (Jaccard
+        index of their participating genes); k is 10 by default.  Each
+        object in the response includes the signature's ID and name and
+        all three measures.  The measures are read from the mlmodel's
+        SignatureCorrelationStore (see analyze/similarity.py); the response
+        is "503 Service Unavailable" if it has not been built (see
+        build_signature_correlation).
+        """
+        try:
+            signature = Signature.objects.get(pk=pk,
+                                              mlmodel__published=True)
+        except Signature.DoesNotExist:
+            return http.HttpNotFound()
+
+        k = request.GET.get('k', '10')
+        try:
+            k = int(k)
+        except ValueError:
+            k = 0
+        if k < 1:
+            raise BadRequest("Invalid k: %s" % request.GET['k'])
+        measure = request.GET.get('order_by', 'pearson')
+        if measure not in SignatureCorrelations.measures:
+            raise BadRequest("Invalid order_by: %s" % measure)
+
+        correlations = SignatureCorrelationStore(
+            signature.mlmodel_id).load()
+        if correlations is None:
+            # Computing the correlations would read the whole activity of
+            # the model on every request.
+            return HttpResponse(
+                "The signature correlations of mlmodel %d have not been "
+                "built" % signature.mlmodel_id, status=503)
+        position, related = correlations.related(signature.id, k, measure)
+        if position is None:
+            # The signature was added after the store was built.
+            return self.create_response(request, {'objects': []})
+        signature_ids = correlations.signature_ids[related].tolist()
+        names = dict(Signature.objects.filter(
+            id__in=signature_ids).values_list('id', 'name'))
+        values = [nan_to_none(getattr(correlations, name)[position, related])
+                  for name in SignatureCorrelations.measures]
+        objects = [
+            dict(zip(SignatureCorrelations.measures, measures),
+                 signature=sig_id, name=names.get(sig_id))
+            for sig_id, measures in zip(signature_ids, zip(*values))
+        ]
+        return self.create_response(request, {'objects': objects})
+
     def apply_filters(self, request, applicable_filters):
+        """
+        Implementation of "heavy_genes" filter, a comma-separated list of
+        gene IDs.  By default ("heavy_genes_mode=all") the signatures in
+        which all of these genes participate are returned;
+        "heavy_genes_mode=any" returns the signatures that include at least
+        one of them, and "min_overlap=<k>" the signatures that include at
+        least k of them.  Either way the overlaps are counted by a single
+        aggregated query (grouped by signature) that the database runs as
+        a subquery of the signature list.
+        """
         object_list = super(SignatureResource, self).apply_filters(
             request, applicable_filters)
         heavy_genes = request.GET.get('heavy_genes', None)
@@ -324,21 +1083,44 @@ class SignatureResource(ModelResource):
             except ValueError:
                 raise BadRequest("Invalid gene IDs: %s" % heavy_genes)
 
-            for (i, q) in enumerate(query_genes):
-                q_signatures = {p.signature.id for p in
-                                Participation.objects.filter(gene=q)}
-                if i == 0:
-                    related_signatures = q_signatures
-                else:
-                    related_signatures = related_signatures & q_signatures
+            mode = request.GET.get('heavy_genes_mode', 'all')
+            min_overlap = request.GET.get('min_overlap', None)
+            if min_overlap is not None:
+                try:
+                    min_overlap = int(min_overlap)
+                except ValueError:
+                    min_overlap = 0
+                if min_overlap < 1:
+                    raise BadRequest(
+                        "Invalid min_overlap: %s" %
+                        request.GET['min_overlap'])
+            elif mode == 'all':
+                min_overlap = len(query_genes)
+            elif mode == 'any':
+                min_overlap = 1
+            else:
+                raise BadRequest("Invalid heavy_genes_mode: %s" % mode)
+
+            related_signatures = Participation.objects.filter(
+                gene__in=query_genes
+            ).values('signature').annotate(
+                overlap=Count('gene', distinct=True)
+            ).filter(overlap__gte=min_overlap).values('signature')
             object_list = object_list.filter(id__in=related_signatures)
         return object_list
 
 
-class ActivityResource(ModelResource):
+class ActivityResource(FlatValuesResource):
     sample = fields.IntegerField(attribute='sample_id', null=False)
     signature = fields.IntegerField(attribute='signature_id', null=False)
 
+    # Columns of the lists built by FlatValuesResource.
+    columns = (
+        ('sample', 'sample_id', np.int64),
+        ('signature', 'signature_id', np.int64),
+        ('value', 'value', np.float64),
+    )
+
     class Meta:
         queryset = Activity.objects.all()
         resource_name = 'activity'
@@ -354,6 +1136,129 @@ class ActivityResource(ModelResource):
         ordering = [
             'sample', 'signature'
         ]
+        # Both GET and POST are accepted by "volcano" because the sample
+        # groups may be too long to fit in a URI.
+        volcano_allowed_methods = ['get', 'post']
+
+    def get_object_list(self, request):
+        """
+        Hide the activity of staged mlmodels (see staged_mlmodel_ids()).
+        """
+        object_list = super(ActivityResource, self).get_object_list(request)
+        signature_ids = staged_signature_ids()
+        if signature_ids:
+            object_list = object_list.exclude(signature__in=signature_ids)
+        return object_list
+
+    def prepend_urls(self):
+        return [
+            url((r'^(?P<resource_name>%s)/'
+                 r'volcano%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_volcano'),
+                name='api_activity_volcano'),
+        ]
+
+    def dispatch_volcano(self, request, **kwargs):
+        return self.dispatch('volcano', request, **kwargs)
+
+    def get_volcano(self, request, **kwargs):
+        """
+        Compare the activity of two groups of samples on every signature
+        of an mlmodel and return the data needed for a volcano plot:
+          api/v0/activity/volcano/?mlmodel=<id>&base_group=<id1,id2,...>
+              &comp_group=<id3,id4,...>
+
+        Each object in the response includes the signature's ID and name,
+        "diff" (mean activity of base_group minus mean activity of
+        comp_group), "pvalue" (Welch's two-sample t-test), "adj_pvalue"
+        (Benjamini-Hochberg FDR-adjusted "pvalue") and "logsig"
+        (-log10(adj_pvalue)).  Undefined statistics are returned as null.
+        """
+        mlmodel = request.GET.get('mlmodel', None)
+        if not mlmodel:
+            raise BadRequest("Required parameter mlmodel is missing")
+        try:
+            mlmodel_id = MLModel.objects.get(id=int(mlmodel),
+                                             published=True).id
+        except (ValueError, MLModel.DoesNotExist):
+            raise BadRequest("Invalid mlmodel ID: %s" % mlmodel)
+
+        groups = []
+        for group_name in ('base_group', 'comp_group'):
+            group = request.GET.get(group_name, '')
+            try:
+                sample_ids = {int(id) for id in group.split(',') if id}
+            except ValueError:
+                raise BadRequest("Invalid sample IDs in %s: %s" %
+                                 (group_name, group))
+            if not sample_ids:
+                raise BadRequest("At least one sample is required in %s" %
+                                 group_name)
+            groups.append(sorted(sample_ids))
+        base_ids, comp_ids = groups
+
+        signatures = list(Signature.objects.filter(
+            mlmodel=mlmodel_id).order_by('name').values_list('id', 'name'))
+        signature_ids = [sig_id for sig_id, name in signatures]
+        # Retrieve the activity of both groups at once, then split it.
+        sample_ids = sorted(set(base_ids) | set(comp_ids))
+        matrix = self.get_activity_matrix(mlmodel_id, sample_ids,
+                                          signature_ids)
+        row_index = {sample_id: i for i, sample_id in enumerate(sample_ids)}
+        base = matrix[[row_index[id] for id in base_ids]]
+        comp = matrix[[row_index[id] for id in comp_ids]]
+
+        diff, t, pvalues = welch_ttest(base, comp)
+        adj_pvalues = fdr_correction(pvalues)
+        with np.errstate(divide='ignore'):
+            logsig = -np.log10(adj_pvalues)
+        objects = [
+            {'signature': sig_id, 'name': name, 'diff': d, 'pvalue': p,
+             'adj_pvalue': adj_p, 'logsig': ls}
+            for (sig_id, name), d, p, adj_p, ls in zip(
+                signatures, nan_to_none(diff), nan_to_none(pvalues),
+                nan_to_none(adj_pvalues), nan_to_none(logsig))
+        ]
+        return self.create_response(request, {'objects': objects})
+
+    def post_volcano(self, request, **kwargs):
+        """
+        handle an incoming POST as a GET to work around URI length limitations
+        """
+        request.method = 'GET'  # override the incoming POST
+        converted_request = convert_post_to_VERB(request, 'GET')
+        return self.get_volcano(converted_request, **kwargs)
+
+    @staticmethod
+    def get_activity_matrix(mlmodel_id, sample_ids, signature_ids):
+        """
+        Retrieve the activity of "sample_ids" (rows) on "signature_ids"
+        (columns) of mlmodel_id and return it as a 2-D NumPy array.
+        Missing activity values are set to NaN.  The values are sliced
+        out of the model's ActivityMatrixStore if it has been built;
+        otherwise they are retrieved with a single query.
+        """
+        matrix = np.full((len(sample_ids), len(signature_ids)), np.nan)
+        if not sample_ids or not signature_ids:
+            return matrix
+
+        store = ActivityMatrixStore(mlmodel_id).load()
+        if store is not None:
+            rows, row_found = store.row_positions(sample_ids)
+            cols, col_found = store.col_positions(signature_ids)
+            matrix[np.ix_(row_found, col_found)] = store.values[
+                np.ix_(rows[row_found], cols[col_found])]
+            return matrix
+
+        row_index = {sample_id: i for i, sample_id in enumerate(sample_ids)}
+        col_index = {sig_id: j for j, sig_id in enumerate(signature_ids)}
+        records = Activity.objects.filter(
+            sample__in=sample_ids, signature__in=signature_ids
+        ).values_list('sample_id', 'signature_id', 'value')
+        for sample_id, signature_id, value in records.iterator():
+            matrix[row_index[sample_id], col_index[signature_id]] = value
+        return matrix
 
     def apply_filters(self, request, applicable_filters):
         """
@@ -378,11 +1283,19 @@ class ActivityResource(ModelResource):
         return object_list
 
 
-class EdgeResource(ModelResource):
+class EdgeResource(FlatValuesResource):
     gene1 = fields.IntegerField(attribute='gene1_id', null=False)
     gene2 = fields.IntegerField(attribute='gene2_id', null=False)
     mlmodel = fields.IntegerField(attribute='mlmodel_id', null=False)
 
+    # Columns of the lists built by FlatValuesResource.
+    columns = (
+        ('gene1', 'gene1_id', np.int64),
+        ('gene2', 'gene2_id', np.int64),
+        ('mlmodel', 'mlmodel_id', np.int64),
+        ('weight', 'weight', np.float64),
+    )
+
     class Meta:
         queryset = Edge.objects.all()
         resource_name = 'edge'
@@ -395,6 +1308,8 @@ class EdgeResource(ModelResource):
             'gene2': ('exact', 'in', ),
             'mlmodel': ('exact', 'in', ),
             'genes': ('exact', ),  # New filter, see apply_filters().
+            'min_weight': ('exact', ),  # New filter, see apply_filters().
+            'sign': ('exact', ),  # New filter, see apply_filters().
         }
         # Allow ordering by weight.
         # The following URL will sort the edges in ascending order of
@@ -406,15 +1321,41 @@ class EdgeResource(ModelResource):
         # (Note the extra "-" character before "weight".)
         ordering = ['weight']
 
+    def get_object_list(self, request):
+        """
+        Hide the edges of staged mlmodels (see staged_mlmodel_ids()).
+        """
+        object_list = super(EdgeResource, self).get_object_list(request)
+        mlmodel_ids = staged_mlmodel_ids()
+        if mlmodel_ids:
+            object_list = object_list.exclude(mlmodel__in=mlmodel_ids)
+        return object_list
+
     def apply_filters(self, request, applicable_filters):
         """
         Instead of overriding prepend_url() method, we added a new
-        filter "genes" to retrieve the edges whose "gene1" or "gene2"
-        field is on the list of genes in a URL like this:
+        filter "genes" to retrieve the subgraph induced by the genes on
+        the list and all of their neighbors in a URL like this:
           api/v0/edge/?genes=id1,id2,...&...
+
+        Two more filters apply to all edges: "min_weight" keeps the edges
+        whose absolute weight is at least its value, and "sign"
+        ("positive" or "negative") keeps the edges with that sign.
+
+        Subgraphs of the models whose GeneNetworkStore has been built are
+        usually read from the store instead (see get_stored_columns()).
         """
         object_list = super(EdgeResource, self).apply_filters(
             request, applicable_filters)
+        min_weight, sign = self.parse_weight_filters(request.GET)
+        if min_weight is not None:
+            object_list = object_list.filter(
+                Q(weight__gte=min_weight) | Q(weight__lte=-min_weight))
+        if sign == 'positive':
+            object_list = object_list.filter(weight__gt=0)
+        elif sign == 'negative':
+            object_list = object_list.filter(weight__lt=0)
+
         genes = request.GET.get('genes', None)
         if genes:
             # Instead of relying on tastypie/resources.py to catch the
@@ -427,18 +1368,76 @@ class EdgeResource(ModelResource):
                 ids = {int(id) for id in genes.split(',')}
             except ValueError:
                 raise BadRequest("Invalid gene IDs: %s" % genes)
+
             # "in" operator in Django supports both list and set.
             qset = Q(gene1__in=ids) | Q(gene2__in=ids)
-            direct_edges = object_list.filter(qset).distinct()
             related_genes = set()
-            for e in direct_edges:
-                related_genes.add(e.gene1)
-                related_genes.add(e.gene2)
+            for gene1, gene2 in object_list.filter(qset).values_list(
+                    'gene1_id', 'gene2_id').iterator():
+                related_genes.add(gene1)
+                related_genes.add(gene2)
             object_list = object_list.filter(
-                gene1__in=related_genes, gene2__in=related_genes
-            ).distinct()
+                gene1__in=related_genes, gene2__in=related_genes)
         return object_list
 
+    @staticmethod
+    def parse_weight_filters(params):
+        """
+        Return the values of the "min_weight" and "sign" filters in params
+        (None if not given).  Raise BadRequest if one is invalid.
+        """
+        min_weight = params.get('min_weight', None)
+        if min_weight is not None:
+            try:
+                min_weight = float(min_weight)
+            except ValueError:
+                raise BadRequest("Invalid min_weight: %s" % min_weight)
+        sign = params.get('sign', None)
+        if sign not in (None, 'positive', 'negative'):
+            raise BadRequest("Invalid sign: %s" % sign)
+        return min_weight, sign
+
+    # Parameters of the requests that can be served from the
+    # GeneNetworkStore (see get_stored_columns()).
+    stored_params = {'genes', 'mlmodel', 'min_weight', 'sign', 'order_by',
+                     'format'}
+
+    def get_stored_columns(self, request, **kwargs):
+        """
+        Read the subgraph of a "genes" request from the GeneNetworkStore of
+        the requested mlmodel (see analyze/matrix_store.py) when no filter
+        other than "mlmodel", "min_weight" and "sign" restricts the edges
+        and the mlmodel is published and its store has been built.  The
+        cost then depends on the size of the neighborhood instead of the
+        total number of edges.
+        The edges are sorted by ID unless they are sorted by weight.
+        """
+        params = request.GET
+        order_by = params.get('order_by', None)
+        if (set(params) - self.stored_params or
+                order_by not in (None, 'weight', '-weight')):
+            return None
+        try:
+            mlmodel_id = int(params.get('mlmodel', ''))
+            gene_ids = {int(id) for id in params.get('genes', '').split(',')}
+        except ValueError:
+            return None  # Let the queryset report the error.
+        min_weight, sign = self.parse_weight_filters(params)
+        if mlmodel_id in staged_mlmodel_ids():
+            return None
+        network = GeneNetworkStore(mlmodel_id).load()
+        if network is None:
+            return None
+        edge_ids, genes1, genes2, weights = network.neighborhood_edges(
+            sorted(gene_ids), min_weight, sign)
+        if order_by is not None:
+            order = np.argsort(weights if order_by == 'weight' else -weights,
+                               kind='mergesort')
+            edge_ids, genes1, genes2, weights = (
+                edge_ids[order], genes1[order], genes2[order], weights[order])
+        mlmodels = np.full(len(edge_ids), mlmodel_id, dtype=np.int64)
+        return [edge_ids, genes1, genes2, mlmodels, weights]
+
 
 class ParticipationTypeResource(ModelResource):
 
@@ -474,11 +1473,30 @@ class ParticipationResource(ModelResource):
             'participation_type': ('exact', 'in', ),
         }
 
+    def get_object_list(self, request):
+        """
+        Hide the participations of the signatures of staged mlmodels (see
+        staged_mlmodel_ids()).
+        """
+        object_list = super(ParticipationResource, self).get_object_list(
+            request)
+        signature_ids = staged_signature_ids()
+        if signature_ids:
+            object_list = object_list.exclude(signature__in=signature_ids)
+        return object_list
+
 
-class ExpressionValueResource(ModelResource):
+class ExpressionValueResource(FlatValuesResource):
     gene = fields.IntegerField(attribute='gene_id', null=False)
     sample = fields.IntegerField(attribute='sample_id', null=False)
 
+    # Columns of the lists built by FlatValuesResource.
+    columns = (
+        ('sample', 'sample_id', np.int64),
+        ('gene', 'gene_id', np.int64),
+        ('value', 'value', np.float64),
+    )
+
     class Meta:
         queryset = ExpressionValue.objects.all()
         include_resource_uri = False
@@ -492,6 +1510,114 @@ class ExpressionValueResource(ModelResource):
         }
         # Allow ordering by gene ID.
         ordering = ['gene']
+        # Both GET and POST are accepted by "differential" because the
+        # sample groups may be too long to fit in a URI.
+        differential_allowed_methods = ['get', 'post']
+
+    def prepend_urls(self):
+        return [
+            url((r'^(?P<resource_name>%s)/'
+                 r'differential%s$') %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_differential'),
+                name='api_expressionvalue_differential'),
+        ]
+
+    def dispatch_differential(self, request, **kwargs):
+        return self.dispatch('differential', request, **kwargs)
+
+    def get_differential(self, request, **kwargs):
+        """
+        Compare the expression of two groups of samples on every gene of
+        an organism:
+          api/v0/expressionvalue/differential/?organism=<id>
+              &base_group=<id1,id2,...>&comp_group=<id3,id4,...>
+
+        The response is a compact table of parallel arrays, one entry per
+        gene that has expression values in the samples, ranked by
+        increasing p-value: "gene" (gene IDs), "diff" (mean expression of
+        base_group minus mean expression of comp_group), "t" and "pvalue"
+        (Welch's two-sample t-test) and "adj_pvalue" (Benjamini-Hochberg
+        FDR-adjusted "pvalue"), plus "meta": {"total_count": <number of
+        genes>}.  Undefined statistics are returned as null.
+        """
+        organism = request.GET.get('organism', None)
+        if not organism:
+            raise BadRequest("Required parameter organism is missing")
+        try:
+            organism_id = int(organism)
+        except ValueError:
+            raise BadRequest("Invalid organism ID: %s" % organism)
+
+        groups = []
+        for group_name in ('base_group', 'comp_group'):
+            group = request.GET.get(group_name, '')
+            try:
+                sample_ids = {int(id) for id in group.split(',') if id}
+            except ValueError:
+                raise BadRequest("Invalid sample IDs in %s: %s" %
+                                 (group_name, group))
+            if not sample_ids:
+                raise BadRequest("At least one sample is required in %s" %
+                                 group_name)
+            groups.append(sorted(sample_ids))
+        base_ids, comp_ids = groups
+
+        # Retrieve the expression of both groups at once, then split it.
+        sample_ids = sorted(set(base_ids) | set(comp_ids))
+        gene_ids, matrix = self.get_expression_matrix(organism_id,
+                                                      sample_ids)
+        measured = ~np.isnan(matrix).all(axis=0)
+        gene_ids, matrix = gene_ids[measured], matrix[:, measured]
+        row_index = {sample_id: i for i, sample_id in enumerate(sample_ids)}
+        base = matrix[[row_index[id] for id in base_ids]]
+        comp = matrix[[row_index[id] for id in comp_ids]]
+
+        diff, t, pvalues = welch_ttest(base, comp)
+        adj_pvalues = fdr_correction(pvalues)
+        # NaN p-values are ranked last.
+        order = np.argsort(pvalues, kind='mergesort')
+        return self.create_response(request, {
+            'meta': {'total_count': len(order)},
+            'gene': gene_ids[order].tolist(),
+            'diff': nan_to_none(diff[order]),
+            't': nan_to_none(t[order]),
+            'pvalue': nan_to_none(pvalues[order]),
+            'adj_pvalue': nan_to_none(adj_pvalues[order]),
+        })
+
+    def post_differential(self, request, **kwargs):
+        """
+        handle an incoming POST as a GET to work around URI length limitations
+        """
+        request.method = 'GET'  # override the incoming POST
+        converted_request = convert_post_to_VERB(request, 'GET')
+        return self.get_differential(converted_request, **kwargs)
+
+    @staticmethod
+    def get_expression_matrix(organism_id, sample_ids):
+        """
+        Retrieve the expression of the sorted "sample_ids" (rows) on the
+        genes of organism_id and return (gene IDs, 2-D NumPy array).
+        Missing values are NaN.  The rows are read from the organism's
+        ExpressionMatrixStore if it has been built; otherwise the values
+        are retrieved with a single query.
+        """
+        store = ExpressionMatrixStore(organism_id).load()
+        if store is not None:
+            return store.gene_ids, store.sample_rows(sample_ids)
+
+        samples, genes, values = records_to_columns(
+            ExpressionValue.objects.filter(
+                gene__organism=organism_id, sample__in=sample_ids
+            ).values_list('sample_id', 'gene_id', 'value').iterator(),
+            (np.int64, np.int64, np.float64))
+        gene_ids, cols = np.unique(genes, return_inverse=True)
+        rows = np.searchsorted(np.asarray(sample_ids, dtype=np.int64),
+                               samples)
+        matrix = np.full((len(sample_ids), len(gene_ids)), np.nan)
+        matrix[rows, cols] = values
+        return gene_ids, matrix
 
     def post_list(self, request, **kwargs):
         """
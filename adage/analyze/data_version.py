@@ -0,0 +1,100 @@
+"""
+Data-version stamps for caches derived from the database.
+
+A stamp is a small file under settings.DATA_CACHE_DIR/versions whose
+content (a random token) changes every time the data it covers change,
+and whose modification time is the time of that change.  Caches (such as
+the annotation TSV files served by SampleResource.get_annotations) are
+keyed by the current token, so bumping a stamp invalidates them in every
+worker process at once.
+
+Stamps are bumped by the import management commands and by the model
+signal receivers at the end of models.py.  A stamp must only be bumped
+once the change has been committed: a cache generated from the data
+seen before the commit would otherwise be stored under the new token and
+served until the next change.  Changes made inside a transaction are
+therefore recorded by bump_data_version_on_commit() and bumped by
+bump_pending_data_versions(), which runs at the end of every request
+(when the transactions of views have been committed) and must be called
+after any other transaction that changes such data (including those that
+Django opens itself, e.g. to delete objects).
+"""
+
+import os
+import threading
+import uuid
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection
+from django.dispatch import receiver
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Name of the stamp that covers experiments, samples and annotations.
+ANNOTATIONS = 'annotations'
+
+# Names of the stamps to bump once the current transaction of this thread
+# has been committed.
+_pending = threading.local()
+
+
+def stamp_path(name):
+    return os.path.join(settings.DATA_CACHE_DIR, 'versions', name)
+
+
+def bump_data_version(name):
+    """
+    Replace stamp "name" with a new token, and return a tuple of
+    (token, modification timestamp).
+    """
+    path = stamp_path(name)
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    token = uuid.uuid4().hex
+    tmp_path = "%s.%s.tmp" % (path, token)
+    with open(tmp_path, 'w') as stamp_file:
+        stamp_file.write(token)
+    os.rename(tmp_path, path)
+    return token, os.path.getmtime(path)
+
+
+def get_data_version(name):
+    """
+    Return a tuple of (token, modification timestamp) of stamp "name".
+    A stamp that does not exist yet is created.
+    """
+    path = stamp_path(name)
+    try:
+        with open(path) as stamp_file:
+            return stamp_file.read().strip(), os.path.getmtime(path)
+    except (IOError, OSError):
+        return bump_data_version(name)
+
+
+def bump_data_version_on_commit(name):
+    """
+    Bump stamp "name" now if the database connection is in autocommit
+    mode (so the change is already committed), or else once the current
+    transaction has been committed (see bump_pending_data_versions()).
+    """
+    if connection.in_atomic_block:
+        _pending.names = getattr(_pending, 'names', set()) | {name}
+    else:
+        bump_data_version(name)
+
+
+@receiver(request_finished)
+def bump_pending_data_versions(**kwargs):
+    """
+    Bump the stamps recorded by bump_data_version_on_commit() in this
+    thread.
+    """
+    names, _pending.names = getattr(_pending, 'names', set()), set()
+    for name in sorted(names):
+        try:
+            bump_data_version(name)
+        except (IOError, OSError) as e:
+            logger.warning("Failed to bump the %s data version: %s", name, e)
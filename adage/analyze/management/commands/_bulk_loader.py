@@ -0,0 +1,383 @@
+"""
+Shared bulk loader of the import management commands.
+
+BulkLoader streams validated tuples of column values into a table.  On
+PostgreSQL the tuples are written into an in-memory buffer in the text
+format of "COPY ... FROM STDIN", which is sent to the server every
+time it reaches BUFFER_SIZE bytes, so no model instance (and no huge
+INSERT statement) is ever built.  On other databases (e.g. SQLite in
+tests) it falls back to bulk_create() in batches of BATCH_SIZE records.
+
+Typical usage inside the import's transaction:
+
+  with BulkLoader(Activity, ('sample_id', 'signature_id', 'value')) as loader:
+      for ...:
+          loader.add((sample_id, signature_id, value))
+  print(loader.count)
+
+DiffLoader has the same interface for "--update" imports: the tuples
+are compared with the existing records, and only new, changed and
+removed records are written.  Changed records are updated in place, so
+they keep their IDs (which the API exposes).
+
+(The module name starts with an underscore so that Django does not take
+it for a management command.)
+"""
+
+import io
+import math
+import numpy as np
+from django.db import connection
+import _instrumentation
+
+# Size (in bytes) of the COPY buffer that is sent to PostgreSQL at a time.
+BUFFER_SIZE = 16 * 1024 * 1024
+
+# Number of records created by each bulk_create() call when COPY is not
+# available.
+BATCH_SIZE = 20000
+
+# Number of IDs in each "DELETE ... WHERE id IN (...)" query of DiffLoader
+# (below the limit of query parameters of SQLite).
+DELETE_BATCH_SIZE = 900
+
+# Characters that must be escaped in the text format of COPY.
+COPY_ESCAPES = {
+    ord(u'\\'): u'\\\\',
+    ord(u'\t'): u'\\t',
+    ord(u'\n'): u'\\n',
+    ord(u'\r'): u'\\r',
+}
+
+
+def copy_text(value):
+    """Format "value" as a column value in the text format of COPY."""
+    if value is None:
+        return u'\\N'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return u'NaN'
+        if math.isinf(value):
+            return u'Infinity' if value > 0 else u'-Infinity'
+        return repr(value)
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return unicode(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(rows):
+    """
+    Format an iterable of tuples as the (UTF-8 encoded) data of COPY.
+    Tuples can be formatted by other processes with this function and
+    loaded with BulkLoader.add_copy_data().
+    """
+    return b''.join(
+        u'\t'.join(copy_text(value) for value in values).encode('utf-8') +
+        b'\n' for values in rows)
+
+
+class BulkLoader(object):
+    """
+    Load tuples of values of the fields "fields" (attribute names such
+    as "sample_id") into the table of "model".  Call add() or extend()
+    with the tuples and flush() (or use the loader as a context manager)
+    at the end; "count" is the number of tuples loaded so far.  The
+    "line_num" argument of extend() (the input line of the tuples) is
+    only used by DiffLoader.
+    """
+    def __init__(self, model, fields, use_copy=None):
+        self.model = model
+        self.fields = tuple(fields)
+        columns = {f.attname: f.column for f in model._meta.concrete_fields}
+        self.columns = [columns[field] for field in self.fields]
+        if use_copy is None:
+            use_copy = connection.vendor == 'postgresql'
+        self.use_copy = use_copy
+        self.count = 0
+        self._pending = 0  # number of tuples not written yet
+        self._buffer = io.BytesIO()
+        self._records = []
+
+    def add(self, values):
+        if self.use_copy:
+            self._buffer.write(copy_rows((values, )))
+            if self._buffer.tell() >= BUFFER_SIZE:
+                self.flush()
+        else:
+            self._records.append(self.model(**dict(zip(self.fields, values))))
+            if len(self._records) >= BATCH_SIZE:
+                self.flush()
+        self.count += 1
+        self._pending += 1
+
+    def extend(self, rows, line_num=None):
+        for values in rows:
+            self.add(values)
+
+    def add_copy_data(self, data, count):
+        """
+        Add "count" tuples that have already been formatted by copy_rows().
+        Only available when COPY is used.
+        """
+        self._buffer.write(data)
+        if self._buffer.tell() >= BUFFER_SIZE:
+            self.flush()
+        self.count += count
+        self._pending += count
+
+    def flush(self):
+        """Write the buffered tuples into the database."""
+        with _instrumentation.phase('write'):
+            if self.use_copy:
+                if self._buffer.tell():
+                    qn = connection.ops.quote_name
+                    self._buffer.seek(0)
+                    with connection.cursor() as cursor:
+                        cursor.copy_expert(
+                            "COPY %s (%s) FROM STDIN" % (
+                                qn(self.model._meta.db_table),
+                                ', '.join(qn(column)
+                                          for column in self.columns)),
+                            self._buffer)
+                    self._buffer = io.BytesIO()
+            elif self._records:
+                self.model.objects.bulk_create(self._records)
+                self._records = []
+        _instrumentation.count('rows_written', self._pending)
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Nothing is written if the import failed; its transaction will be
+        # rolled back anyway.
+        if exc_type is None:
+            self.flush()
+
+
+class DiffLoader(object):
+    """
+    Update the existing records of "queryset" (whose model has the fields
+    in "fields", e.g. ('sample_id', 'signature_id', 'value')) to the full
+    matrix of (row ID, column ID, value) tuples that are passed to add()
+    or extend(), so that re-importing a matrix only writes what changed:
+      * tuples of new (row ID, column ID) pairs are inserted;
+      * records whose value differs by more than "tolerance" are updated
+        (see update_values());
+      * records that were not passed at all (e.g. samples that have been
+        removed from the input file) are deleted by flush().
+    The existing (row ID, column ID) pairs are kept in a sorted NumPy
+    array, so each batch of tuples is compared without any query.
+    "inserted", "updated" and "deleted" count the records written.
+    A (row ID, column ID) pair that is passed more than once raises an
+    exception before any of the tuples of its batch is written.
+
+    Like BulkLoader, a DiffLoader is used inside the import's transaction,
+    and flush() must be called (once) after the last tuple.
+    """
+    use_copy = False  # tuples are never pre-formatted for COPY
+
+    def __init__(self, queryset, fields, tolerance=0.0):
+        self.model = queryset.model
+        self.loader = BulkLoader(self.model, fields)
+        self.tolerance = tolerance
+        # 24 bytes per existing record
+        with _instrumentation.phase('validate'):
+            records = self.read_records(queryset, fields)
+        records.sort(order='key')
+        self.keys = records['key']
+        self.ids = records['id']
+        self.values = records['value']
+        self.seen = np.zeros(len(records), dtype=bool)
+        self.inserted = self.updated = self.deleted = 0
+        self._changed = []  # (id, tuple) of the changed records
+        self._values_table = None  # see update_values()
+        self._passed = KeySet()  # 8 bytes per tuple passed
+
+    @staticmethod
+    def read_records(queryset, fields):
+        return np.fromiter(
+            ((diff_key(row, col), record_id, value)
+             for row, col, record_id, value in queryset.values_list(
+                 fields[0], fields[1], 'id', fields[2]).iterator()),
+            dtype=[('key', np.int64), ('id', np.int64),
+                   ('value', np.float64)])
+
+    @property
+    def count(self):
+        return self.inserted + self.updated
+
+    def add(self, values, line_num=None):
+        self.extend((values, ), line_num)
+
+    def extend(self, rows, line_num=None):
+        """
+        Compare the tuples "rows" with the existing records.  "line_num"
+        is the input line of the tuples, which is reported if one of them
+        repeats a (row ID, column ID) pair.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        keys = np.array([diff_key(row, col) for row, col, _ in rows],
+                        dtype=np.int64)
+        self.check_duplicates(keys, line_num)
+        if not len(self.keys):
+            self.loader.extend(rows)
+            self.inserted += len(rows)
+            return
+        values = np.array([row[2] for row in rows], dtype=np.float64)
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys
+        self.seen[positions[found]] = True
+        # NaN is only equal to NaN.
+        old_values = self.values[positions]
+        changed = found & ~((np.abs(old_values - values) <= self.tolerance) |
+                            (np.isnan(old_values) & np.isnan(values)))
+        for index in np.flatnonzero(~found):
+            self.loader.add(rows[index])
+            self.inserted += 1
+        for index in np.flatnonzero(changed):
+            self._changed.append((self.ids[positions[index]], rows[index]))
+        if len(self._changed) >= BATCH_SIZE:
+            self._apply_changes()
+
+    def _apply_changes(self):
+        self.update_values([(int(record_id), values[2])
+                            for record_id, values in self._changed])
+        self.updated += len(self._changed)
+        self._changed = []
+
+    def update_values(self, changes):
+        """
+        Set the value of the records of the (record ID, value) pairs
+        "changes".  On PostgreSQL the pairs are copied into a temporary
+        table and applied by one "UPDATE ... FROM" query; on other
+        databases they are applied by one executemany() of UPDATE
+        queries.
+        """
+        if not changes:
+            return
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        id_column = qn(self.model._meta.pk.column)
+        value_column = qn(self.loader.columns[2])
+        with _instrumentation.phase('write'), connection.cursor() as cursor:
+            if self.loader.use_copy:
+                if self._values_table is None:
+                    self._values_table = qn('diff_loader_values')
+                    cursor.execute("DROP TABLE IF EXISTS %s" %
+                                   self._values_table)
+                    cursor.execute(
+                        "CREATE TEMPORARY TABLE %s (id bigint, "
+                        "value double precision)" % self._values_table)
+                else:
+                    cursor.execute("TRUNCATE %s" % self._values_table)
+                cursor.copy_expert(
+                    "COPY %s (id, value) FROM STDIN" % self._values_table,
+                    io.BytesIO(copy_rows(changes)))
+                cursor.execute(
+                    "UPDATE {table} SET {value} = v.value FROM {values} v "
+                    "WHERE {table}.{id} = v.id".format(
+                        table=table, value=value_column,
+                        values=self._values_table, id=id_column))
+            else:
+                cursor.executemany(
+                    "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                        table, value_column, id_column),
+                    [(value, record_id) for record_id, value in changes])
+        _instrumentation.count('rows_written', len(changes))
+
+    def delete_ids(self, ids):
+        ids = [int(record_id) for record_id in ids]
+        with _instrumentation.phase('write'):
+            for start in xrange(0, len(ids), DELETE_BATCH_SIZE):
+                self.model.objects.filter(
+                    id__in=ids[start:start + DELETE_BATCH_SIZE]).delete()
+        _instrumentation.count('rows_deleted', len(ids))
+
+    def check_duplicates(self, keys, line_num=None):
+        """
+        Raise an exception if one of the pairs "keys" (see diff_key())
+        repeats another one of "keys" or one passed before; otherwise
+        record them as passed.
+        """
+        # A stable sort keeps the repeated pairs in input order.
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        repeated = np.zeros(len(keys), dtype=bool)
+        repeated[order[1:][np.diff(sorted_keys) == 0]] = True
+        repeated |= self._passed.contains(keys)
+        if repeated.any():
+            row_id, col_id = split_diff_key(keys[np.argmax(repeated)])
+            message = "%s %d and %s %d are not unique" % (
+                self.loader.fields[0], row_id, self.loader.fields[1], col_id)
+            if line_num is not None:
+                message = "Input file line #%d: %s" % (line_num, message)
+            raise Exception(message)
+        self._passed.add(sorted_keys)
+
+    def flush(self):
+        """
+        Write the pending changes and delete the records that were not
+        passed.
+        """
+        self._apply_changes()
+        removed = self.ids[~self.seen]
+        self.delete_ids(removed)
+        self.deleted += len(removed)
+        self.seen[~self.seen] = True
+        self.loader.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+class KeySet(object):
+    """
+    A set of int64 keys stored as a few sorted NumPy arrays ("runs") of
+    decreasing sizes; a new run is merged with the previous ones while
+    they are not more than twice as large, so there are O(log n) runs
+    and adding or looking up a batch of keys needs no Python loop over
+    the keys.
+    """
+    def __init__(self):
+        self.runs = []
+
+    def contains(self, keys):
+        """Return a boolean mask of the "keys" that are in the set."""
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.searchsorted(run, keys)
+            positions[positions == len(run)] = 0
+            found |= run[positions] == keys
+        return found
+
+    def add(self, keys):
+        """Add the sorted "keys", none of which is in the set yet."""
+        run = keys
+        while self.runs and len(self.runs[-1]) <= 2 * len(run):
+            run = np.concatenate((self.runs.pop(), run))
+            run.sort(kind='mergesort')
+        self.runs.append(run)
+
+
+def diff_key(row_id, col_id):
+    """Encode a pair of IDs as one 64-bit integer."""
+    return (row_id << 32) | col_id
+
+
+def split_diff_key(key):
+    """Decode the pair of IDs encoded by diff_key()."""
+    key = int(key)
+    return key >> 32, key & 0xffffffff
@@ -0,0 +1,24 @@
+"""
+Gene lookups shared by the import management commands.
+
+Input files name genes by their systematic names.  load_gene_ids() maps
+all of them to database IDs with a single query, so that data lines can
+be resolved without any query.
+
+(The module name starts with an underscore so that Django does not take
+it for a management command.)
+"""
+
+from genes.models import Gene
+
+
+def load_gene_ids(organism_id):
+    """
+    Return a dictionary that maps the systematic_name of every gene of
+    the organism to its ID, or to None if the name matches multiple genes.
+    """
+    gene_ids = {}
+    for name, gene_id in Gene.objects.filter(
+            organism_id=organism_id).values_list('systematic_name', 'id'):
+        gene_ids[name] = None if name in gene_ids else gene_id
+    return gene_ids
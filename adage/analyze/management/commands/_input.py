@@ -0,0 +1,162 @@
+"""
+Shared input files of the import management commands.
+
+open_input() opens an input file by name, or standard input if the name
+is "-", and transparently decompresses gzip, bzip2 and xz data, which
+are recognized by their first bytes (not by the file name), so data can
+be piped into a command as they are produced:
+
+  zcat network.txt.gz | python manage.py import_gene_network - "Model"
+  python manage.py import_gene_network network.txt.gz "Model"
+
+The result is a buffered binary file object whose lines are read by C
+code, like the file objects that the commands used to open with
+"type=file".  Only an uncompressed named file is "regular" (see
+is_regular_file() in import_gene_sample_expr.py); decompressed streams
+have no name.
+
+Reading xz data requires the "lzma" module, which is part of Python 3
+and is provided by the "backports.lzma" package in Python 2.
+
+(The module name starts with an underscore so that Django does not take
+it for a management command.)
+"""
+
+import argparse
+import bz2
+import io
+import sys
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Size (in bytes) of the read buffers.
+BUFFER_SIZE = 1024 * 1024
+
+
+def gzip_decompressor():
+    # 16 + MAX_WBITS: expect a gzip header and trailer.
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def xz_decompressor():
+    if lzma is None:
+        raise IOError("Reading xz data requires the backports.lzma package")
+    return lzma.LZMADecompressor()
+
+
+# (magic bytes, decompressor factory) of the supported formats
+FORMATS = (
+    (b'\x1f\x8b', gzip_decompressor),
+    (b'BZh', bz2.BZ2Decompressor),
+    (b'\xfd7zXZ\x00', xz_decompressor),
+)
+
+
+class DecompressedStream(io.RawIOBase):
+    """
+    Raw stream of the decompressed data of the buffered binary stream
+    "source".  Concatenated compressed streams (e.g. from "cat a.gz b.gz"
+    or parallel compressors) are decompressed one after another.  IOError
+    is raised if "source" ends in the middle of a compressed stream (e.g.
+    a truncated file), instead of silently returning part of the data.
+    """
+    def __init__(self, source, new_decompressor):
+        super(DecompressedStream, self).__init__()
+        self.source = source
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+        self.pending = b''  # decompressed data not read yet
+        self.offset = 0
+        self.at_eof = False  # all streams of "source" have been read
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self.offset == len(self.pending):
+            data = None if self.at_eof else self.source.read(BUFFER_SIZE)
+            if not data:
+                if not self.at_eof and not stream_ended(self.decompressor):
+                    raise IOError("Unexpected end of compressed data "
+                                  "(the input is truncated)")
+                self.at_eof = True
+                return 0
+            self.pending = self.decompress(data)
+            self.offset = 0
+        size = min(len(buf), len(self.pending) - self.offset)
+        buf[:size] = self.pending[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self.decompressor.decompress(data))
+            except EOFError:
+                # bzip2 and xz decompressors reject data after the end of
+                # their stream; start the next one.
+                self.decompressor = self.new_decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                # The end of a stream was reached; start the next one.
+                self.decompressor = self.new_decompressor()
+        return b''.join(output)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super(DecompressedStream, self).close()
+
+
+def stream_ended(decompressor):
+    """
+    Return True if "decompressor" has reached the end of its compressed
+    stream.  This is called once its input is exhausted.  Decompressors
+    without an "eof" attribute (those of zlib and bz2 in Python 2) are
+    fed one more byte, which is left in unused_data (zlib) or rejected
+    with EOFError (bz2) only after the end of the stream.
+    """
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    try:
+        decompressor.decompress(b'\x00')
+    except EOFError:
+        return True
+    except (IOError, zlib.error):
+        return False  # not a valid continuation of the stream
+    return bool(decompressor.unused_data)
+
+
+def open_input(name):
+    """
+    Open input file "name" ("-" for standard input) for reading, and
+    return a buffered binary file object of its (decompressed) data.
+    """
+    if name == '-':
+        source = io.open(sys.stdin.fileno(), 'rb', BUFFER_SIZE,
+                         closefd=False)
+    else:
+        source = io.open(name, 'rb', BUFFER_SIZE)
+    magic = source.peek(6)
+    for prefix, new_decompressor in FORMATS:
+        if magic.startswith(prefix):
+            return io.BufferedReader(
+                DecompressedStream(source, new_decompressor), BUFFER_SIZE)
+    return source
+
+
+def input_file(name):
+    """argparse "type" of input file arguments (see open_input())."""
+    try:
+        return open_input(name)
+    except IOError as e:
+        raise argparse.ArgumentTypeError(
+            "can't open '%s': %s" % (name, e))
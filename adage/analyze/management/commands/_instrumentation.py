@@ -0,0 +1,184 @@
+"""
+Shared instrumentation of the import management commands.
+
+The import functions report what they do to the module-level ImportStats
+object "stats":
+
+  for line_index, line in enumerate(lines(file_handle)):  # counts lines
+      ...
+  with phase('validate'):
+      gene_ids = ...                     # time spent validating input
+  count('rows_written', n)                # any other counter
+
+BulkLoader and DiffLoader (see _bulk_loader.py) time their database
+writes as the "write" phase and count the rows they write, so an import
+only has to time its validation.  The time not spent in any phase is
+reported as "parse".  Rebuilding matrix stores after the import is
+timed as the "rebuild" phase, which the rows/s rate leaves out.
+
+A command that derives from InstrumentedCommand (and calls the
+add_arguments() of its base class) resets "stats" before it runs, prints
+a progress line to stderr every PROGRESS_INTERVAL seconds, prints a
+summary (lines parsed, rows written, rows/s, time per phase and peak
+RSS) when it ends, and writes the summary as JSON into the file given
+by its "--stats-file" option, whether the import succeeded or not.
+
+(The module name starts with an underscore so that Django does not take
+it for a management command.)
+"""
+
+import collections
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand
+
+# Minimum number of seconds between two progress lines.
+PROGRESS_INTERVAL = 10
+
+# Number of lines between two checks of the progress clock.
+LINES_PER_CHECK = 10000
+
+
+class ImportStats(object):
+    def __init__(self, out=None):
+        self.out = out  # function that writes progress lines (or None)
+        self.start = time.time()
+        self.last_progress = self.start
+        self.counters = collections.Counter()
+        self.timings = collections.Counter()
+        self._phases = []  # stack of (phase name, start time)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Count the time spent in the block as phase "name".  Time spent in
+        nested phases is only counted for the innermost one.
+        """
+        now = time.time()
+        if self._phases:
+            outer, outer_start = self._phases[-1]
+            self.timings[outer] += now - outer_start
+        self._phases.append((name, now))
+        try:
+            yield
+        finally:
+            now = time.time()
+            name, phase_start = self._phases.pop()
+            self.timings[name] += now - phase_start
+            if self._phases:
+                self._phases[-1] = (self._phases[-1][0], now)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def progress(self):
+        """Write a progress line if PROGRESS_INTERVAL has passed."""
+        now = time.time()
+        if self.out is None or now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        elapsed = now - self.start
+        self.out("%8.1f s: %d lines parsed, %d rows written (%.0f rows/s)" % (
+            elapsed, self.counters['lines'], self.counters['rows_written'],
+            self.counters['rows_written'] / elapsed))
+
+    def summary(self):
+        """Return a dictionary of all statistics collected so far."""
+        elapsed = time.time() - self.start
+        timings = dict(self.timings)
+        timings['parse'] = max(0.0, elapsed - sum(self.timings.values()))
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+        rss_unit = 1 if sys.platform == 'darwin' else 1024
+        summary = dict(self.counters)
+        summary.update({
+            'lines': self.counters['lines'],
+            'rows_written': self.counters['rows_written'],
+            'elapsed_seconds': elapsed,
+            'rows_per_second': (self.counters['rows_written'] / max(
+                elapsed - self.timings['rebuild'], 1e-6)),
+            'phase_seconds': timings,
+            'peak_rss_bytes': usage.ru_maxrss * rss_unit,
+            'peak_worker_rss_bytes': children.ru_maxrss * rss_unit,
+        })
+        return summary
+
+
+stats = ImportStats()
+
+
+def phase(name):
+    return stats.phase(name)
+
+
+def phase_seconds(name):
+    """Return the time spent so far in phase "name"."""
+    return stats.timings[name]
+
+
+def count(name, n=1):
+    stats.count(name, n)
+
+
+def progress():
+    stats.progress()
+
+
+def lines(file_handle):
+    """Iterate over the lines of file_handle, counting them."""
+    num_lines = 0
+    for line in file_handle:
+        yield line
+        num_lines += 1
+        if num_lines == LINES_PER_CHECK:
+            stats.count('lines', num_lines)
+            stats.progress()
+            num_lines = 0
+    stats.count('lines', num_lines)
+
+
+def format_summary(summary):
+    text = ["%d lines parsed, %d rows written in %.1f seconds "
+            "(%.0f rows/s)" % (summary['lines'], summary['rows_written'],
+                               summary['elapsed_seconds'],
+                               summary['rows_per_second'])]
+    text.append("Time per phase: " + ", ".join(
+        "%s %.1f s" % item for item in sorted(
+            summary['phase_seconds'].items())))
+    text.append("Peak RSS: %.0f MB (worker processes: %.0f MB)" % (
+        summary['peak_rss_bytes'] / 1048576.0,
+        summary['peak_worker_rss_bytes'] / 1048576.0))
+    return "\n".join(text)
+
+
+class InstrumentedCommand(BaseCommand):
+    """
+    Base class of the instrumented import commands (see above).
+    """
+    def add_arguments(self, parser):
+        parser.add_argument('--stats-file', dest='stats_file', default=None,
+                            help='Write a JSON summary of the import '
+                            'statistics into this file')
+
+    def execute(self, *args, **options):
+        global stats
+        # execute() may replace self.stderr, so look it up when writing.
+        stats = ImportStats(out=lambda text: self.stderr.write(text))
+        status = 'failed'
+        try:
+            result = super(InstrumentedCommand, self).execute(*args,
+                                                              **options)
+            status = 'succeeded'
+            return result
+        finally:
+            summary = stats.summary()
+            summary['command'] = self.__module__.rsplit('.', 1)[-1]
+            summary['status'] = status
+            self.stdout.write(format_summary(summary))
+            if options.get('stats_file'):
+                with open(options['stats_file'], 'w') as stats_file:
+                    json.dump(summary, stats_file, indent=2, sort_keys=True)
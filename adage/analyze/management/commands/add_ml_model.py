@@ -7,7 +7,7 @@ invoked like this:
 
   python manage.py add_ml_model <ml_model_name> <organism_tax_id> \
  [--directed_edge] [--g2g_edge_cutoff <cutoff_value>] \
- [--desc_html <desc_html>]
+ [--desc_html <desc_html>] [--staged]
 
 The two required arguments are:
   (1) ml_model_name: machine learning model name;
@@ -24,6 +24,10 @@ gene-gene network; otherwise the edge cutoff value will be set to 0.
 "--desc_html" is another optional argument that is the model description
 in html format; the default is an empty string.
 
+"--staged" adds the model unpublished: it is hidden from the API until
+the "publish_ml_model" command has validated and published it, so its
+data can be imported while the API keeps serving the other models.
+
 IMPORTANT:
 Before running this command, please make sure that organism_tax_id
 already exists in the database's "Organism" table, whose model is
@@ -60,6 +64,11 @@ class Command(BaseCommand):
                             dest='desc_html',
                             default='',
                             help='Model description in HTML format')
+        parser.add_argument('--staged',
+                            action='store_true',
+                            dest='staged',
+                            default=False,
+                            help='Hide the model until it is published')
 
     def handle(self, **options):
         try:
@@ -67,7 +76,8 @@ class Command(BaseCommand):
                          options['organism_tax_id'],
                          options['directed'],
                          options['g2g_edge_cutoff'],
-                         options['desc_html'])
+                         options['desc_html'],
+                         options['staged'])
             self.stdout.write(self.style.NOTICE(
                 "Added a new machine learning model successfully"))
         except Exception as e:
@@ -77,7 +87,7 @@ class Command(BaseCommand):
 
 
 def add_ml_model(ml_model_name, organism_tax_id, directed_edge, edge_cutoff,
-                 desc_html):
+                 desc_html, staged=False):
     # Raise an exception if ml_model_name on the command line is "" or
     # "  ".
     if not ml_model_name or ml_model_name.isspace():
@@ -97,4 +107,5 @@ def add_ml_model(ml_model_name, organism_tax_id, directed_edge, edge_cutoff,
                            organism=organism,
                            directed_g2g_edge=directed_edge,
                            g2g_edge_cutoff=edge_cutoff,
-                           desc_html=desc_html)
+                           desc_html=desc_html,
+                           published=not staged)
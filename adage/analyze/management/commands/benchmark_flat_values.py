@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+This management command benchmarks the list API of ActivityResource on a
+synthetic Activity table.  It compares the rows/second of Tastypie's
+default list implementation (ModelResource.get_list(), which builds a
+model instance and a Bundle and calls full_dehydrate() for every row)
+with the values_list() fast path of FlatValuesResource.  It should be
+invoked like this:
+
+  python manage.py benchmark_flat_values [--rows <num_rows>] \
+ [--signatures <num_signatures>] [--repeat <num_repeats>]
+
+"--rows" is the (approximate) number of synthetic Activity rows, 1000000
+by default.  The rows are split among "--signatures" signatures (600 by
+default, the size of an Ensemble ADAGE model) and as many samples as
+needed.  "--repeat" is the number of times each implementation is run
+(the best time is reported), 1 by default.
+
+All synthetic records (organism, machine learning model, signatures,
+samples and activity) are created inside a transaction that is rolled
+back at the end, so the database is left unchanged.
+"""
+
+from __future__ import print_function
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory
+from organisms.models import Organism
+from tastypie.resources import ModelResource
+from analyze.api import ActivityResource
+from analyze.models import MLModel, Signature, Sample, Activity
+
+BULK_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = ("Benchmark ActivityResource lists on a synthetic Activity table.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000)
+        parser.add_argument('--signatures', type=int, default=600)
+        parser.add_argument('--repeat', type=int, default=1)
+
+    def handle(self, **options):
+        try:
+            results = benchmark_flat_values(options['rows'],
+                                            options['signatures'],
+                                            options['repeat'])
+        except Exception as e:
+            raise CommandError(
+                "Failed to run benchmark: benchmark_flat_values raised an "
+                "exception:\n%s" % e)
+        for name, num_rows, seconds in results:
+            self.stdout.write("%-30s %9d rows in %8.2f s: %12.0f rows/s" % (
+                name, num_rows, seconds, num_rows / seconds))
+
+
+def create_synthetic_activity(num_rows, num_signatures):
+    """
+    Create a machine learning model with num_signatures signatures and
+    enough samples to have about num_rows activity records.  Return the
+    machine learning model.
+    """
+    last_organism = Organism.objects.order_by('-taxonomy_id').first()
+    taxonomy_id = last_organism.taxonomy_id + 1 if last_organism else 1
+    organism = Organism.objects.create(
+        taxonomy_id=taxonomy_id,
+        common_name="benchmark organism %d" % taxonomy_id,
+        scientific_name="benchmark organism %d" % taxonomy_id,
+        slug="benchmark-organism-%d" % taxonomy_id)
+    mlmodel = MLModel.objects.create(
+        title="benchmark model %d" % taxonomy_id, organism=organism)
+
+    Signature.objects.bulk_create([
+        Signature(name="benchmark signature %d" % i, mlmodel=mlmodel)
+        for i in xrange(num_signatures)
+    ])
+    signature_ids = list(Signature.objects.filter(
+        mlmodel=mlmodel).values_list('id', flat=True))
+
+    num_samples = max(1, num_rows // num_signatures)
+    first_sample = Sample.objects.create(name="benchmark sample 0")
+    Sample.objects.bulk_create([
+        Sample(name="benchmark sample %d" % i)
+        for i in xrange(1, num_samples)
+    ])
+    sample_ids = list(Sample.objects.filter(
+        id__gte=first_sample.id,
+        name__startswith="benchmark sample"
+    ).values_list('id', flat=True))
+
+    records = []
+    for i, sample_id in enumerate(sample_ids):
+        for j, signature_id in enumerate(signature_ids):
+            records.append(Activity(sample_id=sample_id,
+                                    signature_id=signature_id,
+                                    value=(i * 0.001 - j * 0.01)))
+            if len(records) == BULK_SIZE:
+                Activity.objects.bulk_create(records)
+                records = []
+    if records:
+        Activity.objects.bulk_create(records)
+    return mlmodel
+
+
+def time_list(get_list, request, repeat):
+    """
+    Call get_list(request) "repeat" times and return the best time in
+    seconds.
+    """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        response = get_list(request)
+        # Make sure the whole response body has been generated.
+        if response.streaming:
+            for chunk in response.streaming_content:
+                pass
+        else:
+            len(response.content)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_flat_values(num_rows, num_signatures, repeat):
+    """
+    Return a list of (implementation name, number of rows, seconds).
+    """
+    if num_rows < 1 or num_signatures < 1 or repeat < 1:
+        raise Exception("rows, signatures and repeat must be positive")
+
+    results = []
+    with transaction.atomic():
+        mlmodel = create_synthetic_activity(num_rows, num_signatures)
+        num_rows = Activity.objects.filter(signature__mlmodel=mlmodel).count()
+        request = RequestFactory().get('/api/v0/activity/',
+                                       data={'mlmodel': mlmodel.id})
+        resource = ActivityResource()
+
+        def tastypie_get_list(request):
+            return ModelResource.get_list(resource, request)
+
+        results.append(("Tastypie full_dehydrate", num_rows,
+                        time_list(tastypie_get_list, request, repeat)))
+        results.append(("FlatValuesResource", num_rows,
+                        time_list(resource.get_list, request, repeat)))
+        # Leave the database unchanged.
+        transaction.set_rollback(True)
+    return results
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+This management command (re)builds the ActivityMatrixStore (see
+analyze/matrix_store.py) and the SampleSimilarityStore (see
+analyze/similarity.py) of one or more machine learning models from the
+"Activity" table in the database.  It should be invoked like this:
+
+  python manage.py build_activity_matrix [<ml_model_name> ...]
+
+If no ml_model_name is given, the stores of all published machine
+learning models in the database will be rebuilt.
+
+The import_activity command rebuilds the stores of its model
+automatically, so this command is only needed when the "Activity" table
+has been modified by other means (or the data cache folder was removed).
+"""
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from analyze.models import MLModel
+from analyze.matrix_store import ActivityMatrixStore
+from analyze.similarity import SampleSimilarityStore
+
+
+class Command(BaseCommand):
+    help = ("Build the dense activity matrix of machine learning models.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('ml_model_names', nargs='*', type=str)
+
+    def handle(self, **options):
+        try:
+            build_activity_matrix(options['ml_model_names'])
+            self.stdout.write(self.style.NOTICE(
+                "Built activity matrices successfully"))
+        except Exception as e:
+            raise CommandError(
+                "Failed to build activity matrices: build_activity_matrix "
+                "raised an exception:\n%s" % e)
+
+
+def build_activity_matrix(ml_model_names):
+    """
+    Build the ActivityMatrixStore and SampleSimilarityStore of every model
+    in ml_model_names, or of all published models if ml_model_names is
+    empty.
+    """
+    if ml_model_names:
+        mlmodels = []
+        for ml_model_name in ml_model_names:
+            try:
+                mlmodels.append(MLModel.objects.get(title=ml_model_name))
+            except MLModel.DoesNotExist:
+                raise Exception("Input ml_model_name %s does not exist in "
+                                "the database" % ml_model_name)
+    else:
+        # Staged models get their stores when they are published.
+        mlmodels = MLModel.objects.filter(published=True)
+
+    for mlmodel in mlmodels:
+        ActivityMatrixStore(mlmodel.id).build()
+        SampleSimilarityStore(mlmodel.id).build()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+This management command (re)builds the ExpressionMatrixStore (see
+analyze/matrix_store.py) of one or more organisms from the
+"ExpressionValue" table in the database.  It should be invoked like this:
+
+  python manage.py build_expression_matrix [<organism_tax_id> ...]
+
+If no organism_tax_id is given, the stores of all organisms in the
+database will be rebuilt.
+
+The import_gene_sample_expr command rebuilds the store of its organism
+automatically, so this command is only needed when the "ExpressionValue"
+table has been modified by other means (or the data cache folder was
+removed).
+"""
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from organisms.models import Organism
+from analyze.matrix_store import ExpressionMatrixStore
+
+
+class Command(BaseCommand):
+    help = ("Build the dense expression matrix of organisms.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('organism_tax_ids', nargs='*', type=int)
+
+    def handle(self, **options):
+        try:
+            build_expression_matrix(options['organism_tax_ids'])
+            self.stdout.write(self.style.NOTICE(
+                "Built expression matrices successfully"))
+        except Exception as e:
+            raise CommandError(
+                "Failed to build expression matrices: "
+                "build_expression_matrix raised an exception:\n%s" % e)
+
+
+def build_expression_matrix(organism_tax_ids):
+    """
+    Build the ExpressionMatrixStore of every organism in organism_tax_ids,
+    or of all organisms if organism_tax_ids is empty.
+    """
+    if organism_tax_ids:
+        organisms = []
+        for tax_id in organism_tax_ids:
+            try:
+                organisms.append(Organism.objects.get(taxonomy_id=tax_id))
+            except Organism.DoesNotExist:
+                raise Exception("Input organism_tax_id %s does not exist in "
+                                "the database" % tax_id)
+    else:
+        organisms = Organism.objects.all()
+
+    for organism in organisms:
+        ExpressionMatrixStore(organism.id).build()
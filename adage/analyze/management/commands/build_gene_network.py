@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+This management command (re)builds the GeneNetworkStore (see
+analyze/matrix_store.py) of one or more machine learning models from the
+"Edge" table in the database.  It should be invoked like this:
+
+  python manage.py build_gene_network [<ml_model_name> ...]
+
+If no ml_model_name is given, the stores of all published machine
+learning models in the database will be rebuilt.
+
+The import_gene_network command rebuilds the store of its model
+automatically, so this command is only needed when the "Edge" table has
+been modified by other means (or the data cache folder was removed).
+"""
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from analyze.models import MLModel
+from analyze.matrix_store import GeneNetworkStore
+
+
+class Command(BaseCommand):
+    help = ("Build the gene-gene network of machine learning models.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('ml_model_names', nargs='*', type=str)
+
+    def handle(self, **options):
+        try:
+            build_gene_network(options['ml_model_names'])
+            self.stdout.write(self.style.NOTICE(
+                "Built gene-gene networks successfully"))
+        except Exception as e:
+            raise CommandError(
+                "Failed to build gene-gene networks: build_gene_network "
+                "raised an exception:\n%s" % e)
+
+
+def build_gene_network(ml_model_names):
+    """
+    Build the GeneNetworkStore of every model in ml_model_names, or of
+    all published models if ml_model_names is empty.
+    """
+    if ml_model_names:
+        mlmodels = []
+        for ml_model_name in ml_model_names:
+            try:
+                mlmodels.append(MLModel.objects.get(title=ml_model_name))
+            except MLModel.DoesNotExist:
+                raise Exception("Input ml_model_name %s does not exist in "
+                                "the database" % ml_model_name)
+    else:
+        # Staged models get their stores when they are published.
+        mlmodels = MLModel.objects.filter(published=True)
+
+    for mlmodel in mlmodels:
+        GeneNetworkStore(mlmodel.id).build()
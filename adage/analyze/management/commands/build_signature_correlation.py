@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+This management command (re)builds the SignatureCorrelationStore (see
+analyze/similarity.py) of one or more machine learning models: the
+Pearson and Spearman correlations of the activity of every pair of
+signatures across samples, and the Jaccard index of their participating
+genes.  It should be invoked like this:
+
+  python manage.py build_signature_correlation [<ml_model_name> ...]
+
+If no ml_model_name is given, the stores of all published machine
+learning models in the database will be rebuilt.
+
+The import_activity and import_signature_gene_network commands rebuild
+the store of their model automatically, so this command is only needed
+when the "Activity" or "Participation" table has been modified by other
+means (or the data cache folder was removed).
+"""
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from analyze.models import MLModel
+from analyze.similarity import SignatureCorrelationStore
+
+
+class Command(BaseCommand):
+    help = ("Build the signature correlation matrices of machine learning "
+            "models.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('ml_model_names', nargs='*', type=str)
+
+    def handle(self, **options):
+        try:
+            build_signature_correlation(options['ml_model_names'])
+            self.stdout.write(self.style.NOTICE(
+                "Built signature correlation matrices successfully"))
+        except Exception as e:
+            raise CommandError(
+                "Failed to build signature correlation matrices: "
+                "build_signature_correlation raised an exception:\n%s" % e)
+
+
+def build_signature_correlation(ml_model_names):
+    """
+    Build the SignatureCorrelationStore of every model in ml_model_names,
+    or of all published models if ml_model_names is empty.
+    """
+    if ml_model_names:
+        mlmodels = []
+        for ml_model_name in ml_model_names:
+            try:
+                mlmodels.append(MLModel.objects.get(title=ml_model_name))
+            except MLModel.DoesNotExist:
+                raise Exception("Input ml_model_name %s does not exist in "
+                                "the database" % ml_model_name)
+    else:
+        # Staged models get their stores when they are published.
+        mlmodels = MLModel.objects.filter(published=True)
+
+    for mlmodel in mlmodels:
+        SignatureCorrelationStore(mlmodel.id).build()
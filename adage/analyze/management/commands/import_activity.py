@@ -4,13 +4,32 @@
 Load activity spreadsheet (generated by Jie) into the database.
 This module should be invoked as a management command:
 
-  python manage.py import_activity <activity_filename> <ml_model_name>
+  python manage.py import_activity <activity_filename> <ml_model_name> \
+[--update [--tolerance <tolerance>]]
 
 The two required arguments of this commands are:
   (1) activity_filename: a tab-delimited activity spreadsheet;
   (2) ml_model_name: machine learning model's name that corresponds to
       activity_filename;
 
+The input file may be compressed with gzip, bzip2 or xz, or "-" to read
+standard input (see _input.py).
+
+Signature names and data sources are resolved into database IDs once
+(with one query each) before the data lines are read, and activity
+records are streamed into the database by a BulkLoader (see
+_bulk_loader.py).  When the import succeeds, the number of imported
+records and the import rate are reported, and the ActivityMatrixStore of
+ml_model_name (see analyze/matrix_store.py), its SampleSimilarityStore
+and its SignatureCorrelationStore (see analyze/similarity.py) are rebuilt
+from the database (unless the model is staged, see "publish_ml_model").
+
+With "--update", the model's existing activity is updated to match the
+input file instead: new signatures are created, and only new activity
+records, records whose value changed by more than "--tolerance" (0 by
+default) and records of samples or signatures that are no longer in the
+file are written (see DiffLoader in _bulk_loader.py).
+
 IMPORTANT:
 Before running this command, please make sure that ml_model_name already
 exists in the database.  If it doesn't, you can use the management
@@ -18,40 +37,66 @@ command "add_ml_model.py" to add it into the database.
 """
 
 from __future__ import print_function
-from django.core.management.base import BaseCommand, CommandError
+import time
+from django.core.management.base import CommandError
 from django.db import transaction
 from analyze.models import Sample, MLModel, Signature, Activity
+from analyze.matrix_store import ActivityMatrixStore
+from analyze.similarity import (
+    SampleSimilarityStore, SignatureCorrelationStore)
+from _input import input_file
+from _instrumentation import (InstrumentedCommand, phase, phase_seconds,
+                              lines)
+from _bulk_loader import BulkLoader, DiffLoader
 
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = ("Import activity data from an input  spreadsheet.")
 
     def add_arguments(self, parser):
-        parser.add_argument('activity_file', type=file)
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('activity_file', type=input_file)
         parser.add_argument('ml_model_name', type=str)
+        parser.add_argument('--update', action='store_true')
+        parser.add_argument('--tolerance', type=float, default=0.0)
 
     def handle(self, **options):
         try:
-            import_activity(options['activity_file'],
-                            options['ml_model_name'])
+            start = time.time()
+            loader = import_activity(options['activity_file'],
+                                     options['ml_model_name'],
+                                     options['update'], options['tolerance'])
+            # The rate leaves out the time spent rebuilding the stores.
+            elapsed = time.time() - start - phase_seconds('rebuild')
+            num_records = loader.count
             self.stdout.write(self.style.NOTICE(
-                "Imported activity data successfully"))
+                "Imported activity data successfully: %d records in %.1f "
+                "seconds (%.0f records/s)" % (
+                    num_records, elapsed, num_records / max(elapsed, 1e-6))))
+            if options['update']:
+                self.stdout.write(self.style.NOTICE(
+                    "%d records inserted, %d updated and %d deleted" % (
+                        loader.inserted, loader.updated, loader.deleted)))
         except Exception as e:
             raise CommandError(
                 "Failed to import activity data: import_activity raised "
                 "an exception:\n%s" % e)
 
 
-def import_activity(file_handle, ml_model_name):
+def import_activity(file_handle, ml_model_name, update=False, tolerance=0.0):
     """
     Read the data in activity sheet into the database.
     This function first checks whether ml_model_name exists in the
     database, then call import_signatures() and import_activity_line()
     to populate "Signature" and "Activity" tables in the database.
+    If "update" is True, the existing activity of ml_model_name is
+    updated to match the file with a DiffLoader.
+    Return the BulkLoader (or DiffLoader) of the activity records, whose
+    "count" is the number of records that were written.
     """
 
     # Raise an exception if ml_model_name doesn't exist in the database.
@@ -61,24 +106,52 @@ def import_activity(file_handle, ml_model_name):
         raise Exception("Input ml_model_name %s does not exist in the database"
                         % ml_model_name)
 
+    # Map every known data source to its sample ID with a single query,
+    # so that data lines do not need any query.
+    with phase('validate'):
+        sample_ids = dict(Sample.objects.filter(
+            ml_data_source__isnull=False).values_list('ml_data_source', 'id'))
+
     # Enclose reading/importing process in a transaction context
     # manager.  Any exception raised inside the manager will
     # terminate the transaction and roll back the database.
+    fields = ('sample_id', 'signature_id', 'value')
     with transaction.atomic():
-        signatures = []
-        for line_index, line in enumerate(file_handle):
+        if update:
+            loader = DiffLoader(Activity.objects.filter(
+                signature__mlmodel=mlmodel), fields, tolerance)
+        else:
+            loader = BulkLoader(Activity, fields)
+        signature_ids = []
+        for line_index, line in enumerate(lines(file_handle)):
             tokens = line.rstrip('\r\n').split('\t')
             if line_index == 0:
-                signatures = tokens[1:]
-                import_signatures(signatures, mlmodel)
+                with phase('validate'):
+                    signature_ids = import_signatures(tokens[1:], mlmodel,
+                                                      update)
             else:
-                import_activity_line(line_index + 1, signatures, tokens,
-                                     mlmodel)
-
-
-def import_signatures(signatures, mlmodel):
+                line_num = line_index + 1
+                loader.extend(import_activity_line(
+                    line_num, signature_ids, tokens, sample_ids), line_num)
+        loader.flush()
+
+    # Rebuild the model's dense activity matrix, similarity index and
+    # signature correlations from the new data (staged models get theirs
+    # when they are published).
+    if mlmodel.published:
+        with phase('rebuild'):
+            ActivityMatrixStore(mlmodel.id).refresh()
+            SampleSimilarityStore(mlmodel.id).refresh()
+            SignatureCorrelationStore(mlmodel.id).refresh()
+    return loader
+
+
+def import_signatures(signatures, mlmodel, update=False):
     """
-    Load input signatures into "Signature" table in the database.
+    Load input signatures into "Signature" table in the database, and
+    return the list of their IDs (in the same order as "signatures").
+    If "update" is True, signatures that already exist are reused instead
+    of being rejected.
 
     This function will raise an exception if any of the following errors
     are detected:
@@ -87,27 +160,41 @@ def import_signatures(signatures, mlmodel):
       * The combination of Signature name and given ml_model_name is not
         unique.
     """
+    existing_names = set(Signature.objects.filter(
+        mlmodel=mlmodel).values_list('name', flat=True))
     signature_set = set()
     for index, name in enumerate(signatures):
         if not name or name.isspace():
             raise Exception(
                 "Input file line #1 column #%d: blank signature name" %
-                index + 2)
+                (index + 2))
         elif name in signature_set:
             raise Exception("Input file line #1 column #%d: %s is NOT unique" %
                             (index + 2, name))
-        elif Signature.objects.filter(name=name, mlmodel=mlmodel).exists():
+        elif name in existing_names and not update:
             raise Exception("Input file line #1 column #%d: Signature name %s "
                             "already exists in Signature table"
                             % (index + 2, name))
         else:
             signature_set.add(name)
-            Signature.objects.create(name=name, mlmodel=mlmodel)
+    Signature.objects.bulk_create(
+        [Signature(name=name, mlmodel=mlmodel) for name in signatures
+         if name not in existing_names])
+
+    # bulk_create() does not set the IDs of new records on every database,
+    # so read them back.
+    signature_ids = dict(Signature.objects.filter(
+        mlmodel=mlmodel).values_list('name', 'id'))
+    return [signature_ids[name] for name in signatures]
 
 
-def import_activity_line(line_num, signatures, tokens, mlmodel):
+def import_activity_line(line_num, signature_ids, tokens, sample_ids):
     """
-    Load numerical values in input tokens into "Activity" table.
+    Convert numerical values in input tokens into a list of
+    (sample_id, signature_id, value) tuples of "Activity" records (which
+    are loaded in bulk by import_activity()).
+    "signature_ids" are the IDs of the signatures in column #2 to the end,
+    and "sample_ids" maps each data source to its sample ID.
 
     This function will raise an exception if any of the following errors
     are detected on the data line:
@@ -117,42 +204,34 @@ def import_activity_line(line_num, signatures, tokens, mlmodel):
       * Any field from column #2 to the end can not be converted into a
         float type.
     """
-    if len(tokens) != len(signatures) + 1:
+    if len(tokens) != len(signature_ids) + 1:
         raise Exception("Input file line #%d: Number of columns is not %d" %
-                        (line_num, len(signatures) + 1))
+                        (line_num, len(signature_ids) + 1))
 
     data_source = tokens[0]
     if not data_source or data_source.isspace():
         raise Exception("Input file line #%d: column #1 (data_source) is blank"
                         % line_num)
 
-    try:
-        sample = Sample.objects.get(ml_data_source=data_source)
-    except Sample.DoesNotExist:
+    sample_id = sample_ids.get(data_source)
+    if sample_id is None:
         # If data_source on the line is not found in Sample table, then
         # instead of raising an exception, generate a warning message
         # and skip this activity data line.
         logger.warn(
             "Input file line #%d: data_source in column #1 is not found in "
             "the database: %s", line_num, data_source)
-        return
+        return []
 
-    values = tokens[1:]
-    # In order to speed up the import, all activity records on the same
-    # line will be saved in "records" and created in bulk at the end.
     records = []
     col_num = 2   # The numerical values start from column #2.
-    for signature_name, value in zip(signatures, values):
+    for signature_id, value in zip(signature_ids, tokens[1:]):
         try:
             float_val = float(value)
         except ValueError:
             raise Exception("Input file line #%d column #%d: %s can not be "
                             "converted into a float type" %
                             (line_num, col_num, value))
-
-        signature = Signature.objects.get(name=signature_name, mlmodel=mlmodel)
-        records.append(
-            Activity(sample=sample, signature=signature, value=float_val)
-        )
+        records.append((sample_id, signature_id, float_val))
         col_num += 1
-    Activity.objects.bulk_create(records)  # Create records in bulk.
+    return records
@@ -6,11 +6,13 @@ from __future__ import print_function
 import argparse
 import sys
 import os
+from collections import OrderedDict
 from operator import itemgetter
 
 # Django imports
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.conf import settings
+from django.db import transaction
 
 # Unclear if there's any way to keep Flake8 happy and setup loggers.
 import logging
@@ -19,6 +21,9 @@ logger.addHandler(logging.NullHandler())
 
 # import Django environment
 from analyze.models import Experiment, Sample, SampleAnnotation, AnnotationType
+from analyze.data_version import bump_data_version, ANNOTATIONS
+from _bulk_loader import BulkLoader
+from _instrumentation import InstrumentedCommand, phase, lines
 
 # import ADAGE utilities
 # we've stashed a copy of get_pseudo_sdrf here for deployment (see fabfile.py)
@@ -35,11 +40,12 @@ import gen_spreadsheets as gs
 JSON_CACHE_FILE_NAME = 'json_cache.p'
 
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = 'Imports data to initialize the database with Experiment, Sample '\
             'and SampleAnnotation records.'
 
     def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
         parser.add_argument('annotation_file', type=argparse.FileType('r'))
 
     def handle(self, **options):
@@ -53,6 +59,187 @@ class Command(BaseCommand):
                     "threw an exception:\n%s" % e)
 
 
+def collect_samples(rows):
+    """
+    Walk through the annotation spreadsheet `rows` and collect every sample
+    in memory, linking it to one or more experiment(s) and merging the
+    annotations of all of its rows with merge_annotations().
+
+    Return a tuple of (samples, mismatches): `samples` is an OrderedDict
+    of {(name, ml_data_source): (experiment accessions, annotations)}, where
+    `annotations` is a dict of {typename: text}, and `mismatches` is a dict
+    of lists of conflicting typenames indexed by
+    (sample, experiment, existing_experiment).
+    """
+    samples = OrderedDict()
+    mismatches = {}
+    for r in lines(rows):
+        ml_data_source = r.cel_file
+        if ml_data_source == '':
+            ml_data_source = None
+        annotations = dict((k, v)
+            for k, v in r._asdict().items() if k not in \
+                ('accession', 'sample', 'cel_file', 'expt_summary'))
+        key = (r.sample, ml_data_source)
+        if key not in samples:
+            # a new sample so we need new annotations for it
+            samples[key] = ([r.accession],
+                            dict((k, v) for k, v in annotations.iteritems()
+                                 if v))
+            continue
+        # sample was already present, so check if our annotations match
+        accessions, existing_annotation_dict = samples[key]
+        existing_experiments = [a for a in accessions if a != r.accession]
+        if r.accession not in accessions:
+            accessions.append(r.accession)
+        mismatched = merge_annotations(existing_annotation_dict, annotations)
+        if mismatched:
+            # We organize our lists of mismatched fields by `sample` and the
+            # pair of experiments with conflicting annotations so we can
+            # report them at the end.  Build the err_key as:
+            # (sample, experiment, existing_experiment)
+            err_key = (r.sample, r.accession,
+                       (existing_experiments or [r.accession])[0])
+            mismatches.setdefault(err_key, []).extend(mismatched)
+    return samples, mismatches
+
+
+def merge_annotations(existing_annotation_dict, annotations):
+    """
+    Merge the annotations of another spreadsheet row of a sample into
+    `existing_annotation_dict` (both are dicts of {typename: text}), and
+    return a list of typenames whose values conflict.
+    """
+    mismatched = []
+    for k, v in annotations.iteritems():
+        if not v:
+            # there is nothing to do if our value is blank
+            continue
+        existing = existing_annotation_dict.get(k, "")
+        if existing == v:
+            continue
+        # In this section, we automatically handle several minor data
+        # inconsistencies in the manually-generated annotation spreadsheet
+        # and report the rest for follow-up
+        if existing == "":
+            # data trump emptiness: update the existing annotation
+            existing_annotation_dict[k] = v
+        elif existing.lower() == v.lower():
+            # don't care about minor differences in case
+            continue
+        elif existing.lower().startswith(v.lower()):
+            # nothing new to add (new annotation is a subset of what's
+            # there already)
+            continue
+        elif v.lower().startswith(existing.lower()):
+            # let's take the longer explanation (new annotation is a strict
+            # superset of what was provided already)
+            existing_annotation_dict[k] = v
+        else:
+            mismatched.append(k)
+    return mismatched
+
+
+def load_sample_ids():
+    """
+    Return a dict of {(name, ml_data_source): sample ID} of all samples in
+    the database.
+    """
+    return dict(((name, ml_data_source), sample_id)
+                for sample_id, name, ml_data_source in
+                Sample.objects.values_list('id', 'name', 'ml_data_source'))
+
+
+def write_bootstrap_data(experiments, samples):
+    """
+    Write `experiments` (a list of unsaved Experiment instances) and the
+    `samples` collected by collect_samples() into the database, with one
+    bulk insert for each of the Experiment, Sample, Experiment-Sample link
+    and SampleAnnotation tables.  Annotation types are looked up in a dict
+    and only missing ones are created.
+
+    Samples that are already in the database (with the same name and
+    ml_data_source) are reused: their annotations are merged with the
+    collected ones by merge_annotations(), as bootstrap_database does for
+    the rows of a sample, and only the annotations that change are
+    written.  Return the mismatches found while merging them, indexed by
+    (sample, experiment, existing_experiment) like those of
+    collect_samples().
+    """
+    Experiment.objects.bulk_create(experiments)
+    sample_ids = load_sample_ids()
+    existing_ids = dict((key, sample_ids[key]) for key in samples
+                        if key in sample_ids)
+    new_samples = [key for key in samples if key not in sample_ids]
+    if new_samples:
+        Sample.objects.bulk_create([
+            Sample(name=name, ml_data_source=ml_data_source)
+            for name, ml_data_source in new_samples])
+        # bulk_create() does not set primary keys, so read them back.
+        sample_ids = load_sample_ids()
+    type_ids = dict(AnnotationType.objects.values_list('typename', 'id'))
+
+    # The annotations and experiments of the samples that already exist.
+    existing_annotations = {}
+    existing_experiments = {}
+    if existing_ids:
+        for sample_id, typename, text, annotation_id in \
+                SampleAnnotation.objects.filter(
+                    sample__in=existing_ids.values()).values_list(
+                        'sample_id', 'annotation_type__typename', 'text',
+                        'id'):
+            existing_annotations.setdefault(sample_id, {})[typename] = (
+                text, annotation_id)
+        for sample_id, accession in Sample.experiments.through.objects.filter(
+                sample__in=existing_ids.values()).order_by('id').values_list(
+                    'sample_id', 'experiment_id'):
+            existing_experiments.setdefault(sample_id, []).append(accession)
+
+    links = BulkLoader(Sample.experiments.through,
+                       ('experiment_id', 'sample_id'))
+    annotations = BulkLoader(SampleAnnotation,
+                             ('annotation_type_id', 'sample_id', 'text'))
+    mismatches = {}
+    for key, (accessions, annotation_dict) in samples.iteritems():
+        sample_id = sample_ids[key]
+        linked = existing_experiments.get(sample_id, [])
+        links.extend((accession, sample_id) for accession in accessions
+                     if accession not in linked)
+        if key in existing_ids:
+            stored = existing_annotations.get(sample_id, {})
+            merged = dict((typename, text) for typename, (text, annotation_id)
+                          in stored.iteritems())
+            mismatched = merge_annotations(merged, annotation_dict)
+            if mismatched:
+                err_key = (key[0], accessions[0], (linked or accessions)[0])
+                mismatches.setdefault(err_key, []).extend(mismatched)
+            # Only the annotations that were added or changed are written.
+            annotation_dict = {}
+            for typename, text in merged.iteritems():
+                if typename not in stored:
+                    annotation_dict[typename] = text
+                elif text != stored[typename][0]:
+                    SampleAnnotation.objects.filter(
+                        id=stored[typename][1]).update(text=text)
+        add_annotations(annotations, type_ids, sample_id, annotation_dict)
+    links.flush()
+    annotations.flush()
+    return mismatches
+
+
+def add_annotations(loader, type_ids, sample_id, annotation_dict):
+    """
+    Add the annotations in `annotation_dict` ({typename: text}) of a
+    sample to the BulkLoader `loader`, creating the annotation types that
+    are not in `type_ids` ({typename: ID}) yet.
+    """
+    for typename, text in annotation_dict.iteritems():
+        if typename not in type_ids:
+            type_ids[typename] = AnnotationType.objects.create(
+                typename=typename).id
+        loader.add((type_ids[typename], sample_id, text))
+
+
 def bootstrap_database(annotation_fh, dir_name=None):
     """
     Import initial experiment, sample and annotation data to initialize the
@@ -72,6 +259,12 @@ def bootstrap_database(annotation_fh, dir_name=None):
     addition, a cache containing a record of the JSON data retrieved from
     ArrayExpress will be saved here.
 
+    Experiments, samples, their links and annotations are collected in memory
+    (see collect_samples()) and written with one bulk insert per table (see
+    write_bootstrap_data()) inside a transaction.  Samples that are already
+    in the database are reused, and their annotations are reconciled with
+    the same rules.
+
     This function will raise errors if it is unable to complete successfully,
     and it will exit with no error if it succeeds in initializing the database.
     """
@@ -85,9 +278,10 @@ def bootstrap_database(annotation_fh, dir_name=None):
     # Experiment in the database for each matching experiment found in the
     # annotation spreadsheet. Raise an error if any annotated experiment
     # cannot be found in the data retrieved from ArrayExpress.
-    ae_retriever = gp.AERetriever(ae_url=gp._AEURL_EXPERIMENTS,
-        cache_file_name=os.path.join(dir_name, JSON_CACHE_FILE_NAME))
-    ae_experiments = ae_retriever.ae_json_to_experiment_text()
+    with phase('download'):
+        ae_retriever = gp.AERetriever(ae_url=gp._AEURL_EXPERIMENTS,
+            cache_file_name=os.path.join(dir_name, JSON_CACHE_FILE_NAME))
+        ae_experiments = ae_retriever.ae_json_to_experiment_text()
     annotated_experiments = ss.get_experiment_ids()
     # we can fail fast by checking for missing experiments before we start
     missing_experiments = frozenset(annotated_experiments) - \
@@ -98,90 +292,17 @@ def bootstrap_database(annotation_fh, dir_name=None):
                         ', '.join(missing_experiments)
                 )
         ))
-    # nothing missing, so proceed with importing!
-    for e in ae_experiments:
-        if e['accession'] in annotated_experiments:
-            Experiment.objects.create(**e)
-
-    # now that we have database records for every Experiment, we walk through
-    # the annotation spreadsheet and create records for Samples, linking each
-    # to one or more Experiment(s) and creating a set of SampleAnnotations for
-    # each as we go.
-    mismatches = {}  # mismatches indexed by sample and experiment ids
-    for r in ss.rows():
-        row_experiment = Experiment.objects.get(pk=r.accession)
-        ml_data_source = r.cel_file
-        if ml_data_source == '':
-            ml_data_source = None
-        row_sample, created = Sample.objects.get_or_create(
-                name=r.sample, ml_data_source=ml_data_source)
-        row_experiment.sample_set.add(row_sample)
-        annotations = dict((k, v)
-            for k, v in r._asdict().items() if k not in \
-                ('accession', 'sample', 'cel_file', 'expt_summary'))
-        if created:
-            # a new sample was created so we need new annotations for it
-            SampleAnnotation.objects.create_from_dict(row_sample, annotations)
-        else:
-            # sample was already present, so check if our annotations match
-            existing_annotation_dict = SampleAnnotation.objects.get_as_dict(
-                    sample=row_sample)
-            for k, v in annotations.iteritems():
-                if not v:
-                    # there is nothing to do if our value is blank
-                    continue
-                if k not in existing_annotation_dict:
-                    # add a blank value to existing_annotation_dict to signal
-                    # that this annotation needs to be added
-                    existing_annotation_dict[k] = ""
-                if existing_annotation_dict[k] != v:
-                    # In this section, we automatically handle several minor
-                    # data inconsistencies in the manually-generated annotation
-                    # spreadsheet and report the rest for follow-up
-                    if existing_annotation_dict[k] == "" and v != "":
-                        # data trump emptiness: update the existing annotation
-                        k_type, _ = AnnotationType.objects.get_or_create(
-                                typename=k)
-                        existing_annotation, _ = \
-                                SampleAnnotation.objects.get_or_create(
-                                    annotation_type=k_type, sample=row_sample)
-                        existing_annotation.text = v
-                        existing_annotation.save()
-                        continue
-                    elif existing_annotation_dict[k] != "" and v == "":
-                        # all okay here: nothing new to add.
-                        continue
-                    elif existing_annotation_dict[k].lower() == v.lower():
-                        # don't care about minor differences in case
-                        continue
-                    elif existing_annotation_dict[k].lower().startswith(
-                            v.lower()):
-                        # nothing new to add (new annotation is a subset of
-                        # what's there already)
-                        continue
-                    elif v.lower().startswith(
-                            existing_annotation_dict[k].lower()):
-                        # let's take the longer explanation (new annotation is
-                        # a strict superset of what was provided already)
-                        k_type = AnnotationType.objects.get(typename=k)
-                        existing_annotation = SampleAnnotation.objects.get(
-                                annotation_type=k_type, sample=row_sample)
-                        existing_annotation.text = v
-                        existing_annotation.save()
-                        continue
-                    # We organize our lists of mismatched fields by `sample`
-                    # and the pair of experiments with conflicting annotations
-                    # so we can report them at the end.  Build the err_key as:
-                    # (sample, experiment, existing_experiment)
-                    existing_experiment = row_sample.\
-                            experiments.exclude(accession=r.accession)[0]
-                    err_key = (
-                        r.sample,
-                        r.accession,
-                        existing_experiment.accession
-                    )
-                    if err_key not in mismatches: mismatches[err_key] = []
-                    mismatches[err_key].append(k)
+    # nothing missing, so proceed with importing! Everything is collected
+    # in memory first and then written with one bulk insert per table.
+    experiments = [Experiment(**e) for e in ae_experiments
+                   if e['accession'] in annotated_experiments]
+    samples, mismatches = collect_samples(ss.rows())
+    with transaction.atomic():
+        existing_mismatches = write_bootstrap_data(experiments, samples)
+    for err_key, mismatched in existing_mismatches.iteritems():
+        mismatches.setdefault(err_key, []).extend(mismatched)
+    # invalidate cached annotation files (see SampleResource.get_annotations)
+    bump_data_version(ANNOTATIONS)
     if mismatches:
         # sort err_keys to match original spreadsheet order
         sorted_err_keys = sorted(mismatches.keys(), key=itemgetter(2, 0))
@@ -21,6 +21,19 @@ For example, to import the data lines in an input file "eADAGE.txt" whose
 machine leaning model is "Ensemble ADAGE 300", we will type:
   python manage.py import_gene_network /path/of/eADAGE.txt "Ensemble ADAGE 300"
 
+The input file may be compressed with gzip, bzip2 or xz (such as the
+example file above), or "-" to read standard input (see _input.py).
+
+Genes are looked up in a map of the systematic names of the model's
+organism, and edges that the model already has are looked up in a sorted
+NumPy array of gene ID pairs, both of which are read once, so checking a
+line does not need any query.
+
+After a successful import, the GeneNetworkStore of the model (see
+analyze/matrix_store.py), which EdgeResource uses to find gene
+neighborhoods, is rebuilt, unless the model is staged (it will be built
+by the "publish_ml_model" command).
+
 IMPORTANT:
 Before running this command, please make sure that ml_model_name already
 exists in the database.  If it doesn't, you can use the management
@@ -28,24 +41,29 @@ command "add_ml_model.py" to add it into the database.
 """
 
 from __future__ import print_function
-from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+from django.core.management.base import CommandError
 from django.db import transaction
-from genes.models import Gene
 from analyze.models import MLModel, Edge
+from analyze.matrix_store import GeneNetworkStore
+from _input import input_file
+from _genes import load_gene_ids
+from _instrumentation import InstrumentedCommand, phase, lines
+from _bulk_loader import BulkLoader
 
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 NUM_COLUMNS = 4
-BULK_SIZE = 2000
 
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = ("Imports gene-gene network data into Edge table in the database.")
 
     def add_arguments(self, parser):
-        parser.add_argument('gene_network_file', type=file)
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('gene_network_file', type=input_file)
         parser.add_argument('ml_model_name', type=str)
 
     def handle(self, **options):
@@ -78,22 +96,28 @@ def import_network(file_handle, ml_model_name):
         raise Exception("%s does NOT exist in the database" % ml_model_name)
 
     # Enclose reading/importing process in a transaction.
-    with transaction.atomic():
-        check_and_import(file_handle, ml_model)
-
-
-def check_and_import(file_handle, ml_model):
-    """Read valid data lines into the database.  An exception will be raised
-    if any errors are detected in file_handle.
+    with transaction.atomic(), BulkLoader(
+            Edge, ('mlmodel_id', 'gene1_id', 'gene2_id', 'weight')) as loader:
+        check_and_import(file_handle, ml_model, loader)
+    if ml_model.published:
+        with phase('rebuild'):
+            GeneNetworkStore(ml_model.id).refresh()
+
+
+def check_and_import(file_handle, ml_model, loader):
+    """Read valid data lines into the database through the BulkLoader
+    "loader" (see _bulk_loader.py).  An exception will be raised if any
+    errors are detected in file_handle.
     """
     # If the database already includes record(s) of the same ml_model,
     # check the "unique_together" constraint; Otherwise do not check.
-    check_unique = Edge.objects.filter(mlmodel=ml_model).exists()
+    with phase('validate'):
+        existing_pairs = load_existing_pairs(ml_model)
+        gene_ids = load_gene_ids(ml_model.organism_id)
+    check_unique = len(existing_pairs) > 0
 
     gene_pairs_in_file = set()
-    cached_genes = dict()
-    records = []
-    for line_index, line in enumerate(file_handle):
+    for line_index, line in enumerate(lines(file_handle)):
         # Skip the first line, which includes column names only.
         if line_index == 0:
             continue
@@ -154,7 +178,7 @@ def check_and_import(file_handle, ml_model):
         # If tokens[0] does not match one and only one gene's
         # systematic_name in the database, skip the line.
         try:
-            gene1 = find_gene(tokens[0], cached_genes)
+            gene1 = find_gene(tokens[0], gene_ids)
         except Exception as e:
             logger.warning("Input file line #%d will be skipped: %s",
                            line_index + 1, e)
@@ -163,14 +187,15 @@ def check_and_import(file_handle, ml_model):
         # If tokens[1] does not match one and only one gene's
         # systematic_name in the database, skip the line.
         try:
-            gene2 = find_gene(tokens[1], cached_genes)
+            gene2 = find_gene(tokens[1], gene_ids)
         except Exception as e:
             logger.warning("Input file line #%d will be skipped: %s",
                            line_index + 1, e)
             continue
 
         # Check whether the triplet (ml_model, gene1, gene2) is unique.
-        if check_unique and not unique_together(ml_model, gene1, gene2):
+        if check_unique and not unique_together(ml_model, gene1, gene2,
+                                                existing_pairs):
             raise Exception("Input file line #%d: (%s, %s, %s) is not unique "
                             "in the database" % (line_index + 1,
                                                  tokens[0],
@@ -178,58 +203,62 @@ def check_and_import(file_handle, ml_model):
                                                  ml_model.title))
 
         # Save the valid data into batch.
-        records.append(
-            Edge(mlmodel=ml_model, gene1=gene1, gene2=gene2, weight=weight)
-        )
-        if len(records) == BULK_SIZE:  # dump bulk records into database
-            Edge.objects.bulk_create(records)
-            records = []
-    # Don't forget the last bulk:
-    if len(records) > 0:
-        Edge.objects.bulk_create(records)
-        records = []
-
-
-def find_gene(systematic_name, cached_genes):
+        loader.add((ml_model.id, gene1, gene2, weight))
+
+
+def find_gene(systematic_name, gene_ids):
     """
-    Return the gene in database whose systematic_name matches input
-    "systematic_name".  An exception will be raised if no gene is found
-    or multiple genes exist in the database.
+    Return the ID of the gene whose systematic_name matches input
+    "systematic_name" (see _genes.load_gene_ids()).  An exception will be
+    raised if no gene is found or multiple genes exist in the database.
     """
-    if systematic_name in cached_genes:
-        return cached_genes[systematic_name]
-
-    try:
-        gene = Gene.objects.get(systematic_name=systematic_name)
-    except Gene.DoesNotExist:
+    if systematic_name not in gene_ids:
         raise Exception("gene name %s does not exist in the database"
                         % systematic_name)
-    except Gene.MultipleObjectsReturned:
+    gene_id = gene_ids[systematic_name]
+    if gene_id is None:
         raise Exception("gene name %s matches multiple genes in the database"
                         % systematic_name)
+    return gene_id
+
 
-    cached_genes[systematic_name] = gene
-    return gene
+def pair_key(gene1, gene2):
+    """Encode a pair of gene IDs as one 64-bit integer."""
+    return (gene1 << 32) | gene2
 
 
-def unique_together(ml_model, gene1, gene2):
+def load_existing_pairs(ml_model):
+    """
+    Return the keys (see pair_key()) of the (gene1, gene2) pairs of all
+    edges of ml_model as a sorted NumPy array, which takes 8 bytes per
+    edge.
+    """
+    pairs = np.fromiter(
+        (pair_key(gene1, gene2) for gene1, gene2 in Edge.objects.filter(
+            mlmodel=ml_model).values_list('gene1_id', 'gene2_id').iterator()),
+        dtype=np.int64)
+    pairs.sort()
+    return pairs
+
+
+def pair_exists(existing_pairs, gene1, gene2):
+    key = pair_key(gene1, gene2)
+    index = np.searchsorted(existing_pairs, key)
+    return index < len(existing_pairs) and existing_pairs[index] == key
+
+
+def unique_together(ml_model, gene1, gene2, existing_pairs):
     """
     Check whether the triplet of (ml_model, gene1, gene2) already exists
-    in the database.  If ml_model has directed gene-gene relationship
-    edge, check the triplet of (ml_model, gene2, gene1) too.
+    in the database, i.e. whether (gene1, gene2) is in "existing_pairs"
+    (see load_existing_pairs()).  If ml_model has undirected gene-gene
+    relationship edges, check (gene2, gene1) too.
     Although this "unique together" constraint has been enforced at
     database level, it is still checked explicitly here so that the
     invalid line's number in input file will be reported.
     """
-    try:
-        Edge.objects.get(mlmodel=ml_model, gene1=gene1, gene2=gene2)
-        return False
-    except Edge.DoesNotExist:
-        if ml_model.directed_g2g_edge:  # Check is done if edges are directed.
-            return True
-
-    try:
-        Edge.objects.get(mlmodel=ml_model, gene1=gene2, gene2=gene1)
+    if pair_exists(existing_pairs, gene1, gene2):
         return False
-    except Edge.DoesNotExist:
+    if ml_model.directed_g2g_edge:  # Check is done if edges are directed.
         return True
+    return not pair_exists(existing_pairs, gene2, gene1)
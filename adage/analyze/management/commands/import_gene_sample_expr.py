@@ -5,7 +5,8 @@ This management command reads an input file of gene-sample expression values
 and loads the valid data into the database.  It should be invoked like this:
 
   python manage.py import_gene_sample_expr <expression_filename> \
-<organism_tax_id>
+<organism_tax_id> [--workers <num_workers>] \
+[--update [--tolerance <tolerance>]]
 
 The two required arguments are:
   (1) expression_filename: input file of gene-sample expression values;
@@ -15,6 +16,22 @@ For example, to load the sample-gene expression values for the organism
 "Pseudomonas aeruginosa" (whose taxonomy ID is 208964), the command will be:
   python manage.py import_gene_sample_expr input_filename 208964
 
+The optional "--workers" argument (1 by default) is the number of worker
+processes that parse the data lines.  With more than one worker, the
+file is split into byte ranges that are parsed in parallel (each range's
+values are converted by NumPy at once), while this process writes the
+parsed records into the database in a single transaction, in the same
+order as the file.  Parallel parsing requires a regular file.
+
+The input file may be compressed with gzip, bzip2 or xz, or "-" to read
+standard input (see _input.py); such input is parsed by a single process.
+
+With "--update", the organism's existing expression values are updated to
+match the input file instead: only new values, values that changed by
+more than "--tolerance" (0 by default) and values of genes or samples
+that are no longer in the file are written (see DiffLoader in
+_bulk_loader.py).
+
 IMPORTANT:
 (1) Before running this command, please make sure that "django-organisms"
 package has been installed and organism_tax_id already exists in the database.
@@ -24,45 +41,83 @@ to add it.
 (2) If a data source (on the first row of input file) or gene name (on the
 first column of input file) is not found in the database, a warning message
 will be generated and the corresponding column or row will be skipped.
+
+Data sources and gene names are resolved into database IDs with one query
+each, and the expression values are streamed into the database by a
+BulkLoader (see _bulk_loader.py), so no model instance is built per value.
+After a successful import, the ExpressionMatrixStore of the organism (see
+analyze/matrix_store.py) is rebuilt from the database.
 """
 
 
 from __future__ import print_function
-from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+import collections
+import multiprocessing
+import os
+import numpy as np
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
 from organisms.models import Organism
-from genes.models import Gene
 from analyze.models import Sample, ExpressionValue
+from analyze.matrix_store import ExpressionMatrixStore
+from _input import input_file
+from _genes import load_gene_ids
+from _instrumentation import (InstrumentedCommand, phase, lines, count,
+                              progress)
+from _bulk_loader import BulkLoader, DiffLoader, copy_rows
 
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Number of byte ranges per worker process and their maximum size.  Each
+# range is parsed by one task; no more than 2 tasks per worker are queued
+# at a time, which bounds the memory used by parsed records.
+CHUNKS_PER_WORKER = 4
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = ("Import gene-sample expression values from an input file.")
 
     def add_arguments(self, parser):
-        parser.add_argument('expression_filename', type=file)
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('expression_filename', type=input_file)
         parser.add_argument('organism_tax_id', type=int)
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--update', action='store_true')
+        parser.add_argument('--tolerance', type=float, default=0.0)
 
     def handle(self, **options):
         try:
-            import_expr(options['expression_filename'],
-                        options['organism_tax_id'])
+            loader = import_expr(options['expression_filename'],
+                                 options['organism_tax_id'],
+                                 options['workers'], options['update'],
+                                 options['tolerance'])
             self.stdout.write(self.style.NOTICE(
                 "Imported gene-sample expression values successfully"))
+            if options['update']:
+                self.stdout.write(self.style.NOTICE(
+                    "%d values inserted, %d updated and %d deleted" % (
+                        loader.inserted, loader.updated, loader.deleted)))
         except Exception as e:
             raise CommandError(
                 "Raised exception when importing gene-sample expression "
                 "values: %s" % e)
 
 
-def import_expr(file_handle, organism_tax_id):
+def import_expr(file_handle, organism_tax_id, workers=1, update=False,
+                tolerance=0.0):
     """
     Function that reads input file and load gene-sample expression values
-    into the database.
+    into the database.  If "workers" is more than 1 and file_handle is a
+    regular file, the data lines are parsed by that many processes (see
+    import_lines_parallel()).  If "update" is True, the organism's
+    existing expression values are updated to match the file with a
+    DiffLoader.  Return the BulkLoader (or DiffLoader) of the values.
     """
+    if workers < 1:
+        raise Exception("The number of workers must be positive")
 
     # Make sure input organism_tax_id already exists in database.
     try:
@@ -73,26 +128,71 @@ def import_expr(file_handle, organism_tax_id):
                         "'organism_create_or_update.py' in django-organisms "
                         "package to create this organism.")
 
+    # Map data sources and gene names to database IDs with one query each.
+    with phase('validate'):
+        sample_ids = dict(Sample.objects.filter(
+            ml_data_source__isnull=False).values_list('ml_data_source', 'id'))
+        gene_ids = load_gene_ids(organism.id)
+
+    # The worker processes are forked before the transaction begins, and
+    # without an open database connection, so that they never share this
+    # process's connection (see init_worker()).
+    pool = None
+    if workers > 1 and is_regular_file(file_handle):
+        if not connection.in_atomic_block:
+            connection.close()
+        pool = multiprocessing.Pool(workers, init_worker)
+    elif workers > 1:
+        logger.warning("Input file is not a regular file, so it will be "
+                       "parsed by a single process")
+
     # Enclose reading/importing process in a transaction context manager.
     # Any exception raised inside the manager will terminate the transaction
     # and roll back the database.
-    with transaction.atomic():
-        samples = []
-        for line_index, line in enumerate(file_handle):
-            tokens = line.rstrip('\r\n').split('\t')
-            if line_index == 0:
-                tokens = tokens[1:]
-                read_header(tokens, samples)
+    fields = ('sample_id', 'gene_id', 'value')
+    try:
+        with transaction.atomic():
+            if update:
+                loader = DiffLoader(ExpressionValue.objects.filter(
+                    gene__organism=organism), fields, tolerance)
+            else:
+                loader = BulkLoader(ExpressionValue, fields)
+            samples = []
+            if pool:
+                tokens = file_handle.readline().rstrip('\r\n').split('\t')
+                count('lines')
+                read_header(tokens[1:], samples, sample_ids)
+                import_lines_parallel(file_handle, samples, gene_ids, loader,
+                                      pool, workers)
             else:
-                import_data_line(line_index + 1, tokens, samples, organism)
+                for line_index, line in enumerate(lines(file_handle)):
+                    tokens = line.rstrip('\r\n').split('\t')
+                    if line_index == 0:
+                        tokens = tokens[1:]
+                        read_header(tokens, samples, sample_ids)
+                    else:
+                        line_num = line_index + 1
+                        loader.extend(import_data_line(
+                            line_num, tokens, samples, gene_ids), line_num)
+            loader.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
+    # Rebuild the organism's dense expression matrix from the new data.
+    with phase('rebuild'):
+        ExpressionMatrixStore(organism.id).refresh()
+    return loader
 
-def read_header(tokens, samples):
+
+def read_header(tokens, samples, sample_ids):
     """
     Read input tokens on header line and save the corresponding sample
-    object into "samples". (Each token will be searched in the database
-    using "ml_data_source" field. If a token does not match any sample's
-    ml_data_source, put None into "samples".)
+    ID into "samples". (Each token will be looked up in "sample_ids",
+    which maps every ml_data_source in the database to its sample ID. If
+    a token does not match any sample's ml_data_source, put None into
+    "samples".)
 
     An exception will be raised if any of the following errors are detected:
       * Sample token is blank (null or consists of space characters only);
@@ -103,25 +203,27 @@ def read_header(tokens, samples):
     for index, data_source in enumerate(tokens):
         if not data_source or data_source.isspace():
             raise Exception("Input file line #1 column #%d: blank data_source"
-                            % index + 2)
+                            % (index + 2))
         elif data_source in token_set:
             raise Exception("Input file line #1 column #%d: %s is duplicate" %
                             (index + 2, data_source))
         else:
-            try:
-                token_set.add(data_source)
-                sample = Sample.objects.get(ml_data_source=data_source)
-                samples.append(sample)
-            except Sample.DoesNotExist:
-                samples.append(None)
+            token_set.add(data_source)
+            sample_id = sample_ids.get(data_source)
+            samples.append(sample_id)
+            if sample_id is None:
                 logger.warning(
                     "Input file line #1: data_source in column #%d not found "
                     "in the database: %s", index + 2, data_source)
 
 
-def import_data_line(line_num, tokens, samples, organism):
+def import_data_line(line_num, tokens, samples, gene_ids):
     """
-    Function that imports numerical values in input tokens into the database.
+    Function that converts numerical values in input tokens into a list of
+    (sample_id, gene_id, value) tuples of "ExpressionValue" records, which
+    are loaded in bulk by import_expr().  "gene_ids" maps the systematic
+    names of the organism's genes to their IDs (None if a name matches
+    multiple genes).
     An exception will be raised if any of the following errors are detected:
       * The number of columns on this line is not equal to the number of
         samples plus 1.
@@ -139,33 +241,194 @@ def import_data_line(line_num, tokens, samples, organism):
         raise Exception("Input file line #%d: gene name (column #1)"
                         " is blank" % line_num)
 
-    try:
-        gene = Gene.objects.get(systematic_name=gene_name, organism=organism)
-    except Gene.MultipleObjectsReturned:
-        raise Exception("Input file line #%d: gene name %s (column #1) matches"
-                        " multiple genes in the database" %
-                        (line_num, gene_name))
-    except Gene.DoesNotExist:
+    if gene_name not in gene_ids:
         # If a gene is not found in database, generate a warning message
         # and skip this line.
         logger.warning(
             "Input file line #%d: gene name %s (column #1) not found in "
             "database", line_num, gene_name)
-        return
+        return []
+    gene_id = gene_ids[gene_name]
+    if gene_id is None:
+        raise Exception("Input file line #%d: gene name %s (column #1) matches"
+                        " multiple genes in the database" %
+                        (line_num, gene_name))
 
-    values = tokens[1:]
-    # To speed up the importing process, all expression values on current data
-    # line will be saved in "records" and created in bulk at the end.
     records = []
     col_num = 2   # Expression values start from column #2.
-    for sample, value in zip(samples, values):
+    for sample_id, value in zip(samples, tokens[1:]):
         try:
             float_val = float(value)
         except ValueError:
             raise Exception("Input file line #%d column #%d: expression value "
                             "%s not numeric" % (line_num, col_num, value))
-        if sample is not None:
-            records.append(
-                ExpressionValue(sample=sample, gene=gene, value=float_val))
+        if sample_id is not None:
+            records.append((sample_id, gene_id, float_val))
         col_num += 1
-    ExpressionValue.objects.bulk_create(records)  # Create records in bulk.
+    return records
+
+
+def is_regular_file(file_handle):
+    name = getattr(file_handle, 'name', None)
+    return (isinstance(name, basestring) and os.path.isfile(name) and
+            hasattr(file_handle, 'fileno'))
+
+
+def import_lines_parallel(file_handle, samples, gene_ids, loader, pool,
+                          workers):
+    """
+    Parse the data lines of file_handle (which is positioned right after
+    the header line) in "pool", a pool of "workers" processes, and add the
+    parsed records to "loader" in file order.  Warnings and exceptions are
+    the same as in import_data_line(), with the same line numbers.
+    """
+    data_start = file_handle.tell()
+    file_size = os.fstat(file_handle.fileno()).st_size
+    chunk_size = max(1, min(
+        MAX_CHUNK_SIZE,
+        (file_size - data_start) // (workers * CHUNKS_PER_WORKER) + 1))
+    tasks = ((file_handle.name, start, min(start + chunk_size, file_size),
+              data_start, samples, gene_ids, loader.use_copy)
+             for start in xrange(data_start, file_size, chunk_size))
+
+    line_num = 1  # the header is line #1
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(parse_chunk, (task, )))
+        if len(pending) < 2 * workers:
+            continue
+        line_num = add_chunk(pending.popleft().get(), line_num, samples,
+                             gene_ids, loader)
+    while pending:
+        line_num = add_chunk(pending.popleft().get(), line_num, samples,
+                             gene_ids, loader)
+
+
+# Database connections inherited by a worker process (see init_worker()).
+_inherited_connections = []
+
+
+def init_worker():
+    """
+    Initialize a worker process of import_lines_parallel().  If the parent
+    process had a database connection open when it forked (because the
+    caller holds a transaction), the worker keeps a reference to it, so
+    that it is never closed here (closing it would end the parent's
+    session), and Django opens a new connection if the worker ever uses
+    the database.
+    """
+    for conn in connections.all():
+        if conn.connection is not None:
+            _inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def add_chunk(chunk, line_num, samples, gene_ids, loader):
+    """
+    Add the result of parse_chunk() to "loader".  "line_num" is the
+    number of the line before the chunk; the number of its last line is
+    returned.
+    """
+    for index, gene_name in chunk['skipped_genes']:
+        logger.warning(
+            "Input file line #%d: gene name %s (column #1) not found in "
+            "database", line_num + index + 1, gene_name)
+    if chunk['error_line'] is not None:
+        # Parse the invalid line again in this process to raise the same
+        # exception as a sequential import.
+        index, line = chunk['error_line']
+        import_data_line(line_num + index + 1,
+                         line.rstrip('\r\n').split('\t'), samples, gene_ids)
+        raise Exception("Input file line #%d is invalid" %
+                        (line_num + index + 1))
+    if loader.use_copy:
+        loader.add_copy_data(chunk['rows'], chunk['num_rows'])
+    else:
+        # Every parsed line has the same number of rows.
+        width = chunk['num_rows'] // max(1, len(chunk['line_indexes']))
+        for i, index in enumerate(chunk['line_indexes']):
+            loader.extend(chunk['rows'][i * width:(i + 1) * width],
+                          line_num + index + 1)
+    count('lines', chunk['num_lines'])
+    progress()
+    return line_num + chunk['num_lines']
+
+
+def parse_chunk(task):
+    """
+    Parse the data lines that start in a byte range of the input file (in
+    a worker process, without any database access).  Return a dictionary
+    of:
+      * num_lines: the number of lines in the range;
+      * skipped_genes: (line index, gene name) of the lines whose gene is
+        not found in the database;
+      * error_line: (line index, line) of the first invalid line, or None;
+      * rows and num_rows: the (sample_id, gene_id, value) tuples of the
+        "ExpressionValue" records, formatted by copy_rows() if "use_copy"
+        is True;
+      * line_indexes: the indexes of the lines of these tuples (in order,
+        with the same number of tuples per line).
+    Line indexes are relative to the first line of the range.
+    """
+    path, start, end, data_start, samples, gene_ids, use_copy = task
+    with open(path, 'rb') as chunk_file:
+        if start > data_start:
+            # Skip the line that started in the previous range.
+            chunk_file.seek(start - 1)
+            chunk_file.readline()
+        else:
+            chunk_file.seek(start)
+        lines = []
+        while chunk_file.tell() < end:
+            line = chunk_file.readline()
+            if not line:
+                break
+            lines.append(line)
+
+    result = {'num_lines': len(lines), 'skipped_genes': [],
+              'error_line': None, 'rows': [], 'num_rows': 0,
+              'line_indexes': []}
+    line_indexes, line_gene_ids, values = [], [], []
+    for index, line in enumerate(lines):
+        tokens = line.rstrip('\r\n').split('\t')
+        gene_name = tokens[0]
+        if (len(tokens) != len(samples) + 1 or not gene_name or
+                gene_name.isspace() or gene_ids.get(gene_name, 0) is None):
+            result['error_line'] = (index, line)
+            break
+        if gene_name not in gene_ids:
+            result['skipped_genes'].append((index, gene_name))
+            continue
+        line_indexes.append(index)
+        line_gene_ids.append(gene_ids[gene_name])
+        values.append(tokens[1:])
+
+    # Convert all values of the range at once; if that fails, look for the
+    # first line that can not be converted.
+    try:
+        matrix = np.array(values, dtype=np.float64).reshape(
+            len(values), len(samples))
+    except ValueError:
+        for index, line_values in zip(line_indexes, values):
+            try:
+                np.array(line_values, dtype=np.float64)
+            except ValueError:
+                result['error_line'] = (index, lines[index])
+                break
+    if result['error_line'] is not None:
+        error_index = result['error_line'][0]
+        result['skipped_genes'] = [
+            skipped for skipped in result['skipped_genes']
+            if skipped[0] < error_index]
+        return result
+
+    columns = [i for i, sample_id in enumerate(samples)
+               if sample_id is not None]
+    matrix = matrix[:, columns]
+    rows = zip(np.tile([samples[i] for i in columns], len(values)).tolist(),
+               np.repeat(line_gene_ids, len(columns)).tolist(),
+               matrix.ravel().tolist())
+    result['rows'] = copy_rows(rows) if use_copy else rows
+    result['num_rows'] = len(rows)
+    result['line_indexes'] = line_indexes
+    return result
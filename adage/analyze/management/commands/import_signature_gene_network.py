@@ -25,6 +25,17 @@ For example, to import the data lines in an input file
   python manage.py import_signature_gene_network \
 /path/of/signature_gene_network.txt "Ensemble ADAGE 300" "High-weight genes"
 
+The input file may be compressed with gzip, bzip2 or xz, or "-" to read
+standard input (see _input.py).
+
+All signatures of the model, all genes of its organism and all existing
+participations of the model's signatures with the participation type are
+read up front (one query each), so conflicts are detected in memory, and
+the new participations are loaded by a BulkLoader (see _bulk_loader.py).
+After a successful import, the SignatureCorrelationStore of the model
+(see analyze/similarity.py) is rebuilt, unless the model is staged (see
+"publish_ml_model").
+
 IMPORTANT:
 Before running this command, please:
   (1) Make sure that ml_model_name already exists in the database.
@@ -36,22 +47,27 @@ Before running this command, please:
 """
 
 from __future__ import print_function
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.db import transaction
-from genes.models import Gene
 from analyze.models import MLModel, Signature, Participation, ParticipationType
+from analyze.similarity import SignatureCorrelationStore
+from _input import input_file
+from _genes import load_gene_ids
+from _instrumentation import InstrumentedCommand, phase, lines
+from _bulk_loader import BulkLoader
 
 import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = ("Imports signature-gene network data into Participation table in "
             "the database.")
 
     def add_arguments(self, parser):
-        parser.add_argument('signature_gene_network_file', type=file)
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('signature_gene_network_file', type=input_file)
         parser.add_argument('ml_model_name', type=str)
         parser.add_argument('participation_type_name', type=str)
 
@@ -96,16 +112,35 @@ def import_network(file_handle, ml_model_name, participation_type_name):
                         "database" % participation_type_name)
 
     # Enclose reading/importing process in a transaction.
-    with transaction.atomic():
-        check_and_import(file_handle, ml_model, participation_type)
-
-
-def check_and_import(file_handle, ml_model, participation_type):
-    """Read valid data lines into the database.  An exception will be
-    raised if any errors are detected in file_handle.
+    with transaction.atomic(), BulkLoader(
+            Participation, ('signature_id', 'gene_id',
+                            'participation_type_id')) as loader:
+        check_and_import(file_handle, ml_model, participation_type, loader)
+
+    # Rebuild the Jaccard indexes of the model's signatures (staged models
+    # get theirs when they are published).
+    if ml_model.published:
+        with phase('rebuild'):
+            SignatureCorrelationStore(ml_model.id).refresh()
+
+
+def check_and_import(file_handle, ml_model, participation_type, loader):
+    """Read valid data lines into the database through the BulkLoader
+    "loader".  An exception will be raised if any errors are detected in
+    file_handle.
     """
+    with phase('validate'):
+        signature_ids = dict(Signature.objects.filter(
+            mlmodel=ml_model).values_list('name', 'id'))
+        gene_ids = load_gene_ids(ml_model.organism_id)
+        # (signature ID, gene ID) pairs that already exist with this
+        # participation type, plus the ones added from the file.
+        participations = set(Participation.objects.filter(
+            signature__mlmodel=ml_model, participation_type=participation_type
+        ).values_list('signature_id', 'gene_id'))
+
     signatures_in_file = set()
-    for line_index, line in enumerate(file_handle):
+    for line_index, line in enumerate(lines(file_handle)):
         tokens = line.rstrip("\t\r\n").split("\t")
         # Skip a line if it is blank or has only one field.
         if len(tokens) < 2:
@@ -118,29 +153,25 @@ def check_and_import(file_handle, ml_model, participation_type):
             raise Exception("Input file line #%s: %s is a duplicate signature "
                             "in the file" % (line_index + 1, signature_name))
 
-        try:
-            signature = Signature.objects.get(name=signature_name,
-                                              mlmodel=ml_model)
-        except Signature.DoesNotExist:
+        signature_id = signature_ids.get(signature_name)
+        if signature_id is None:
             raise Exception("Input file line #%s: Signature name %s not found "
                             "in database" % (line_index + 1, signature_name))
 
-        records = []
         for sys_name in gene_names:
-            try:
-                gene = Gene.objects.get(systematic_name=sys_name)
             # If the gene's sytematic name does not match one and only
             # one gene in the database, generate a warning message and
             # skip this gene.
-            except Gene.DoesNotExist:
+            if sys_name not in gene_ids:
                 logger.warning("Input file line #%s: Gene name %s is skipped "
                                "because it is not found in the database",
                                line_index + 1, sys_name)
                 continue
-            except Gene.MultipleObjectsReturned:
+            gene_id = gene_ids[sys_name]
+            if gene_id is None:
                 logger.warning("Input file line #%s: Gene name %s is skipped "
                                "because multiple genes are named %s in the "
-                               "database", line_index + 1, sys_name)
+                               "database", line_index + 1, sys_name, sys_name)
                 continue
 
             # Raise an exception if the combination of (signature, gene,
@@ -149,22 +180,13 @@ def check_and_import(file_handle, ml_model, participation_type):
             # implicitly, we raise an explicit exception that includes the
             # input file's line number where the error is detected, and
             # signature name, gene name, and participation_type name involved.
-            if Participation.objects.filter(
-                    signature=signature, gene=gene,
-                    participation_type=participation_type).exists():
+            if (signature_id, gene_id) in participations:
                 raise Exception("Input file line #%s: (%s, %s, %s) already "
                                 "exists in Participation table." %
                                 (line_index + 1, signature_name, sys_name,
                                  participation_type.name))
-            else:
-                records.append(
-                    Participation(signature=signature,
-                                  gene=gene,
-                                  participation_type=participation_type)
-                )
-
-        # Create database records in bulk.
-        Participation.objects.bulk_create(records)
+            participations.add((signature_id, gene_id))
+            loader.add((signature_id, gene_id, participation_type.id))
 
         # Save this signature name so that we can check signature
         # duplicate(s) in the file later.
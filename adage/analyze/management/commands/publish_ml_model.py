@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+This management command publishes a staged machine learning model (one
+that was added by "add_ml_model --staged"), so that the API starts
+serving it.  It should be invoked like this:
+
+  python manage.py publish_ml_model <ml_model_name> \
+ [--replaces <old_ml_model_name>]
+
+A staged model's data are imported with the usual commands while the
+API keeps serving the published models only.  This command then:
+  (1) validates the staged data: the model must have signatures, and
+      every signature must have the same (non-zero) number of activity
+      records;
+  (2) builds the model's ActivityMatrixStore and GeneNetworkStore (see
+      analyze/matrix_store.py), and its SampleSimilarityStore and
+      SignatureCorrelationStore (see analyze/similarity.py);
+  (3) publishes the model in one short transaction that only updates
+      the "published" flag(s) of the "MLModel" table, so readers switch
+      to the new model at once and never see it half loaded.  The staged
+      records are already in the live tables, where the API hides them
+      until then (see api.py), so no record is copied or deleted.
+
+"--replaces" is an optional argument.  If it is specified, the (published)
+model old_ml_model_name is unpublished in the same transaction, so that
+a new version of a model replaces the old one atomically.  The stores of
+the old model are removed afterwards, and its activity, edges and
+participations are deleted in batches of DELETE_BATCH_SIZE records, each
+in its own short transaction.  (Its "MLModel" and "Signature" records
+are kept, unpublished.)
+"""
+
+from __future__ import print_function
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from analyze.models import (
+    MLModel, Signature, Activity, Edge, Participation)
+from analyze.matrix_store import ActivityMatrixStore, GeneNetworkStore
+from analyze.similarity import (
+    SampleSimilarityStore, SignatureCorrelationStore)
+
+
+# Number of records of the replaced model deleted per transaction.
+DELETE_BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = "Validate and publish a staged machine learning model."
+
+    def add_arguments(self, parser):
+        parser.add_argument('ml_model_name', type=str)
+        parser.add_argument('--replaces',
+                            type=str,
+                            dest='replaces',
+                            default=None,
+                            help='Published model that the new model '
+                            'replaces')
+
+    def handle(self, **options):
+        try:
+            publish_ml_model(options['ml_model_name'], options['replaces'])
+            self.stdout.write(self.style.NOTICE(
+                "Published the machine learning model successfully"))
+        except Exception as e:
+            raise CommandError(
+                "Failed to publish the machine learning model: "
+                "publish_ml_model raised an exception:\n%s" % e)
+
+
+def publish_ml_model(ml_model_name, replaces=None):
+    try:
+        mlmodel = MLModel.objects.get(title=ml_model_name)
+    except MLModel.DoesNotExist:
+        raise Exception("Input ml_model_name %s does not exist in the "
+                        "database" % ml_model_name)
+    if mlmodel.published:
+        raise Exception("%s has already been published" % ml_model_name)
+
+    old_mlmodel = None
+    if replaces:
+        try:
+            old_mlmodel = MLModel.objects.get(title=replaces, published=True)
+        except MLModel.DoesNotExist:
+            raise Exception("Published model %s does not exist in the "
+                            "database" % replaces)
+
+    validate_ml_model(mlmodel)
+    ActivityMatrixStore(mlmodel.id).build()
+    GeneNetworkStore(mlmodel.id).build()
+    SampleSimilarityStore(mlmodel.id).build()
+    SignatureCorrelationStore(mlmodel.id).build()
+
+    # Publishing only updates metadata.
+    with transaction.atomic():
+        MLModel.objects.filter(id=mlmodel.id).update(published=True)
+        if old_mlmodel:
+            MLModel.objects.filter(id=old_mlmodel.id).update(published=False)
+
+    if old_mlmodel:
+        ActivityMatrixStore(old_mlmodel.id).delete()
+        GeneNetworkStore(old_mlmodel.id).delete()
+        SampleSimilarityStore(old_mlmodel.id).delete()
+        SignatureCorrelationStore(old_mlmodel.id).delete()
+        delete_in_batches(Activity.objects.filter(
+            signature__mlmodel=old_mlmodel))
+        delete_in_batches(Edge.objects.filter(mlmodel=old_mlmodel))
+        delete_in_batches(Participation.objects.filter(
+            signature__mlmodel=old_mlmodel))
+
+
+def delete_in_batches(queryset, batch_size=DELETE_BATCH_SIZE):
+    """
+    Delete the records of "queryset" "batch_size" records at a time, each
+    batch in its own transaction, so that no lock is held on the table for
+    the whole deletion.
+    """
+    model = queryset.model
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            model.objects.filter(id__in=ids).delete()
+
+
+def validate_ml_model(mlmodel):
+    """
+    Raise an exception if the staged data of mlmodel are incomplete: the
+    model has no signatures, or its signatures do not all have the same
+    non-zero number of activity records.
+    """
+    signatures = dict(Signature.objects.filter(
+        mlmodel=mlmodel).values_list('id', 'name'))
+    if not signatures:
+        raise Exception("%s has no signatures" % mlmodel.title)
+
+    counts = dict(Activity.objects.filter(
+        signature__mlmodel=mlmodel).values('signature').annotate(
+            num_records=Count('id')).values_list('signature', 'num_records'))
+    num_records = max(counts.values()) if counts else 0
+    if num_records == 0:
+        raise Exception("%s has no activity records" % mlmodel.title)
+    for signature_id, name in sorted(signatures.items()):
+        if counts.get(signature_id, 0) != num_records:
+            raise Exception("Signature %s has %d activity records instead "
+                            "of %d" % (name, counts.get(signature_id, 0),
+                                       num_records))
@@ -0,0 +1,482 @@
+"""
+Memory-mapped copies of tables that the API reads as matrices.
+
+Tables such as "Activity" hold one database row per (sample, signature)
+pair, so assembling a matrix from them means scanning millions of rows.
+A matrix store materializes such a table once (right after the data are
+imported) as a float32 NumPy ".npy" file plus two ID index arrays, and
+every worker process memory-maps that file read-only.  Slicing a subset
+of rows and columns out of it is then plain NumPy fancy-indexing, and
+the operating system's page cache shares the data among all processes.
+The "Edge" table is stored the same way as a sparse adjacency matrix in
+compressed sparse row (CSR) format (see GeneNetworkStore), and the
+"ExpressionValue" table of each organism is stored in both gene-major
+and sample-major order (see ExpressionMatrixStore).
+
+Each store lives in its own folder under settings.DATA_CACHE_DIR, with
+one ".npy" file per array:
+
+  <DATA_CACHE_DIR>/<subdir>/<key>  ->  <key>.<build timestamp>/
+                                         row_ids.npy
+                                         col_ids.npy
+                                         values.npy
+                                         ...
+
+"<key>" is a symbolic link that is replaced atomically whenever the
+store is rebuilt, so readers never see a half-written matrix; processes
+that already mapped the previous version keep reading it until they
+notice the link has changed.
+"""
+
+import itertools
+import os
+import shutil
+import time
+import numpy as np
+from django.conf import settings
+from models import Activity, Signature, Edge, ExpressionValue
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Number of database rows converted into NumPy arrays at a time while a
+# store is being built.
+BUILD_CHUNK_SIZE = 100000
+
+
+def records_to_columns(records, dtypes, chunk_size=BUILD_CHUNK_SIZE):
+    """
+    Convert an iterator of equal-length tuples (such as the one returned
+    by a values_list() queryset's iterator()) into a list of 1-D NumPy
+    arrays, one per tuple element, whose data types are given by
+    "dtypes".  Records are converted "chunk_size" at a time so that only
+    one chunk of Python tuples is held in memory.
+    """
+    records = iter(records)
+    chunks = [[] for dtype in dtypes]
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        for column_chunks, column, dtype in zip(chunks, zip(*chunk), dtypes):
+            column_chunks.append(np.array(column, dtype=dtype))
+    return [np.concatenate(column_chunks) if column_chunks
+            else np.empty(0, dtype=dtype)
+            for column_chunks, dtype in zip(chunks, dtypes)]
+
+
+class DenseMatrix(object):
+    """
+    A read-only matrix whose rows and columns are labeled by integer
+    database IDs.  "row_ids" and "col_ids" must be sorted in ascending
+    order; missing values in "values" are NaN.
+    """
+    def __init__(self, row_ids, col_ids, values):
+        self.row_ids = row_ids
+        self.col_ids = col_ids
+        self.values = values
+
+    @staticmethod
+    def _positions(index, ids):
+        """
+        Return the positions of "ids" in the sorted array "index", and a
+        boolean mask of the ids that were found.
+        """
+        ids = np.asarray(ids, dtype=index.dtype)
+        positions = np.searchsorted(index, ids)
+        positions[positions == len(index)] = 0
+        found = (index[positions] == ids) if len(index) else (
+            np.zeros(len(ids), dtype=bool))
+        return positions, found
+
+    def row_positions(self, row_ids):
+        return self._positions(self.row_ids, row_ids)
+
+    def col_positions(self, col_ids):
+        return self._positions(self.col_ids, col_ids)
+
+    def slice(self, row_ids=None, col_ids=None):
+        """
+        Return (row_ids, col_ids, values) for the requested rows and
+        columns (all of them if None), in the requested order.  IDs that
+        are not in the matrix are silently dropped.
+        """
+        if row_ids is None:
+            rows, row_ids = slice(None), self.row_ids
+        else:
+            rows, found = self.row_positions(row_ids)
+            rows = rows[found]
+            row_ids = self.row_ids[rows]
+        if col_ids is None:
+            cols, col_ids = slice(None), self.col_ids
+        else:
+            cols, found = self.col_positions(col_ids)
+            cols = cols[found]
+            col_ids = self.col_ids[cols]
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            values = self.values[rows][:, cols]
+        else:
+            values = self.values[np.ix_(rows, cols)]
+        return row_ids, col_ids, values
+
+
+class ArrayStore(object):
+    """
+    Base class of all stores.  A subclass sets "subdir" and implements
+    read_arrays(), which reads the data of the store from the database
+    and returns a dictionary of {name: NumPy array}, and wrap(), which
+    builds the object returned by build() and load() from such a
+    dictionary.  The arrays named in "mmap_arrays" are memory-mapped by
+    load(), the other (small) ones are read into memory.
+    """
+    subdir = None
+    mmap_arrays = ()
+
+    # Per-process cache of loaded stores: {link path: (target, object)}
+    _loaded = {}
+
+    def __init__(self, key):
+        self.key = key
+
+    @property
+    def path(self):
+        return os.path.join(settings.DATA_CACHE_DIR, self.subdir,
+                            str(self.key))
+
+    def exists(self):
+        return os.path.islink(self.path)
+
+    def read_arrays(self):
+        raise NotImplementedError()
+
+    def wrap(self, arrays):
+        raise NotImplementedError()
+
+    def build(self):
+        """
+        (Re)build this store from the database and publish it atomically.
+        """
+        start = time.time()
+        arrays = self.read_arrays()
+        parent = os.path.dirname(self.path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        version_dir = "%s.%d" % (self.path, int(start * 1000000))
+        os.mkdir(version_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(version_dir, name + '.npy'), array)
+
+        # Replace the symbolic link atomically, then remove the previous
+        # version (processes that mapped it keep their open copy).
+        previous_dir = (os.path.realpath(self.path) if self.exists()
+                        else None)
+        tmp_link = version_dir + '.link'
+        os.symlink(os.path.basename(version_dir), tmp_link)
+        os.rename(tmp_link, self.path)
+        if previous_dir and os.path.isdir(previous_dir):
+            shutil.rmtree(previous_dir, ignore_errors=True)
+        logger.info("Built %s in %.1f seconds", self.path,
+                    time.time() - start)
+        return self.wrap(arrays)
+
+    def load(self):
+        """
+        Return the current content of this store (see wrap()) with large
+        arrays memory-mapped read-only, or None if the store has not been
+        built yet.  The content is cached in this process until the store
+        is rebuilt.
+        """
+        link = self.path
+        try:
+            target = os.readlink(link)
+        except OSError:
+            return None
+        cached = self._loaded.get(link)
+        if cached and cached[0] == target:
+            return cached[1]
+
+        version_dir = os.path.join(os.path.dirname(link), target)
+        try:
+            arrays = {}
+            for file_name in os.listdir(version_dir):
+                name = os.path.splitext(file_name)[0]
+                arrays[name] = np.load(
+                    os.path.join(version_dir, file_name),
+                    mmap_mode='r' if name in self.mmap_arrays else None)
+        except (IOError, OSError):
+            # If the store was rebuilt (and this version removed) between
+            # readlink() and np.load(), try again with the new version.
+            if os.path.islink(link) and os.readlink(link) != target:
+                return self.load()
+            raise
+        content = self.wrap(arrays)
+        self._loaded[link] = (target, content)
+        return content
+
+    def refresh(self):
+        """
+        Rebuild this store after its data have been imported.  If the
+        build fails, the store is removed (a stale store is worse than
+        none, because readers fall back to the database without it) and
+        a warning is logged instead of raising an exception, because the
+        import itself has already succeeded.
+        """
+        try:
+            return self.build()
+        except Exception as e:
+            self.delete()
+            logger.warning("Failed to build %s: %s", self.path, e)
+
+    def delete(self):
+        """Remove this store from disk."""
+        if self.exists():
+            version_dir = os.path.realpath(self.path)
+            os.remove(self.path)
+            shutil.rmtree(version_dir, ignore_errors=True)
+        self._loaded.pop(self.path, None)
+
+
+class DenseMatrixStore(ArrayStore):
+    """
+    Base class of all dense matrix stores.  A subclass sets "subdir" and
+    implements read_records(), which returns an iterator of
+    (row_id, col_id, value) tuples, and optionally col_ids(), which
+    returns every column ID the matrix should include (even columns
+    without any value).  The values are stored as float32.
+    """
+    mmap_arrays = ('values', )
+
+    def read_records(self):
+        raise NotImplementedError()
+
+    def col_ids(self):
+        return None
+
+    def read_matrix(self):
+        """
+        Read all records of this store from the database and return them
+        as a DenseMatrix.
+        """
+        rows, cols, values = records_to_columns(
+            self.read_records(), (np.int64, np.int64, np.float32))
+
+        row_ids, row_positions = np.unique(rows, return_inverse=True)
+        col_ids = self.col_ids()
+        if col_ids is None:
+            col_ids, col_positions = np.unique(cols, return_inverse=True)
+        else:
+            col_ids = np.unique(np.asarray(col_ids, dtype=np.int64))
+            col_positions = np.searchsorted(col_ids, cols)
+        matrix = np.full((len(row_ids), len(col_ids)), np.nan,
+                         dtype=np.float32)
+        matrix[row_positions, col_positions] = values
+        return DenseMatrix(row_ids, col_ids, matrix)
+
+    def read_arrays(self):
+        matrix = self.read_matrix()
+        return {'row_ids': matrix.row_ids, 'col_ids': matrix.col_ids,
+                'values': matrix.values}
+
+    def wrap(self, arrays):
+        return DenseMatrix(arrays['row_ids'], arrays['col_ids'],
+                           arrays['values'])
+
+
+class ActivityMatrixStore(DenseMatrixStore):
+    """
+    Samples x signatures float32 matrix of the activity values of one
+    MLModel.  Rows are sample IDs, columns are the IDs of all signatures
+    in the model.
+    """
+    subdir = 'activity'
+
+    def __init__(self, mlmodel_id):
+        super(ActivityMatrixStore, self).__init__(int(mlmodel_id))
+
+    def read_records(self):
+        return Activity.objects.filter(
+            signature__mlmodel=self.key
+        ).values_list('sample_id', 'signature_id', 'value').iterator()
+
+    def col_ids(self):
+        return list(Signature.objects.filter(
+            mlmodel=self.key).values_list('id', flat=True))
+
+
+class GeneNetwork(object):
+    """
+    A gene-gene network in compressed sparse row (CSR) format.  Genes are
+    numbered by their positions in the sorted array "gene_ids"; the
+    neighbors of the gene at position i are
+    neighbors[indptr[i]:indptr[i + 1]], and "weights" and "edge_ids" hold
+    the weight and database ID of the edge to each of these neighbors.
+    Every edge is stored in both directions; "forward" is True for the
+    direction in which it is stored in the database (gene1 to gene2).
+    """
+    def __init__(self, gene_ids, indptr, neighbors, weights, edge_ids,
+                 forward):
+        self.gene_ids = gene_ids
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.weights = weights
+        self.edge_ids = edge_ids
+        self.forward = forward
+
+    @classmethod
+    def from_edges(cls, edge_ids, genes1, genes2, weights):
+        """
+        Build a GeneNetwork from the columns of a list of edges.
+        """
+        gene_ids = np.unique(np.concatenate((genes1, genes2)))
+        sources = np.searchsorted(gene_ids, np.concatenate((genes1, genes2)))
+        targets = np.searchsorted(gene_ids, np.concatenate((genes2, genes1)))
+        order = np.argsort(sources, kind='mergesort')
+        indptr = np.zeros(len(gene_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(gene_ids)),
+                  out=indptr[1:])
+        forward = np.arange(len(sources)) < len(edge_ids)
+        return cls(gene_ids, indptr,
+                   targets[order].astype(np.int32),
+                   np.concatenate((weights, weights))[order],
+                   np.concatenate((edge_ids, edge_ids))[order],
+                   forward[order])
+
+    def _adjacency(self, positions):
+        """
+        Return (sources, neighbors, weights, edge_ids, forward) of all
+        entries in the rows at "positions".
+        """
+        starts = self.indptr[positions]
+        lengths = self.indptr[positions + 1] - starts
+        # Positions of the entries of every row, concatenated.
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        entries = np.arange(lengths.sum()) + offsets
+        return (np.repeat(positions, lengths), self.neighbors[entries],
+                self.weights[entries], self.edge_ids[entries],
+                self.forward[entries])
+
+    @staticmethod
+    def _weight_mask(weights, min_weight=None, sign=None):
+        mask = np.ones(len(weights), dtype=bool)
+        if min_weight is not None:
+            mask &= np.abs(weights) >= min_weight
+        if sign == 'positive':
+            mask &= weights > 0
+        elif sign == 'negative':
+            mask &= weights < 0
+        return mask
+
+    def neighborhood_edges(self, gene_ids, min_weight=None, sign=None):
+        """
+        Return (edge IDs, gene1 IDs, gene2 IDs, weights) of the edges of
+        the subgraph induced by "gene_ids" and all their neighbors as 1-D
+        arrays, sorted by edge ID.  Only edges whose absolute weight is at
+        least "min_weight" (if not None) and whose sign is "sign"
+        ("positive" or "negative", if not None) are considered, both for
+        finding neighbors and in the subgraph.
+        """
+        positions, found = DenseMatrix._positions(self.gene_ids, gene_ids)
+        positions = np.unique(positions[found])
+        sources, neighbors, weights, edge_ids, forward = self._adjacency(
+            positions)
+        mask = self._weight_mask(weights, min_weight, sign)
+        nodes = np.unique(np.concatenate((sources[mask], neighbors[mask])))
+
+        sources, neighbors, weights, edge_ids, forward = self._adjacency(
+            nodes)
+        in_subgraph = np.zeros(len(self.gene_ids), dtype=bool)
+        in_subgraph[nodes] = True
+        # Each edge of the subgraph is read in its forward direction only.
+        mask = forward & in_subgraph[neighbors] & self._weight_mask(
+            weights, min_weight, sign)
+        order = np.argsort(edge_ids[mask], kind='mergesort')
+        return (edge_ids[mask][order].astype(np.int64),
+                self.gene_ids[sources[mask][order]],
+                self.gene_ids[neighbors[mask][order]],
+                weights[mask][order])
+
+
+class GeneNetworkStore(ArrayStore):
+    """
+    Gene-gene network (the "Edge" table) of one MLModel as a GeneNetwork.
+    """
+    subdir = 'gene_network'
+    mmap_arrays = ('neighbors', 'weights', 'edge_ids', 'forward')
+
+    def __init__(self, mlmodel_id):
+        super(GeneNetworkStore, self).__init__(int(mlmodel_id))
+
+    def read_arrays(self):
+        edge_ids, genes1, genes2, weights = records_to_columns(
+            Edge.objects.filter(mlmodel=self.key).values_list(
+                'id', 'gene1_id', 'gene2_id', 'weight').iterator(),
+            (np.int64, np.int64, np.int64, np.float64))
+        network = GeneNetwork.from_edges(edge_ids, genes1, genes2, weights)
+        return {'gene_ids': network.gene_ids, 'indptr': network.indptr,
+                'neighbors': network.neighbors, 'weights': network.weights,
+                'edge_ids': network.edge_ids, 'forward': network.forward}
+
+    def wrap(self, arrays):
+        return GeneNetwork(arrays['gene_ids'], arrays['indptr'],
+                           arrays['neighbors'], arrays['weights'],
+                           arrays['edge_ids'], arrays['forward'])
+
+
+class ExpressionMatrix(object):
+    """
+    Genes x samples matrix of the expression values of one organism.
+    Rows are the sorted IDs "gene_ids", columns the sorted IDs
+    "sample_ids".  The values are stored twice, gene-major ("values", one
+    row per gene) and sample-major ("sample_values", one row per sample),
+    so the values of a few genes or of a few samples are contiguous
+    reads.  Both layouts are float32.
+    """
+    def __init__(self, gene_ids, sample_ids, values, sample_values):
+        self.gene_ids = gene_ids
+        self.sample_ids = sample_ids
+        self.values = values
+        self.sample_values = sample_values
+
+    def sample_rows(self, sample_ids):
+        """
+        Return the rows of "sample_ids" (in the requested order) in the
+        sample-major layout as a samples x genes float32 array (whose
+        columns are "gene_ids"); the rows of unknown samples are NaN.
+        """
+        positions, found = DenseMatrix._positions(self.sample_ids,
+                                                  sample_ids)
+        matrix = np.full((len(found), len(self.gene_ids)), np.nan,
+                         dtype=np.float32)
+        matrix[found] = self.sample_values[positions[found]]
+        return matrix
+
+
+class ExpressionMatrixStore(ArrayStore):
+    """
+    ExpressionMatrix of the expression values of one organism.
+    """
+    subdir = 'expression'
+    mmap_arrays = ('values', 'sample_values')
+
+    def __init__(self, organism_id):
+        super(ExpressionMatrixStore, self).__init__(int(organism_id))
+
+    def read_arrays(self):
+        genes, samples, values = records_to_columns(
+            ExpressionValue.objects.filter(
+                gene__organism=self.key
+            ).values_list('gene_id', 'sample_id', 'value').iterator(),
+            (np.int64, np.int64, np.float32))
+        gene_ids, rows = np.unique(genes, return_inverse=True)
+        sample_ids, cols = np.unique(samples, return_inverse=True)
+        matrix = np.full((len(gene_ids), len(sample_ids)), np.nan,
+                         dtype=np.float32)
+        matrix[rows, cols] = values
+        return {'gene_ids': gene_ids, 'sample_ids': sample_ids,
+                'values': matrix,
+                'sample_values': np.ascontiguousarray(matrix.T)}
+
+    def wrap(self, arrays):
+        return ExpressionMatrix(arrays['gene_ids'], arrays['sample_ids'],
+                                arrays['values'], arrays['sample_values'])
@@ -1,10 +1,18 @@
 # coding: utf-8 (see https://www.python.org/dev/peps/pep-0263/)
 
 import re
-from django.db import models
+import uuid
+from django.db import models, connection, transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from organisms.models import Organism
 from genes.models import Gene
+from data_version import bump_data_version_on_commit, ANNOTATIONS
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 
 def validate_pyname(value):
@@ -96,18 +104,68 @@ class AnnotationType(models.Model):
         return "%d (%s)" % (self.id, self.typename)
 
 
+def iter_query(sql, params=(), chunk_size=2000):
+    """
+    Execute a raw SQL query and yield its result rows one at a time while
+    fetching them from the database "chunk_size" rows at a time.  On
+    PostgreSQL the rows are read through a server-side (named) cursor in
+    a transaction that stays open until they have all been read, so the
+    first rows arrive as soon as the server produces them and the client
+    never holds more than one chunk of a large result in memory.
+    """
+    if connection.vendor == 'postgresql':
+        # A named cursor only exists inside a transaction.  (A "WITH HOLD"
+        # cursor would outlive it, but its whole result would be computed
+        # and stored on the server when the transaction commits.)
+        with transaction.atomic():
+            cursor = connection.connection.cursor(
+                name='iter_query_%s' % uuid.uuid4().hex)
+            cursor.itersize = chunk_size
+            for row in fetch_rows(cursor, sql, params, chunk_size):
+                yield row
+    else:
+        connection.ensure_connection()
+        for row in fetch_rows(connection.cursor(), sql, params, chunk_size):
+            yield row
+
+
+def fetch_rows(cursor, sql, params, chunk_size):
+    """
+    Execute a query with "cursor" and yield its result rows, fetched
+    "chunk_size" at a time, then close the cursor.
+    """
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+
 class SampleAnnotationManager(models.Manager):
     def create_from_dict(self, sample, ann_dict):
-        for k, v in ann_dict.iteritems():
-            if not v:
-                continue
-            ann_type, created = AnnotationType.objects.get_or_create(k)
-            sa = SampleAnnotation(
+        """
+        Create the non-blank annotations in ann_dict ({typename: text}) for
+        sample with a single bulk insert, creating missing annotation types.
+        """
+        ann_dict = dict((k, v) for k, v in ann_dict.iteritems() if v)
+        type_ids = dict(AnnotationType.objects.filter(
+            typename__in=ann_dict.keys()).values_list('typename', 'id'))
+        for k in ann_dict:
+            if k not in type_ids:
+                type_ids[k] = AnnotationType.objects.create(k).id
+        self.bulk_create([
+            SampleAnnotation(
                 sample=sample,
-                annotation_type=ann_type,
+                annotation_type_id=type_ids[k],
                 text=v,
-            )
-            sa.save()
+            ) for k, v in ann_dict.iteritems()])
+        # bulk_create() does not send post_save signals.
+        bump_annotations_version(sender=SampleAnnotation)
 
     def get_as_dict(self, sample):
         annotations_for_sample = self.get_queryset().filter(sample=sample)
@@ -115,6 +173,59 @@ class SampleAnnotationManager(models.Manager):
                   for sa in annotations_for_sample}
         return result
 
+    def iter_experiment_samples(self, annotation_type_ids):
+        """
+        Yield an (experiment accession, sample name, ml_data_source,
+        annotations) tuple for every sample of every experiment, ordered
+        by experiment accession and then sample ID.  "annotations" is a
+        dict of {annotation_type_id: text} restricted to the types in
+        annotation_type_ids.
+
+        All rows come from a single ordered join of the Experiment-Sample
+        link table with Sample and SampleAnnotation (see iter_query()),
+        which is pivoted into one tuple per sample as it is read, so the
+        memory used does not depend on the number of samples.
+        """
+        qn = connection.ops.quote_name
+        through = Sample.experiments.through._meta
+        annotation = self.model._meta
+        annotation_type_ids = list(annotation_type_ids)
+        if annotation_type_ids:
+            type_filter = "sa.%s IN (%s)" % (
+                qn(annotation.get_field('annotation_type').column),
+                ', '.join(['%s'] * len(annotation_type_ids)))
+        else:
+            type_filter = "1 = 0"
+        sql = ("SELECT es.{experiment}, s.id, s.name, s.ml_data_source, "
+               "sa.{annotation_type}, sa.text "
+               "FROM {through} es "
+               "INNER JOIN {sample_table} s ON s.id = es.{sample} "
+               "LEFT OUTER JOIN {annotation} sa "
+               "ON sa.{annotation_sample} = s.id AND {type_filter} "
+               "ORDER BY es.{experiment}, s.id").format(
+            experiment=qn(through.get_field('experiment').column),
+            sample=qn(through.get_field('sample').column),
+            through=qn(through.db_table),
+            sample_table=qn(Sample._meta.db_table),
+            annotation_type=qn(
+                annotation.get_field('annotation_type').column),
+            annotation=qn(annotation.db_table),
+            annotation_sample=qn(annotation.get_field('sample').column),
+            type_filter=type_filter)
+
+        current_key = None
+        for (accession, sample_id, name, ml_data_source, type_id,
+                text) in iter_query(sql, annotation_type_ids):
+            if (accession, sample_id) != current_key:
+                if current_key is not None:
+                    yield current
+                current_key = (accession, sample_id)
+                current = (accession, name, ml_data_source, {})
+            if type_id is not None:
+                current[3][type_id] = text
+        if current_key is not None:
+            yield current
+
 
 class SampleAnnotation(models.Model):
     annotation_type = models.ForeignKey(
@@ -151,6 +262,13 @@ class MLModel(models.Model):
     g2g_edge_cutoff = models.FloatField(default=0.0)
     desc_html = models.CharField(max_length=2048, blank=True)
 
+    # Only published models (and their signatures, activity, edges and
+    # participations) are served by the API.  A model can be added
+    # unpublished ("staged"), loaded and validated while the API keeps
+    # serving the published ones, and then published in one short
+    # transaction (see the "publish_ml_model" management command).
+    published = models.BooleanField(default=True)
+
     def __unicode__(self):
         edge_info = "directed" if self.directed_g2g_edge else "undirected"
         return ("MLModel %s of organism %s with %s gene-gene edges" %
@@ -252,3 +370,24 @@ class ExpressionValue(models.Model):
     def __unicode__(self):
         return "Expression value %f for Sample %s and Gene %s" % (
             self.value, self.sample.name, self.gene.entrezid)
+
+
+@receiver([post_save, post_delete], sender=Experiment)
+@receiver([post_save, post_delete], sender=Sample)
+@receiver([post_save, post_delete], sender=AnnotationType)
+@receiver([post_save, post_delete], sender=SampleAnnotation)
+@receiver(m2m_changed, sender=Sample.experiments.through)
+def bump_annotations_version(sender, **kwargs):
+    """
+    Invalidate the cached annotation files (see
+    SampleResource.get_annotations) whenever a change of an experiment,
+    sample or annotation through the ORM (e.g. in the admin site) has
+    been committed (see data_version.py).  Bulk imports that bypass
+    these signals bump the version themselves.
+    """
+    if kwargs.get('raw'):  # loading fixtures
+        return
+    try:
+        bump_data_version_on_commit(ANNOTATIONS)
+    except (IOError, OSError) as e:
+        logger.warning("Failed to bump the annotations data version: %s", e)
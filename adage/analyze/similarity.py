@@ -0,0 +1,252 @@
+"""
+Similarity of samples and of signatures, precomputed per MLModel.
+
+The activity profile of a sample is its row of the ActivityMatrixStore
+of an MLModel (one value per signature).  Profiles are normalized once,
+when the model's SampleSimilarityStore is built: each one is centered on
+its mean and scaled to unit length, so the dot product of two profiles
+is their Pearson correlation.  Missing values count as the sample's mean
+activity.
+
+The store wraps the normalized profiles in an index whose search()
+method returns the k most similar samples of a batch of query profiles.
+ExactIndex multiplies the queries by blocks of the (memory-mapped)
+profiles, which takes milliseconds for a compendium of thousands of
+samples.  An approximate index (e.g. one based on random projections or
+a graph) can replace it by implementing the same search() method and
+being set as the "index_class" of SampleSimilarityStore.
+
+SignatureCorrelationStore holds three signatures x signatures matrices
+of a model: the Pearson and Spearman correlations of the signatures'
+activity across samples, and the Jaccard index of their sets of
+participating genes.  They are computed in float32 blocks of
+SEARCH_BLOCK_SIZE rows, which takes a few seconds per model, so the
+signatures related to any signature are read from one row of each
+matrix.
+"""
+
+import numpy as np
+from scipy import sparse, stats
+from models import Participation
+from matrix_store import (
+    ArrayStore, DenseMatrix, ActivityMatrixStore, records_to_columns)
+
+# Number of profiles multiplied by the queries at a time.
+SEARCH_BLOCK_SIZE = 8192
+
+
+def normalize_profiles(values):
+    """
+    Return the rows of the 2-D array "values" centered on their means
+    (ignoring NaN values, which are then set to 0) and scaled to unit
+    length, as a float32 array.  Rows that are constant stay all zeros.
+    """
+    values = np.array(values, dtype=np.float64)
+    if values.size == 0:
+        return values.astype(np.float32)
+    missing = np.isnan(values)
+    counts = (~missing).sum(axis=1)
+    values[missing] = 0.0
+    means = values.sum(axis=1) / np.maximum(counts, 1)
+    values -= means[:, np.newaxis]
+    values[missing] = 0.0
+    norms = np.sqrt((values * values).sum(axis=1))
+    norms[norms == 0] = 1.0
+    return (values / norms[:, np.newaxis]).astype(np.float32)
+
+
+def correlation_matrix(vectors):
+    """
+    Return the float32 matrix of the dot products of all pairs of rows of
+    "vectors" (their correlations if they were normalized by
+    normalize_profiles()), computed SEARCH_BLOCK_SIZE rows at a time.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    result = np.empty((len(vectors), len(vectors)), dtype=np.float32)
+    for start in xrange(0, len(vectors), SEARCH_BLOCK_SIZE):
+        stop = start + SEARCH_BLOCK_SIZE
+        result[start:stop] = np.dot(vectors[start:stop], vectors.T)
+    return result
+
+
+def rank_columns(values):
+    """
+    Replace the values of each column of the 2-D array "values" by their
+    ranks (ties get their average rank); NaN values stay NaN.
+    """
+    ranks = np.full(values.shape, np.nan)
+    for j in xrange(values.shape[1]):
+        column = values[:, j]
+        valid = ~np.isnan(column)
+        ranks[valid, j] = stats.rankdata(column[valid])
+    return ranks
+
+
+def jaccard_matrix(set_positions, member_positions, num_sets):
+    """
+    Return the float32 matrix of the Jaccard indexes of all pairs of
+    "num_sets" sets, whose (set position, member position) pairs are
+    given by the two arrays.  The index of two empty sets is 0.
+    """
+    num_members = member_positions.max() + 1 if len(member_positions) else 0
+    membership = sparse.csr_matrix(
+        (np.ones(len(set_positions), dtype=np.int32),
+         (set_positions, member_positions)), shape=(num_sets, num_members))
+    membership.data[:] = 1  # in case a pair was given twice
+    intersections = (membership * membership.T).toarray()
+    sizes = np.diag(intersections)
+    unions = sizes[:, np.newaxis] + sizes[np.newaxis, :] - intersections
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(unions > 0, intersections / unions.astype(
+            np.float64), 0).astype(np.float32)
+
+
+class ExactIndex(object):
+    """
+    Exact nearest-neighbor index of the normalized profiles "vectors"
+    (one row per ID in the sorted array "ids").
+    """
+    def __init__(self, ids, vectors):
+        self.ids = ids
+        self.vectors = vectors
+
+    def positions(self, ids):
+        """
+        Return the positions of "ids" in the index, and a boolean mask of
+        the ids that were found.
+        """
+        return DenseMatrix._positions(self.ids, ids)
+
+    def search(self, queries, k, exclude=None):
+        """
+        Return (positions, similarities) of the k profiles that are most
+        similar to each row of the 2-D array "queries", as two arrays of
+        shape (len(queries), k) sorted by decreasing similarity.
+        exclude[i] (if not None) is a position that is never returned for
+        query i, e.g. the position of the query itself.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        num_queries = len(queries)
+        k = min(k, len(self.ids) - (exclude is not None))
+        if k <= 0:
+            return (np.empty((num_queries, 0), dtype=np.int64),
+                    np.empty((num_queries, 0), dtype=np.float32))
+        best = np.empty((num_queries, 0), dtype=np.int64)
+        best_scores = np.empty((num_queries, 0), dtype=np.float32)
+        rows = np.arange(num_queries)[:, np.newaxis]
+        for start in xrange(0, len(self.ids), SEARCH_BLOCK_SIZE):
+            block = self.vectors[start:start + SEARCH_BLOCK_SIZE]
+            scores = np.dot(queries, block.T)
+            if exclude is not None:
+                in_block = (exclude >= start) & (exclude < start + len(block))
+                scores[in_block, exclude[in_block] - start] = -np.inf
+            candidates = np.hstack((
+                best, np.broadcast_to(np.arange(start, start + len(block)),
+                                      scores.shape)))
+            scores = np.hstack((best_scores, scores))
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                candidates, scores = candidates[rows, top], scores[rows, top]
+            best, best_scores = candidates, scores
+        order = np.argsort(-best_scores, axis=1, kind='mergesort')
+        return best[rows, order], best_scores[rows, order]
+
+
+class SampleSimilarityStore(ArrayStore):
+    """
+    Normalized activity profiles of the samples of one MLModel, wrapped
+    in an "index_class" index.  It is built from the model's
+    ActivityMatrixStore (or from the database if that store has not been
+    built).
+    """
+    subdir = 'sample_similarity'
+    mmap_arrays = ('vectors', )
+    index_class = ExactIndex
+
+    def __init__(self, mlmodel_id):
+        super(SampleSimilarityStore, self).__init__(int(mlmodel_id))
+
+    def read_arrays(self):
+        activity_store = ActivityMatrixStore(self.key)
+        matrix = activity_store.load() or activity_store.read_matrix()
+        return {'sample_ids': matrix.row_ids,
+                'vectors': normalize_profiles(matrix.values)}
+
+    def wrap(self, arrays):
+        return self.index_class(arrays['sample_ids'], arrays['vectors'])
+
+
+class SignatureCorrelations(object):
+    """
+    Pearson and Spearman correlation and Jaccard index matrices of the
+    signatures "signature_ids" (a sorted array) of one MLModel.
+    """
+    measures = ('pearson', 'spearman', 'jaccard')
+
+    def __init__(self, signature_ids, pearson, spearman, jaccard):
+        self.signature_ids = signature_ids
+        self.pearson = pearson
+        self.spearman = spearman
+        self.jaccard = jaccard
+
+    def related(self, signature_id, k, measure='pearson'):
+        """
+        Return the position of signature_id and the positions of the k
+        other signatures with the largest "measure" with it, sorted by
+        decreasing measure, or (None, None) if signature_id is unknown.
+        """
+        positions, found = DenseMatrix._positions(self.signature_ids,
+                                                  [signature_id])
+        if not found[0]:
+            return None, None
+        position = positions[0]
+        row = np.array(getattr(self, measure)[position], dtype=np.float64)
+        row[position] = -np.inf
+        row[np.isnan(row)] = -np.inf
+        k = min(k, len(row) - 1)
+        if k <= 0:
+            return position, np.empty(0, dtype=np.int64)
+        top = np.argpartition(-row, k - 1)[:k]
+        return position, top[np.argsort(-row[top], kind='mergesort')]
+
+
+class SignatureCorrelationStore(ArrayStore):
+    """
+    SignatureCorrelations of one MLModel.  The correlations are computed
+    from the model's ActivityMatrixStore (or from the database if that
+    store has not been built), and the Jaccard indexes from the
+    "Participation" table.
+    """
+    subdir = 'signature_correlation'
+    mmap_arrays = SignatureCorrelations.measures
+
+    def __init__(self, mlmodel_id):
+        super(SignatureCorrelationStore, self).__init__(int(mlmodel_id))
+
+    def read_arrays(self):
+        activity_store = ActivityMatrixStore(self.key)
+        matrix = activity_store.load() or activity_store.read_matrix()
+        signature_ids = matrix.col_ids
+        values = np.asarray(matrix.values, dtype=np.float64)
+
+        signatures, genes = records_to_columns(
+            Participation.objects.filter(
+                signature__mlmodel=self.key).values_list(
+                    'signature_id', 'gene_id').distinct().iterator(),
+            (np.int64, np.int64))
+        set_positions, found = DenseMatrix._positions(signature_ids,
+                                                      signatures)
+        gene_positions = np.unique(genes[found], return_inverse=True)[1]
+        return {
+            'signature_ids': signature_ids,
+            'pearson': correlation_matrix(normalize_profiles(values.T)),
+            'spearman': correlation_matrix(
+                normalize_profiles(rank_columns(values).T)),
+            'jaccard': jaccard_matrix(set_positions[found], gene_positions,
+                                      len(signature_ids)),
+        }
+
+    def wrap(self, arrays):
+        return SignatureCorrelations(arrays['signature_ids'],
+                                     arrays['pearson'], arrays['spearman'],
+                                     arrays['jaccard'])
@@ -0,0 +1,125 @@
+"""
+Vectorized statistical functions used by the API.  Every function here
+operates on whole NumPy arrays at once (e.g. all signatures of a model
+in a single call) instead of looping over individual tests in Python.
+"""
+
+import warnings
+import numpy as np
+from scipy import stats
+from scipy.special import gammaln, logsumexp
+
+
+def welch_ttest(base, comp):
+    """
+    Column-wise two-sample Welch's t-test (unequal variances).
+
+    "base" and "comp" are 2-D arrays whose rows are samples and whose
+    columns are the variables being tested (signatures, genes, etc.), so
+    that both arrays must have the same number of columns.  Missing
+    values (NaN) are ignored.
+
+    Return a tuple of three 1-D arrays (one element per column):
+    (mean(base) - mean(comp), t statistic, two-sided p-value).  The t
+    statistic and p-value are NaN where the test is undefined: fewer
+    than two values in a group, or zero variance in both groups.  The
+    latter case is NaN even when the means differ, where the formula
+    would give an infinite t statistic and a p-value of 0.
+    """
+    base = np.asarray(base, dtype=np.float64)
+    comp = np.asarray(comp, dtype=np.float64)
+    # nanmean() and nanvar() warn about empty or single-value columns; those
+    # columns legitimately produce NaN, which is what we want to return.
+    with warnings.catch_warnings(), np.errstate(divide='ignore',
+                                                invalid='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        n1 = np.sum(~np.isnan(base), axis=0)
+        n2 = np.sum(~np.isnan(comp), axis=0)
+        mean1 = np.nanmean(base, axis=0)
+        mean2 = np.nanmean(comp, axis=0)
+        se1 = np.nanvar(base, axis=0, ddof=1) / n1
+        se2 = np.nanvar(comp, axis=0, ddof=1) / n2
+        se = se1 + se2
+        diff = mean1 - mean2
+        t = diff / np.sqrt(se)
+        # Two constant groups carry no evidence about the variance, so
+        # don't report them as infinitely significant.
+        t[se == 0] = np.nan
+        # Welch-Satterthwaite approximation of the degrees of freedom
+        df = se ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+        pvalues = 2.0 * stats.t.sf(np.abs(t), df)
+    return diff, t, pvalues
+
+
+def fdr_correction(pvalues):
+    """
+    Benjamini-Hochberg false discovery rate adjustment of "pvalues".
+    NaN p-values are left as NaN and do not count toward the number of
+    tests.  Return an array of adjusted p-values in the input order.
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    adjusted = np.full(pvalues.shape, np.nan)
+    valid = ~np.isnan(pvalues)
+    p = pvalues[valid]
+    n = p.size
+    if n == 0:
+        return adjusted
+    # Walk the p-values from largest to smallest so that the running
+    # minimum enforces monotonicity of the adjusted values.
+    order = np.argsort(p)[::-1]
+    ranked = p[order] * n / np.arange(n, 0, -1)
+    ranked = np.minimum.accumulate(ranked)
+    p_adjusted = np.empty(n)
+    # Clipping at the raw p-values keeps rounding errors (p * n / n) from
+    # making an adjusted p-value smaller than its raw one.
+    p_adjusted[order] = np.clip(ranked, p[order], 1.0)
+    adjusted[valid] = p_adjusted
+    return adjusted
+
+
+def log_binomial(n, k):
+    """Natural logarithm of the binomial coefficient C(n, k)."""
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeometric_sf(overlap, successes, draws, population):
+    """
+    Upper tail P(X >= overlap) of the hypergeometric distribution, i.e.
+    the one-sided p-value of an overlap of at least "overlap" items when
+    "draws" items are drawn (e.g. a gene list) from a population of
+    "population" items, "successes" of which are marked (e.g. the genes
+    of a signature).  The arguments are broadcast against each other, so
+    a whole array of overlaps and successes (one per signature) can be
+    tested in one call.
+
+    Every term of the tail is computed from log-gamma functions, and the
+    terms of all tests are laid out in one 2-D array and summed with
+    logsumexp(), so no Python loop runs per test or per term.
+    """
+    k, n, N, M = np.broadcast_arrays(
+        *[np.asarray(a, dtype=np.float64)
+          for a in (overlap, successes, draws, population)])
+    if k.size == 0:
+        return np.zeros(k.shape)
+    # The support of X is [max(0, N + n - M), min(n, N)].
+    start = np.maximum(k, np.maximum(0, N + n - M))
+    stop = np.minimum(n, N)
+    num_terms = int(max(0, np.max(stop - start))) + 1
+    i = start[..., np.newaxis] + np.arange(num_terms)
+    with np.errstate(invalid='ignore'):
+        log_terms = (log_binomial(n[..., np.newaxis], i) +
+                     log_binomial((M - n)[..., np.newaxis],
+                                  N[..., np.newaxis] - i) -
+                     log_binomial(M, N)[..., np.newaxis])
+    log_terms[i > stop[..., np.newaxis]] = -np.inf
+    with np.errstate(divide='ignore'):
+        pvalues = np.exp(logsumexp(log_terms, axis=-1))
+    return np.clip(pvalues, 0.0, 1.0)
+
+
+def nan_to_none(values):
+    """
+    Convert a NumPy array into a list of Python floats with NaN (and
+    infinite) values replaced by None, so the result is JSON-safe.
+    """
+    return [float(v) if np.isfinite(v) else None for v in values]
@@ -7,13 +7,20 @@ import random
 import re
 import sys
 import codecs
+import bz2
+import gzip
+import io
+import json
+import shutil
+import tempfile
 import unittest
 from copy import deepcopy
+from collections import namedtuple
 
 from django.db.models import Q
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 from django.test.utils import override_settings
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
 from django.conf import settings
 from organisms.models import Organism
 from genes.models import Gene
@@ -21,8 +28,11 @@ from analyze.models import (
     Experiment, Sample, AnnotationType, SampleAnnotation, MLModel, Signature,
     Activity, Edge, Participation, ParticipationType, ExpressionValue)
 from analyze.management.commands.import_data import (
-    bootstrap_database, JSON_CACHE_FILE_NAME)
+    bootstrap_database, JSON_CACHE_FILE_NAME, collect_samples,
+    write_bootstrap_data)
 from datetime import datetime
+from scipy import stats
+import numpy
 from tastypie.test import ResourceTestCaseMixin
 from fixtureless import Factory
 import haystack
@@ -35,11 +45,46 @@ logger = logging.getLogger(__name__)
 factory = Factory()
 
 from adage.settings import CONFIG
-from analyze.api import SampleResource
+from analyze.api import (
+    SampleResource, ActivityResource, EdgeResource, ExpressionValueResource,
+    SearchResource, SearchResultList)
+from tastypie.paginator import Paginator
+from tastypie.resources import ModelResource
+from analyze.matrix_store import (
+    ActivityMatrixStore, GeneNetworkStore, ExpressionMatrixStore)
+from analyze.similarity import (
+    SampleSimilarityStore, SignatureCorrelationStore)
+from analyze.stats import welch_ttest
+from analyze.management.commands.import_activity import import_activity
+from analyze.management.commands.publish_ml_model import (
+    publish_ml_model, delete_in_batches)
+from analyze.management.commands.import_gene_sample_expr import import_expr
+from analyze.management.commands.import_gene_network import import_network
+from analyze.management.commands.import_signature_gene_network import (
+    import_network as import_participations)
+from analyze.management.commands._bulk_loader import copy_text
+from analyze.management.commands._input import open_input
+from analyze.data_version import (
+    get_data_version, bump_pending_data_versions, ANNOTATIONS)
 
 
 TEST_INDEX = deepcopy(settings.HAYSTACK_CONNECTIONS)
 TEST_INDEX['default']['INDEX_NAME'] = 'test_index'
+# Tests that rely on Elasticsearch are skipped with other search backends.
+USES_ELASTICSEARCH = 'elasticsearch' in TEST_INDEX['default']['ENGINE'].lower()
+
+
+def response_content(resp):
+    """
+    Return the body of "resp", which may be a streaming response (such
+    as a FlatValuesResource list).  A streaming body can only be read
+    once, so it is kept on the response.
+    """
+    if not resp.streaming:
+        return resp.content
+    if not hasattr(resp, 'streamed_content'):
+        resp.streamed_content = b''.join(resp.streaming_content)
+    return resp.streamed_content
 
 
 class ModelsTestCase(TestCase):
@@ -169,7 +214,7 @@ class ModelsTestCase(TestCase):
         if MLModel.objects.exists():
             ml_model = MLModel.objects.first()
         else:
-            ml_model = factory.create(MLModel)
+            ml_model = factory.create(MLModel, {'published': True})
 
         # Create genes:
         for i in range(gene_counter):
@@ -223,7 +268,7 @@ class ModelsTestCase(TestCase):
         if MLModel.objects.exists():
             ml_model = MLModel.objects.first()
         else:
-            ml_model = factory.create(MLModel)
+            ml_model = factory.create(MLModel, {'published': True})
 
         if ParticipationType.objects.exists():
             participation_type = ParticipationType.objects.first()
@@ -353,7 +398,8 @@ class BootstrapDBTestCase(TestCase):
             'temperature', 'od', 'additional_notes', 'description',
         ]
         )
-        db_export = raw_export.content.decode(raw_export.charset).splitlines()
+        db_export = b''.join(raw_export.streaming_content).decode(
+            raw_export.charset).splitlines()
 
         self.maxDiff = None     # report all diffs to be most helpful
         self.assertItemsEqual(db_export, db_import)
@@ -385,8 +431,24 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         """
         return random.choice(ModelName.objects.all())
 
+    def assertValidJSONResponse(self, resp):
+        # Same as ResourceTestCaseMixin's, for streaming responses too.
+        self.assertHttpOK(resp)
+        self.assertTrue(resp['Content-Type'].startswith('application/json'))
+        self.assertValidJSON(response_content(resp).decode('utf-8'))
+
+    def deserialize(self, resp):
+        return self.serializer.deserialize(response_content(resp),
+                                           format=resp['Content-Type'])
+
     def setUp(self):
         super(APIResourceTestCase, self).setUp()
+        # keep cached annotation files out of settings.DATA_CACHE_DIR
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            DATA_CACHE_DIR=self.cache_dir)
+        self.settings_override.enable()
+
         # create a test experiment to retrive with the API
         self.test_experiment = ModelsTestCase.experiment_data
         ModelsTestCase.create_test_experiment(
@@ -453,6 +515,11 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         # Define the URI for testing ExpressionValue APIs
         self.expressionvalueURI = self.baseURI + 'expressionvalue/'
 
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_dir)
+        super(APIResourceTestCase, self).tearDown()
+
     @staticmethod
     def create_activities(signature_counter):
         """Create activity related records.  "signature_counter" is the
@@ -603,8 +670,14 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         """
         self.call_non_get_API(self.get_experiment_URI)
 
+    @staticmethod
+    def get_annotations_rows(resp):
+        # get_annotations returns a StreamingHttpResponse
+        return b''.join(resp.streaming_content).decode(
+            resp.charset).splitlines()
+
     def check_annotations_param(self, resp, atypes):
-        rows = resp.content.decode(resp.charset).splitlines()
+        rows = self.get_annotations_rows(resp)
 
         # we should get back a row for each sample we've created (+1 = header)
         self.assertEqual(len(rows), self.s_counter + 1)
@@ -633,7 +706,7 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         self.check_annotations_param(resp, atypes)
 
     def check_annotations_default(self, resp):
-        rows = resp.content.decode(resp.charset).splitlines()
+        rows = self.get_annotations_rows(resp)
 
         # we should get back a row for each sample we've created (+1 = header)
         self.assertEqual(len(rows), self.s_counter + 1)
@@ -660,6 +733,110 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
             self.baseURI + 'sample/get_annotations/')
         self.check_annotations_default(resp)
 
+    def test_get_annotations_conditional(self):
+        """
+        get_annotations sets ETag and Last-Modified headers and answers
+        conditional requests with 304 until the annotations change.
+        """
+        uri = self.baseURI + 'sample/get_annotations/'
+        resp = self.api_client.get(uri)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        self.assertIn('Last-Modified', resp)
+        self.assertIn('Accept-Encoding', resp['Vary'])
+
+        resp = self.api_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], etag)
+        resp = self.api_client.get(uri, HTTP_IF_MODIFIED_SINCE=resp[
+            'Last-Modified'])
+        self.assertEqual(resp.status_code, 304)
+        # other annotation types are a different file
+        resp = self.api_client.get(
+            uri, data={'annotation_types': 'type name & two'},
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+        # any change of the annotations invalidates the cached file, once
+        # its transaction (here, the one of the test) has been committed
+        version = get_data_version(ANNOTATIONS)
+        sample = factory.create(Sample)
+        sample.experiments.add(Experiment.objects.first())
+        self.assertEqual(get_data_version(ANNOTATIONS), version)
+        bump_pending_data_versions()
+        self.assertNotEqual(get_data_version(ANNOTATIONS), version)
+        resp = self.api_client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(len(self.get_annotations_rows(resp)),
+                         self.s_counter + 2)
+        # and only the files of the current data version are kept
+        self.assertEqual(len(os.listdir(
+            os.path.join(self.cache_dir, 'annotations'))), 1)
+
+    def test_get_annotations_file_removed(self):
+        """
+        A request keeps reading its annotation file when another request
+        removes it, and a file removed before it is opened is generated
+        again.
+        """
+        uri = self.baseURI + 'sample/get_annotations/'
+        expected = self.get_annotations_rows(self.api_client.get(uri))
+        cache_dir = os.path.join(self.cache_dir, 'annotations')
+        types = [at.typename
+                 for at in AnnotationType.objects.order_by('typename')]
+
+        annotations_file = SampleResource.open_annotations_file(types)[0]
+        for name in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, name))
+        with gzip.GzipFile(fileobj=annotations_file) as gzip_file:
+            self.assertEqual(gzip_file.read().decode('utf-8').splitlines(),
+                             expected)
+        annotations_file.close()
+
+        self.assertEqual(self.get_annotations_rows(self.api_client.get(uri)),
+                         expected)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_get_annotations_gzip(self):
+        """
+        Clients that accept gzip encoding get the cached compressed file.
+        """
+        uri = self.baseURI + 'sample/get_annotations/'
+        plain = self.get_annotations_rows(self.api_client.get(uri))
+        resp = self.api_client.get(uri, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        with gzip.GzipFile(fileobj=io.BytesIO(
+                b''.join(resp.streaming_content))) as gzip_file:
+            self.assertEqual(gzip_file.read().decode('utf-8').splitlines(),
+                             plain)
+
+    def test_get_annotations_content(self):
+        """
+        Test that get_annotations reports the experiment, sample and
+        annotations of every (experiment, sample) pair.
+        """
+        exp2 = self.create_extra_experiments()
+        sample = Sample.objects.first()
+        atypes = [at.typename
+                  for at in random.sample(AnnotationType.objects.all(), 2)]
+        SampleAnnotation.objects.create_from_dict(
+            sample, {atypes[1]: 'some\u00e9 text'})
+        resp = SampleResource.get_annotations(
+            annotation_types=atypes + ['unknown_type'])
+        rows = self.get_annotations_rows(resp)
+        # the first sample belongs to two experiments
+        self.assertEqual(len(rows), self.s_counter + 2)
+        sample_rows = [row.split('\t') for row in rows[1:]
+                       if row.split('\t')[1] == sample.name]
+        self.assertEqual(sorted(row[0] for row in sample_rows), sorted([
+            ModelsTestCase.experiment_data['accession'], exp2.accession]))
+        for row in sample_rows:
+            self.assertEqual(row[2:], [sample.ml_data_source or '', '',
+                                       'some\u00e9 text', ''])
+
     def test_activity_get(self):
         """
         Test GET method via 'activity/<pk>/' API.
@@ -705,6 +882,239 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         # Test non-GET methods
         self.call_non_get_API(uri, data=data)
 
+    def test_activity_volcano(self):
+        """
+        Test "activity/volcano/?mlmodel=<ml_id>&base_group=...&comp_group=..."
+        API against per-signature t-tests computed with SciPy.
+        """
+        uri = self.baseURI + "activity/volcano/"
+        mlmodel = self.random_object(MLModel)
+        sample_ids = list(Sample.objects.values_list('id', flat=True))
+        base_ids, comp_ids = sample_ids[:10], sample_ids[10:]
+        data = {
+            'mlmodel': mlmodel.id,
+            'base_group': ','.join(str(id) for id in base_ids),
+            'comp_group': ','.join(str(id) for id in comp_ids),
+        }
+        resp = self.api_client.get(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        records = self.deserialize(resp)['objects']
+        self.assertEqual(len(records), self.signature_counter // 2)
+
+        for record in records:
+            signature = Signature.objects.get(pk=record['signature'])
+            self.assertEqual(signature.mlmodel, mlmodel)
+            self.assertEqual(signature.name, record['name'])
+            base = [a.value for a in Activity.objects.filter(
+                signature=signature, sample__in=base_ids)]
+            comp = [a.value for a in Activity.objects.filter(
+                signature=signature, sample__in=comp_ids)]
+            t, p = stats.ttest_ind(base, comp, equal_var=False)
+            self.assertAlmostEqual(
+                record['diff'], sum(base) / len(base) - sum(comp) / len(comp))
+            self.assertAlmostEqual(record['pvalue'], p)
+            self.assertGreaterEqual(record['adj_pvalue'], record['pvalue'])
+
+        # POST should return the same result as GET.
+        resp = self.api_client.client.post(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        self.assertEqual(self.deserialize(resp)['objects'], records)
+
+        # Unknown and staged mlmodels are rejected.
+        staged = MLModel.objects.create(title="staged model", published=False,
+                                        organism=mlmodel.organism)
+        for mlmodel_id in (MLModel.objects.latest('id').id + 1, staged.id):
+            resp = self.api_client.get(uri, data=dict(data,
+                                                      mlmodel=mlmodel_id))
+            self.assertHttpBadRequest(resp)
+
+        # Both groups are required.
+        del data['comp_group']
+        resp = self.api_client.get(uri, data=data)
+        self.assertHttpBadRequest(resp)
+
+    def test_welch_ttest_constant_groups(self):
+        """
+        Test that welch_ttest() returns NaN, not p=0, for two constant
+        groups, whether or not their means differ.
+        """
+        base = [[1.0, 1.0, 1.0], [1.0, 1.0, 2.0]]
+        comp = [[2.0, 1.0, 1.0], [2.0, 1.0, 3.0]]
+        diff, t, pvalues = welch_ttest(base, comp)
+        self.assertEqual(diff[0], -1.0)
+        self.assertTrue(numpy.isnan(t[:2]).all())
+        self.assertTrue(numpy.isnan(pvalues[:2]).all())
+        self.assertAlmostEqual(pvalues[2], stats.ttest_ind(
+            [1.0, 2.0], [1.0, 3.0], equal_var=False)[1])
+
+    def test_sample_similar(self):
+        """
+        Test "sample/<id>/similar/?mlmodel=<ml_id>" and
+        "sample/similar/?mlmodel=<ml_id>&samples=..." APIs against the
+        Pearson correlations of activity profiles computed with NumPy.
+        """
+        mlmodel = self.random_object(MLModel)
+        sample_ids = sorted(Sample.objects.values_list('id', flat=True))
+        signature_ids = sorted(Signature.objects.filter(
+            mlmodel=mlmodel).values_list('id', flat=True))
+        correlations = numpy.corrcoef(ActivityResource.get_activity_matrix(
+            mlmodel.id, sample_ids, signature_ids))
+
+        def check_similar(position, records, k):
+            # The most similar sample is the query sample itself.
+            expected = numpy.argsort(-correlations[position])[1:k + 1]
+            self.assertEqual([record['sample'] for record in records],
+                             [sample_ids[i] for i in expected])
+            for record, i in zip(records, expected):
+                self.assertAlmostEqual(record['similarity'],
+                                       correlations[position, i], places=5)
+
+        # Nothing is searched without a SampleSimilarityStore.
+        uri = self.baseURI + "sample/%d/similar/" % sample_ids[3]
+        resp = self.api_client.get(uri, data={'mlmodel': mlmodel.id})
+        self.assertEqual(resp.status_code, 503)
+
+        SampleSimilarityStore(mlmodel.id).build()
+        resp = self.api_client.get(uri, data={'mlmodel': mlmodel.id})
+        self.assertValidJSONResponse(resp)
+        check_similar(3, self.deserialize(resp)['objects'], 10)
+
+        uri = self.baseURI + "sample/similar/"
+        data = {'mlmodel': mlmodel.id, 'k': 5,
+                'samples': "%d,%d" % (sample_ids[3], sample_ids[7])}
+        resp = self.api_client.client.post(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        records = self.deserialize(resp)['objects']
+        self.assertEqual([record['sample'] for record in records],
+                         [sample_ids[3], sample_ids[7]])
+        check_similar(3, records[0]['similar'], 5)
+        check_similar(7, records[1]['similar'], 5)
+
+        uri = self.baseURI + "sample/%d/similar/" % (sample_ids[-1] + 1)
+        resp = self.api_client.get(uri, data={'mlmodel': mlmodel.id})
+        self.assertHttpNotFound(resp)
+        uri = self.baseURI + "sample/%d/similar/" % sample_ids[3]
+        for params in ({}, {'mlmodel': mlmodel.id, 'k': 0}):
+            self.assertHttpBadRequest(self.api_client.get(uri, data=params))
+
+    def test_activity_columnar_formats(self):
+        """
+        Test "activity/?format=columnar" and "activity/?format=npy" APIs
+        against the default JSON format.
+        """
+        uri = self.baseURI + "activity/"
+        data = {
+            'mlmodel': str(self.random_object(MLModel).id),
+            'order_by': 'signature',
+        }
+        resp = self.api_client.get(uri, data=data)
+        expected = self.deserialize(resp)['objects']
+
+        data['format'] = 'columnar'
+        resp = self.client.get(uri, data=data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('application/json'))
+        columns = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual(columns['meta']['total_count'], len(expected))
+        self.assertEqual(columns['sample'], [a['sample'] for a in expected])
+        self.assertEqual(columns['signature'],
+                         [a['signature'] for a in expected])
+        self.assertEqual(columns['value'], [a['value'] for a in expected])
+
+        data['format'] = 'npy'
+        resp = self.client.get(uri, data=data)
+        self.assertEqual(resp.status_code, 200)
+        records = numpy.load(io.BytesIO(resp.content))
+        self.assertEqual(records.dtype.names, ('sample', 'signature', 'value'))
+        self.assertEqual(records['sample'].tolist(), columns['sample'])
+        self.assertEqual(records['signature'].tolist(), columns['signature'])
+        self.assertEqual(records['value'].tolist(), columns['value'])
+
+        # Both formats honor the pagination parameters.  (The signatures
+        # of one sample are unique, so the order of the pages is fixed.)
+        data.update({'sample': self.random_object(Sample).id,
+                     'format': 'columnar'})
+        resp = self.client.get(uri, data=data)
+        full = json.loads(b''.join(resp.streaming_content))
+        data.update({'limit': 3, 'offset': 2})
+        resp = self.client.get(uri, data=data)
+        columns = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual(columns['meta']['total_count'],
+                         full['meta']['total_count'])
+        self.assertEqual(columns['signature'], full['signature'][2:5])
+        data['format'] = 'npy'
+        resp = self.client.get(uri, data=data)
+        records = numpy.load(io.BytesIO(resp.content))
+        self.assertEqual(records['signature'].tolist(), columns['signature'])
+
+    def check_flat_values_list(self, resource, data):
+        """
+        Helper method: asserts that the list built by "resource" (a
+        FlatValuesResource) from the GET parameters in "data" matches the
+        list built by Tastypie's ModelResource.get_list().
+        """
+        request = RequestFactory().get(
+            self.baseURI + resource._meta.resource_name + '/', data=data)
+        expected = json.loads(
+            ModelResource.get_list(resource, request).content)
+        actual = json.loads(response_content(resource.get_list(request)))
+        self.assertEqual(actual, expected)
+        return actual
+
+    def test_flat_values_lists(self):
+        """
+        Test that the lists built by FlatValuesResource subclasses match
+        the lists built by Tastypie.
+        """
+        mlmodel = self.random_object(MLModel).id
+        result = self.check_flat_values_list(ActivityResource(), {
+            'mlmodel': mlmodel, 'order_by': 'signature'})
+        self.assertEqual(len(result['objects']),
+                         Activity.objects.filter(
+                             signature__mlmodel=mlmodel).count())
+        # Pagination parameters are honored too.
+        result = self.check_flat_values_list(ActivityResource(), {
+            'sample__in': ','.join(
+                str(s.id) for s in random.sample(Sample.objects.all(), 3)),
+            'limit': 7, 'offset': 5})
+        self.assertEqual(len(result['objects']), 7)
+        self.assertIsNotNone(result['meta']['next'])
+
+        ModelsTestCase.create_edges(100, 10, 10)
+        self.check_flat_values_list(EdgeResource(), {
+            'genes': Gene.objects.first().id, 'order_by': '-weight'})
+
+        sample = self.random_object(Sample)
+        for gene in Gene.objects.all()[:20]:
+            ExpressionValue.objects.create(sample=sample, gene=gene,
+                                           value=random.random())
+        result = self.check_flat_values_list(ExpressionValueResource(), {
+            'sample': sample.id})
+        self.assertEqual(len(result['objects']), 20)
+
+    def test_flat_values_non_finite(self):
+        """
+        Test that FlatValuesResource lists NaN and infinite values as null
+        in the default and columnar JSON formats.
+        """
+        sample = self.random_object(Sample)
+        values = [float('nan'), float('inf'), float('-inf'), 0.5]
+        for gene, value in zip(Gene.objects.order_by('id'), values):
+            ExpressionValue.objects.create(sample=sample, gene=gene,
+                                           value=value)
+        uri = self.baseURI + "expressionvalue/"
+        data = {'sample': sample.id, 'order_by': 'gene'}
+        resp = self.api_client.get(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        records = self.deserialize(resp)['objects']
+        self.assertEqual([v['value'] for v in records],
+                         [None, None, None, 0.5])
+
+        data['format'] = 'columnar'
+        resp = self.client.get(uri, data=data)
+        columns = json.loads(b''.join(resp.streaming_content))
+        self.assertEqual(columns['value'], [None, None, None, 0.5])
+
     def test_one_edge(self):
         """
         Test GET, POST, PUT, PATCH and DELETE methods via
@@ -881,6 +1291,164 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
 
         self.call_non_get_API(uri, data=data)  # Test non-get methods too.
 
+    def test_heavy_genes_modes(self):
+        """
+        Test the "heavy_genes_mode" and "min_overlap" params of
+        "heavy_genes" queries in SignatureResource.
+        """
+        ModelsTestCase.create_participations(13, 29)
+        g1 = Gene.objects.first().id
+        g2 = Gene.objects.last().id
+        signatures = list(Signature.objects.order_by('id'))
+        # The first 5 signatures lose g2, the first 2 lose g1 too.
+        Participation.objects.filter(gene=g2,
+                                     signature__in=signatures[:5]).delete()
+        Participation.objects.filter(gene=g1,
+                                     signature__in=signatures[:2]).delete()
+        uri = self.baseURI + "signature/"
+
+        def get_signatures(**params):
+            params.update({'heavy_genes': "%s,%s,%s" % (g1, g2, g1),
+                           'limit': 0})
+            resp = self.api_client.get(uri, data=params)
+            self.assertValidJSONResponse(resp)
+            return sorted(sig['id'] for sig in self.deserialize(resp)[
+                'objects'])
+
+        both = sorted(sig.id for sig in signatures[5:])
+        either = sorted(sig.id for sig in signatures[2:])
+        self.assertEqual(get_signatures(), both)
+        self.assertEqual(get_signatures(heavy_genes_mode='all'), both)
+        self.assertEqual(get_signatures(heavy_genes_mode='any'), either)
+        self.assertEqual(get_signatures(min_overlap=1), either)
+        self.assertEqual(get_signatures(min_overlap=2), both)
+        self.assertEqual(get_signatures(min_overlap=3), [])
+
+        for params in ({'heavy_genes_mode': 'some'}, {'min_overlap': 0},
+                       {'min_overlap': 'x'}):
+            params.update({'heavy_genes': "%s,%s" % (g1, g2)})
+            self.assertHttpBadRequest(self.api_client.get(uri, data=params))
+
+    def test_signature_enrichment(self):
+        """
+        Test "signature/enrichment/?mlmodel=<ml_id>&genes=..." API against
+        hypergeometric tests computed with SciPy.
+        """
+        mlmodel = MLModel.objects.get(title="test model #1")
+        genes = [Gene.objects.create(entrezid=(i + 1),
+                                     systematic_name="sys_name #%d" % (i + 1),
+                                     organism=mlmodel.organism)
+                 for i in range(60)]
+        participation_type = factory.create(ParticipationType)
+        signatures = list(Signature.objects.filter(mlmodel=mlmodel))
+        participations = []
+        for signature in signatures:
+            for gene in random.sample(genes, random.randint(0, 30)):
+                participations.append(Participation(
+                    signature=signature, gene=gene,
+                    participation_type=participation_type))
+        Participation.objects.bulk_create(participations)
+        query_genes = random.sample(genes, 15)
+        # A gene of another organism does not count.
+        other_gene = Gene.objects.create(
+            entrezid=1000, systematic_name="other",
+            organism=factory.create(Organism))
+
+        uri = self.baseURI + "signature/enrichment/"
+        data = {
+            'mlmodel': mlmodel.id,
+            'genes': ','.join(str(gene.id)
+                              for gene in query_genes + [other_gene]),
+        }
+        resp = self.api_client.get(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        records = self.deserialize(resp)['objects']
+        self.assertEqual(len(records), len(signatures))
+        pvalues = [record['pvalue'] for record in records]
+        self.assertEqual(pvalues, sorted(pvalues))
+
+        for record in records:
+            signature = Signature.objects.get(pk=record['signature'])
+            self.assertEqual(signature.mlmodel, mlmodel)
+            self.assertEqual(signature.name, record['name'])
+            sig_genes = set(Participation.objects.filter(
+                signature=signature).values_list('gene', flat=True))
+            overlap = len(sig_genes & {gene.id for gene in query_genes})
+            self.assertEqual(record['size'], len(sig_genes))
+            self.assertEqual(record['overlap'], overlap)
+            self.assertAlmostEqual(record['pvalue'], stats.hypergeom.sf(
+                overlap - 1, len(genes), len(sig_genes), len(query_genes)))
+            self.assertGreaterEqual(record['adj_pvalue'], record['pvalue'])
+
+        # POST should return the same result as GET.
+        resp = self.api_client.client.post(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        self.assertEqual(self.deserialize(resp)['objects'], records)
+
+        # Both the mlmodel and the genes are required.
+        for name in ('mlmodel', 'genes'):
+            params = dict(data)
+            del params[name]
+            self.assertHttpBadRequest(self.api_client.get(uri, data=params))
+
+    def test_signature_related(self):
+        """
+        Test "signature/<id>/related/" API against correlations computed
+        with SciPy and Jaccard indexes of the signatures' gene sets.
+        """
+        mlmodel = MLModel.objects.get(title="test model #1")
+        genes = [Gene.objects.create(entrezid=(i + 1),
+                                     systematic_name="sys_name #%d" % (i + 1),
+                                     organism=mlmodel.organism)
+                 for i in range(30)]
+        participation_type = factory.create(ParticipationType)
+        signatures = list(Signature.objects.filter(mlmodel=mlmodel))
+        gene_sets = {}
+        for signature in signatures:
+            gene_sets[signature.id] = set(random.sample(genes, 10))
+            Participation.objects.bulk_create([
+                Participation(signature=signature, gene=gene,
+                              participation_type=participation_type)
+                for gene in gene_sets[signature.id]])
+        signature = signatures[0]
+        uri = self.baseURI + "signature/%d/related/" % signature.id
+        # Nothing is computed without a SignatureCorrelationStore.
+        self.assertEqual(self.api_client.get(uri).status_code, 503)
+        SignatureCorrelationStore(mlmodel.id).build()
+
+        activity = {
+            sig.id: [a.value for a in Activity.objects.filter(
+                signature=sig).order_by('sample')]
+            for sig in signatures}
+        for measure in ('pearson', 'spearman', 'jaccard'):
+            resp = self.api_client.get(uri, data={'order_by': measure,
+                                                  'k': 5})
+            self.assertValidJSONResponse(resp)
+            records = self.deserialize(resp)['objects']
+            self.assertEqual(len(records), 5)
+            values = [record[measure] for record in records]
+            self.assertEqual(values, sorted(values, reverse=True))
+            for record in records:
+                related = Signature.objects.get(pk=record['signature'])
+                self.assertEqual(related.mlmodel, mlmodel)
+                self.assertNotEqual(related, signature)
+                self.assertEqual(related.name, record['name'])
+                x, y = activity[signature.id], activity[related.id]
+                self.assertAlmostEqual(record['pearson'],
+                                       stats.pearsonr(x, y)[0], places=5)
+                self.assertAlmostEqual(record['spearman'],
+                                       stats.spearmanr(x, y)[0], places=5)
+                set1, set2 = gene_sets[signature.id], gene_sets[related.id]
+                self.assertAlmostEqual(
+                    record['jaccard'],
+                    len(set1 & set2) / float(len(set1 | set2)), places=5)
+
+        self.assertHttpBadRequest(self.api_client.get(
+            uri, data={'order_by': 'cosine'}))
+        uri = self.baseURI + "signature/%d/related/" % (
+            Signature.objects.order_by('id').last().id + 1)
+        self.assertHttpNotFound(self.api_client.get(uri))
+
     def create_extra_experiments(self):
         """
         Generate a few more experiements, one of which is returned
@@ -896,6 +1464,66 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         factory.create(Experiment, 3)
         return exp2
 
+    def test_search_related_items(self):
+        """
+        SearchResource.get_related_items() finds the samples of every
+        experiment and the experiments of every sample in one query.
+        """
+        exp2 = self.create_extra_experiments()
+        exp1 = Experiment.objects.get(
+            pk=ModelsTestCase.experiment_data['accession'])
+        sample = Sample.objects.first()
+        other_sample = Sample.objects.last()
+
+        class Result(object):
+            def __init__(self, model_name, pk):
+                self.model_name, self.pk = model_name, pk
+
+        results = [Result('experiment', exp1.pk),
+                   Result('experiment', exp2.pk),
+                   Result('sample', str(sample.pk)),
+                   Result('sample', str(other_sample.pk))]
+        with self.assertNumQueries(1):
+            related_items = SearchResource.get_related_items(results)
+        self.assertItemsEqual(
+            related_items[('experiment', exp1.pk)],
+            Sample.objects.values_list('pk', flat=True))
+        self.assertEqual(related_items[('experiment', exp2.pk)],
+                         [sample.pk])
+        self.assertItemsEqual(related_items[('sample', sample.pk)],
+                              [exp1.pk, exp2.pk])
+        self.assertEqual(related_items[('sample', other_sample.pk)],
+                         [exp1.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(SearchResource.get_related_items([]), {})
+
+    def test_search_result_list_pagination(self):
+        """
+        Paginating a SearchResultList only retrieves the requested page
+        and takes the total count from the search backend.
+        """
+        class FakeSearchQuerySet(object):
+            def __init__(self, results):
+                self.results = results
+                self.slices = []
+
+            def count(self):
+                return len(self.results)
+
+            def __getitem__(self, k):
+                self.slices.append(k)
+                return self.results[k]
+
+        sqs = FakeSearchQuerySet(range(25))
+        object_list = SearchResultList(
+            sqs, lambda results: [r * 10 for r in results])
+        page = Paginator({'limit': 5, 'offset': 10}, object_list,
+                         resource_uri='/api/v0/search/').page()
+        self.assertEqual(page['meta']['total_count'], 25)
+        self.assertEqual(page['objects'], [100, 110, 120, 130, 140])
+        self.assertEqual(sqs.slices, [slice(10, 15)])
+        self.assertEqual(object_list[3], 30)
+
     def test_signature_filter_in_experiment(self):
         """
         Test the "signature" filter in ExperimentResource.
@@ -1033,6 +1661,93 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
             len(ev_resp['objects'])
         )
 
+    def test_expressionvalue_differential(self):
+        """
+        Test "expressionvalue/differential/?organism=<id>&base_group=...
+        &comp_group=..." API against per-gene t-tests computed with SciPy,
+        with and without the ExpressionMatrixStore.
+        """
+        organism = Organism.objects.first()
+        genes = [Gene.objects.create(entrezid=(i + 1),
+                                     systematic_name="sys_name #%d" % i,
+                                     organism=organism)
+                 for i in range(30)]
+        samples = list(Sample.objects.all())
+        # Leave out some values; the last gene has a single one.
+        ExpressionValue.objects.bulk_create([
+            ExpressionValue(gene=gene, sample=sample, value=random.random())
+            for gene in genes[:-1] for sample in samples
+            if random.random() < 0.9] + [
+            ExpressionValue(gene=genes[-1], sample=samples[0], value=0.5)])
+        uri = self.baseURI + "expressionvalue/differential/"
+        sample_ids = [sample.id for sample in samples]
+        base_ids, comp_ids = sample_ids[:12], sample_ids[12:]
+        data = {
+            'organism': organism.id,
+            'base_group': ','.join(str(id) for id in base_ids),
+            'comp_group': ','.join(str(id) for id in comp_ids),
+        }
+        resp = self.api_client.get(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        result = self.deserialize(resp)
+        self.assertEqual(result['meta']['total_count'], len(result['gene']))
+        self.assertEqual(sorted(result['gene']), sorted(
+            ExpressionValue.objects.values_list('gene', flat=True).distinct()))
+        pvalues = [p for p in result['pvalue'] if p is not None]
+        self.assertEqual(pvalues, sorted(pvalues))
+        self.assertEqual(result['pvalue'][:len(pvalues)], pvalues)
+
+        for i, gene_id in enumerate(result['gene']):
+            base = [v.value for v in ExpressionValue.objects.filter(
+                gene=gene_id, sample__in=base_ids)]
+            comp = [v.value for v in ExpressionValue.objects.filter(
+                gene=gene_id, sample__in=comp_ids)]
+            if base and comp:
+                self.assertAlmostEqual(result['diff'][i],
+                                       numpy.mean(base) - numpy.mean(comp))
+            if result['pvalue'][i] is not None:
+                t, p = stats.ttest_ind(base, comp, equal_var=False)
+                self.assertAlmostEqual(result['t'][i], t)
+                self.assertAlmostEqual(result['pvalue'][i], p)
+                self.assertGreaterEqual(result['adj_pvalue'][i],
+                                        result['pvalue'][i])
+
+        # The stored (float32) matrix gives the same results.
+        ExpressionMatrixStore(organism.id).build()
+        resp = self.api_client.client.post(uri, data=data)
+        self.assertValidJSONResponse(resp)
+        from_store = self.deserialize(resp)
+        self.assertEqual(sorted(from_store['gene']), sorted(result['gene']))
+        for name in ('diff', 't', 'pvalue'):
+            expected = dict(zip(result['gene'], result[name]))
+            for gene_id, value in zip(from_store['gene'], from_store[name]):
+                if value is None:
+                    self.assertIsNone(expected[gene_id])
+                else:
+                    self.assertAlmostEqual(value, expected[gene_id], places=4)
+
+        # Both groups are required.
+        del data['comp_group']
+        self.assertHttpBadRequest(self.api_client.get(uri, data=data))
+
+    def test_expressionvalue_columnar_post(self):
+        """
+        Test that we can POST for ExpressionValue records in columnar format
+        """
+        self.create_expressionvalue_data(100)
+        genes = random.sample(Gene.objects.all(), 10)
+        resp = self.client.post(self.expressionvalueURI, data={
+            'gene__in': ",".join([str(g.id) for g in genes]),
+            'format': 'columnar',
+        })
+        self.assertEqual(resp.status_code, 200)
+        columns = json.loads(b''.join(resp.streaming_content))
+        expected = ExpressionValue.objects.filter(gene__in=genes)
+        self.assertEqual(columns['meta']['total_count'], expected.count())
+        self.assertEqual(
+            sorted(zip(columns['sample'], columns['gene'], columns['value'])),
+            sorted(expected.values_list('sample_id', 'gene_id', 'value')))
+
     def test_expressionvalue_big_post(self):
         """
         Test that we can use POST to retrieve more ExpressionValue records
@@ -1052,6 +1767,806 @@ class APIResourceTestCase(ResourceTestCaseMixin, TestCase):
         )
 
 
+class ImportCommandsTestCase(TestCase):
+    """
+    Test the data import management commands.
+    """
+    def setUp(self):
+        super(ImportCommandsTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            DATA_CACHE_DIR=self.cache_dir)
+        self.settings_override.enable()
+        self.mlmodel = factory.create(MLModel, {'published': True})
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_dir)
+        super(ImportCommandsTestCase, self).tearDown()
+
+    def test_bootstrap_bulk_load(self):
+        """
+        collect_samples() merges the spreadsheet rows of a sample with the
+        annotation reconciliation rules of bootstrap_database, and
+        write_bootstrap_data() bulk-loads them.
+        """
+        Row = namedtuple('Row', ['accession', 'sample', 'cel_file',
+                                 'strain', 'medium', 'treatment'])
+        rows = [Row('E-1', 's1', 's1.CEL', 'PAO1', 'LB', ''),
+                Row('E-1', 's2', '', 'PA14', '', 'heat'),
+                # the same sample in another experiment: a blank value is
+                # filled, a longer one is kept, a different one conflicts
+                Row('E-2', 's1', 's1.CEL', 'pao1', 'LB broth', 'cold'),
+                Row('E-2', 's2', '', 'PAK', '', 'heat')]
+        samples, mismatches = collect_samples(rows)
+        self.assertEqual(mismatches, {('s2', 'E-2', 'E-1'): ['strain']})
+        self.assertEqual(samples[('s1', 's1.CEL')], (
+            ['E-1', 'E-2'],
+            {'strain': 'PAO1', 'medium': 'LB broth', 'treatment': 'cold'}))
+
+        AnnotationType.objects.create(typename='strain')
+        experiments = [Experiment(accession=a, name=a, description='')
+                       for a in ('E-1', 'E-2')]
+        write_bootstrap_data(experiments, samples)
+        self.assertEqual(Experiment.objects.count(), 2)
+        self.assertEqual(Sample.objects.count(), 2)
+        self.assertEqual(Sample.experiments.through.objects.count(), 4)
+        self.assertEqual(
+            sorted(AnnotationType.objects.values_list('typename', flat=True)),
+            ['medium', 'strain', 'treatment'])
+        s1 = Sample.objects.get(ml_data_source='s1.CEL')
+        self.assertEqual(sorted(s1.experiments.values_list('accession',
+                                                           flat=True)),
+                         ['E-1', 'E-2'])
+        self.assertEqual(s1.get_annotation_dict(), {
+            'strain': 'PAO1', 'medium': 'LB broth', 'treatment': 'cold'})
+        s2 = Sample.objects.get(name='s2')
+        self.assertIsNone(s2.ml_data_source)
+        self.assertEqual(s2.get_annotation_dict(), {
+            'strain': 'PA14', 'treatment': 'heat'})
+        self.assertEqual(SampleAnnotation.objects.count(), 5)
+
+    def test_bootstrap_existing_samples(self):
+        """
+        write_bootstrap_data() reuses the samples that are already in the
+        database and reconciles their annotations with the same rules.
+        """
+        Row = namedtuple('Row', ['accession', 'sample', 'cel_file',
+                                 'strain', 'medium', 'treatment'])
+        experiment = Experiment.objects.create(accession='E-1', name='E-1',
+                                               description='')
+        s1 = Sample.objects.create(name='s1', ml_data_source='s1.CEL')
+        s1.experiments.add(experiment)
+        SampleAnnotation.objects.create_from_dict(
+            s1, {'strain': 'PAO1', 'medium': 'LB', 'treatment': 'heat'})
+
+        rows = [Row('E-2', 's1', 's1.CEL', 'pao1', 'LB broth', 'cold'),
+                Row('E-2', 's3', 's3.CEL', 'PA14', '', '')]
+        samples, mismatches = collect_samples(rows)
+        self.assertEqual(mismatches, {})
+        mismatches = write_bootstrap_data(
+            [Experiment(accession='E-2', name='E-2', description='')],
+            samples)
+        self.assertEqual(mismatches, {('s1', 'E-2', 'E-1'): ['treatment']})
+        self.assertEqual(Sample.objects.count(), 2)
+        self.assertEqual(sorted(s1.experiments.values_list('accession',
+                                                           flat=True)),
+                         ['E-1', 'E-2'])
+        self.assertEqual(s1.get_annotation_dict(), {
+            'strain': 'PAO1', 'medium': 'LB broth', 'treatment': 'heat'})
+        s3 = Sample.objects.get(name='s3')
+        self.assertEqual(list(s3.experiments.values_list('accession',
+                                                         flat=True)),
+                         ['E-2'])
+        self.assertEqual(s3.get_annotation_dict(), {'strain': 'PA14'})
+
+    def test_import_activity(self):
+        """
+        import_activity creates the signatures and one activity record
+        per known data source and signature.
+        """
+        for i in range(3):
+            Sample.objects.create(name="sample %d" % i,
+                                  ml_data_source="sample_%d.CEL" % i)
+        lines = ["data_source\tNode1pos\tNode1neg\n",
+                 "sample_0.CEL\t0.1\t-0.1\n",
+                 "unknown.CEL\t0.5\t0.5\n",
+                 "sample_2.CEL\t1e-3\t2\r\n"]
+        loader = import_activity(io.StringIO(''.join(lines)),
+                                 self.mlmodel.title)
+        self.assertEqual(loader.count, 4)
+        # The stores of the (published) model are rebuilt.
+        for store_class in (ActivityMatrixStore, SampleSimilarityStore,
+                            SignatureCorrelationStore):
+            self.assertTrue(store_class(self.mlmodel.id).exists())
+        self.assertEqual(sorted(Signature.objects.filter(
+            mlmodel=self.mlmodel).values_list('name', flat=True)),
+            ['Node1neg', 'Node1pos'])
+        self.assertEqual(
+            sorted(Activity.objects.values_list(
+                'sample__ml_data_source', 'signature__name', 'value')),
+            [('sample_0.CEL', 'Node1neg', -0.1),
+             ('sample_0.CEL', 'Node1pos', 0.1),
+             ('sample_2.CEL', 'Node1neg', 2.0),
+             ('sample_2.CEL', 'Node1pos', 0.001)])
+
+        # Signatures that already exist and bad values are rejected.
+        for bad_lines in (lines[:2],
+                          ["data_source\tNode2\n", "sample_1.CEL\tx\n"]):
+            with self.assertRaises(Exception):
+                import_activity(io.StringIO(''.join(bad_lines)),
+                                self.mlmodel.title)
+        self.assertEqual(Activity.objects.count(), 4)
+
+    def test_publish_staged_model(self):
+        """
+        A staged model is hidden from the API until publish_ml_model has
+        validated it, and can replace a published model at once, whose
+        records are then deleted.
+        """
+        sample = Sample.objects.create(name="sample", ml_data_source="s.CEL")
+        staged = MLModel.objects.create(title="staged model", published=False,
+                                        organism=self.mlmodel.organism)
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        Activity.objects.create(sample=sample, value=0.5,
+                                signature=Signature.objects.create(
+                                    name='Node1', mlmodel=self.mlmodel))
+        with self.assertRaisesRegexp(Exception, 'has no signatures'):
+            publish_ml_model(staged.title)
+        import_activity(io.StringIO("data_source\tNode1\tNode2\n"
+                                    "s.CEL\t0.1\t0.2\n"), staged.title)
+        self.assertFalse(ActivityMatrixStore(staged.id).exists())
+
+        def model_ids():
+            response = self.client.get('/api/v0/mlmodel/')
+            return [m['id'] for m in json.loads(response.content)['objects']]
+
+        def signature_count():
+            response = self.client.get('/api/v0/signature/',
+                                       {'mlmodel': staged.id})
+            return json.loads(response.content)['meta']['total_count']
+
+        def activity_values():
+            response = self.client.get('/api/v0/activity/',
+                                       {'sample': sample.id})
+            return sorted(a['value'] for a in json.loads(
+                response_content(response))['objects'])
+
+        self.assertEqual(model_ids(), [self.mlmodel.id])
+        self.assertEqual(signature_count(), 0)
+        self.assertEqual(activity_values(), [0.5])
+
+        Activity.objects.filter(sample=sample, signature__mlmodel=staged,
+                                signature__name='Node2').delete()
+        with self.assertRaisesRegexp(Exception, 'Node2 has 0 activity'):
+            publish_ml_model(staged.title)
+        Activity.objects.create(sample=sample, value=0.2,
+                                signature=Signature.objects.get(
+                                    mlmodel=staged, name='Node2'))
+        publish_ml_model(staged.title, replaces=self.mlmodel.title)
+        self.assertEqual(model_ids(), [staged.id])
+        self.assertEqual(signature_count(), 2)
+        self.assertEqual(activity_values(), [0.1, 0.2])
+        self.assertFalse(Activity.objects.filter(
+            signature__mlmodel=self.mlmodel).exists())
+        self.assertTrue(ActivityMatrixStore(staged.id).exists())
+        with self.assertRaisesRegexp(Exception, 'already been published'):
+            publish_ml_model(staged.title)
+
+    def test_delete_in_batches(self):
+        """
+        delete_in_batches() deletes all records of a queryset, one batch at
+        a time.
+        """
+        signature = Signature.objects.create(name='Node1',
+                                             mlmodel=self.mlmodel)
+        other = Signature.objects.create(name='Node2', mlmodel=self.mlmodel)
+        samples = [Sample.objects.create(name="sample %d" % i,
+                                         ml_data_source="s%d.CEL" % i)
+                   for i in range(5)]
+        for sample in samples:
+            Activity.objects.create(sample=sample, signature=signature,
+                                    value=0.1)
+        Activity.objects.create(sample=samples[0], signature=other, value=0.2)
+        delete_in_batches(Activity.objects.filter(signature=signature),
+                          batch_size=2)
+        self.assertEqual(list(Activity.objects.values_list(
+            'signature', flat=True)), [other.id])
+
+    def test_import_activity_update(self):
+        """
+        import_activity with update=True only writes new, changed and
+        removed activity records.
+        """
+        samples = [Sample.objects.create(name="sample %d" % i,
+                                         ml_data_source="sample_%d.CEL" % i)
+                   for i in range(3)]
+        import_activity(io.StringIO("data_source\tNode1\tNode2\n"
+                                    "sample_0.CEL\t0.1\t0.2\n"
+                                    "sample_1.CEL\t1.1\t1.2\n"),
+                        self.mlmodel.title)
+        unchanged_id = Activity.objects.get(sample=samples[0],
+                                            signature__name='Node1').id
+        changed_id = Activity.objects.get(sample=samples[0],
+                                          signature__name='Node2').id
+        # sample_1 is removed, sample_2 and Node3 are new, and one value of
+        # sample_0 changes by more than the tolerance.
+        loader = import_activity(
+            io.StringIO("data_source\tNode1\tNode2\tNode3\n"
+                        "sample_0.CEL\t0.1000001\t0.5\t0.3\n"
+                        "sample_2.CEL\t2.1\t2.2\t2.3\n"),
+            self.mlmodel.title, update=True, tolerance=1e-3)
+        self.assertEqual((loader.inserted, loader.updated, loader.deleted),
+                         (4, 1, 2))
+        self.assertEqual(
+            sorted(Activity.objects.values_list(
+                'sample__ml_data_source', 'signature__name', 'value')),
+            [('sample_0.CEL', 'Node1', 0.1),
+             ('sample_0.CEL', 'Node2', 0.5),
+             ('sample_0.CEL', 'Node3', 0.3),
+             ('sample_2.CEL', 'Node1', 2.1),
+             ('sample_2.CEL', 'Node2', 2.2),
+             ('sample_2.CEL', 'Node3', 2.3)])
+        self.assertTrue(Activity.objects.filter(id=unchanged_id).exists())
+        # Changed records keep their IDs.
+        self.assertEqual(Activity.objects.get(id=changed_id).value, 0.5)
+        self.assertEqual(Signature.objects.filter(
+            mlmodel=self.mlmodel).count(), 3)
+
+    def test_import_update_duplicates(self):
+        """
+        import_activity and import_expr with update=True reject a sample
+        (or gene) that is repeated in the input file, whether or not it
+        is new, and report the repeated line.
+        """
+        Sample.objects.create(name="sample 0", ml_data_source="sample_0.CEL")
+        activity = ("data_source\tNode1\tNode2\n"
+                    "sample_0.CEL\t0.1\t0.2\n"
+                    "sample_0.CEL\t0.3\t0.4\n")
+        for i in range(2):  # new, then existing records
+            with self.assertRaisesRegexp(Exception, 'line #3: sample_id'):
+                import_activity(io.StringIO(activity), self.mlmodel.title,
+                                update=True)
+            import_activity(io.StringIO(activity.rsplit("sample_0", 1)[0]),
+                            self.mlmodel.title, update=(i == 1))
+        self.assertEqual(Activity.objects.count(), 2)
+
+        self.create_genes(2)
+        tax_id = self.mlmodel.organism.taxonomy_id
+        expr_file = tempfile.NamedTemporaryFile(suffix='.txt')
+        expr_file.write("gene\tsample_0.CEL\n"
+                        "PA0000\t1.5\nPA0001\t2.5\nPA0000\t3.5\n")
+        expr_file.flush()
+        for workers in (1, 2):
+            with self.assertRaisesRegexp(Exception, 'line #4: sample_id'):
+                import_expr(open(expr_file.name), tax_id, workers=workers,
+                            update=True)
+        self.assertEqual(ExpressionValue.objects.count(), 0)
+
+    def create_genes(self, num_genes):
+        return [Gene.objects.create(entrezid=(i + 1),
+                                    systematic_name="PA%04d" % i,
+                                    organism=self.mlmodel.organism)
+                for i in range(num_genes)]
+
+    def test_import_gene_sample_expr(self):
+        """
+        import_gene_sample_expr loads one expression value per known gene
+        and data source.
+        """
+        genes = self.create_genes(3)
+        samples = [Sample.objects.create(name="sample %d" % i,
+                                         ml_data_source="sample_%d.CEL" % i)
+                   for i in range(2)]
+        lines = ["gene\tsample_0.CEL\tunknown.CEL\tsample_1.CEL\n",
+                 "PA0000\t1.5\t9\t2.5\n",
+                 "PA9999\t1\t1\t1\n",
+                 "PA0002\t-1\t9\t0\n"]
+        import_expr(io.StringIO(''.join(lines)),
+                    self.mlmodel.organism.taxonomy_id)
+        self.assertEqual(
+            sorted(ExpressionValue.objects.values_list(
+                'gene_id', 'sample_id', 'value')),
+            sorted([(genes[0].id, samples[0].id, 1.5),
+                    (genes[0].id, samples[1].id, 2.5),
+                    (genes[2].id, samples[0].id, -1.0),
+                    (genes[2].id, samples[1].id, 0.0)]))
+
+        with self.assertRaises(Exception):
+            import_expr(io.StringIO("gene\tsample_0.CEL\nPA0001\tx\n"),
+                        self.mlmodel.organism.taxonomy_id)
+        self.assertEqual(ExpressionValue.objects.count(), 4)
+
+    def test_import_gene_sample_expr_update(self):
+        """
+        import_expr with update=True gives the same values as a fresh
+        import of the new file, with or without worker processes.
+        """
+        genes = self.create_genes(40)
+        samples = [Sample.objects.create(name="sample %d" % i,
+                                         ml_data_source="sample_%d.CEL" % i)
+                   for i in range(4)]
+        tax_id = self.mlmodel.organism.taxonomy_id
+
+        def write_file(sample_indexes, offset):
+            expr_file = tempfile.NamedTemporaryFile(suffix='.txt')
+            expr_file.write("gene\t" + "\t".join(
+                samples[i].ml_data_source for i in sample_indexes) + "\n")
+            for gene in genes:
+                expr_file.write("\t".join([gene.systematic_name] + [
+                    repr(gene.id * 0.5 + i + (offset if i == 1 else 0))
+                    for i in sample_indexes]) + "\n")
+            expr_file.flush()
+            return expr_file
+
+        old_file = write_file([0, 1, 2], 0)
+        import_expr(open(old_file.name), tax_id)
+        # sample_2 is removed, sample_3 is added and sample_1 changes.
+        new_file = write_file([0, 1, 3], 0.25)
+        for workers in (1, 3):
+            loader = import_expr(open(new_file.name), tax_id, workers=workers,
+                                 update=True)
+            if workers == 1:
+                self.assertEqual(
+                    (loader.inserted, loader.updated, loader.deleted),
+                    (40, 40, 40))
+            else:
+                # Nothing left to change.
+                self.assertEqual(loader.count + loader.deleted, 0)
+        updated = sorted(ExpressionValue.objects.values_list(
+            'gene_id', 'sample_id', 'value'))
+        ExpressionValue.objects.all().delete()
+        import_expr(open(new_file.name), tax_id)
+        self.assertEqual(updated, sorted(ExpressionValue.objects.values_list(
+            'gene_id', 'sample_id', 'value')))
+
+    def test_import_gene_sample_expr_workers(self):
+        """
+        Parsing with several worker processes imports the same values and
+        reports errors on the same lines as a sequential import.
+        """
+        genes = self.create_genes(60)
+        samples = [Sample.objects.create(name="sample %d" % i,
+                                         ml_data_source="sample_%d.CEL" % i)
+                   for i in range(4)]
+        lines = ["gene\t" + "\t".join(s.ml_data_source for s in samples)]
+        for i, gene in enumerate(genes):
+            lines.append("\t".join([gene.systematic_name] + [
+                repr(random.uniform(-10, 10)) for s in samples]))
+            if i == 30:
+                lines.append("PA9999\t1\t2\t3\t4")  # unknown gene
+        tax_id = self.mlmodel.organism.taxonomy_id
+
+        expr_file = tempfile.NamedTemporaryFile(suffix='.txt')
+        expr_file.write('\n'.join(lines) + '\n')
+        expr_file.flush()
+        import_expr(open(expr_file.name), tax_id, workers=3)
+        parallel = sorted(ExpressionValue.objects.values_list(
+            'gene_id', 'sample_id', 'value'))
+        ExpressionValue.objects.all().delete()
+        import_expr(open(expr_file.name), tax_id)
+        sequential = sorted(ExpressionValue.objects.values_list(
+            'gene_id', 'sample_id', 'value'))
+        self.assertEqual(len(sequential), 60 * 4)
+        self.assertEqual(parallel, sequential)
+        ExpressionValue.objects.all().delete()
+
+        lines[50] = lines[50].replace('\t', '\tx', 1)
+        expr_file = tempfile.NamedTemporaryFile(suffix='.txt')
+        expr_file.write('\n'.join(lines) + '\n')
+        expr_file.flush()
+        with self.assertRaisesRegexp(Exception, 'line #51 column #2'):
+            import_expr(open(expr_file.name), tax_id, workers=3)
+        self.assertEqual(ExpressionValue.objects.count(), 0)
+
+    def test_import_gene_network(self):
+        """
+        import_gene_network loads the edges whose weights pass the cutoff.
+        """
+        self.mlmodel.g2g_edge_cutoff = 0.2
+        self.mlmodel.directed_g2g_edge = False
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        genes = self.create_genes(3)
+        lines = ["gene1\tgene2\tweight\tsign\n",
+                 "PA0000\tPA0001\t0.5\t+\n",
+                 "PA0000\tPA0002\t0.1\t+\n",
+                 "PA0001\tPA0002\t0.25\t-\n"]
+        import_network(io.StringIO(''.join(lines)), self.mlmodel.title)
+        self.assertEqual(
+            sorted(Edge.objects.values_list('gene1_id', 'gene2_id',
+                                            'weight')),
+            [(genes[0].id, genes[1].id, 0.5),
+             (genes[1].id, genes[2].id, -0.25)])
+
+        # Re-importing an existing edge (in either direction, since the
+        # model's edges are undirected) reports its line.
+        more_lines = ["gene1\tgene2\tweight\tsign\n",
+                      "PA0000\tPA0002\t0.3\t+\n",
+                      "PA0001\tPA0000\t0.3\t+\n"]
+        with self.assertRaisesRegexp(Exception, 'line #3: .* not unique'):
+            import_network(io.StringIO(''.join(more_lines)),
+                           self.mlmodel.title)
+        # New edges are imported, and lines of unknown genes are skipped.
+        import_network(io.StringIO(''.join(more_lines[:2]) +
+                                   "PA0000\tPA9999\t0.9\t+\n"
+                                   "PA9999\tPA0001\t0.9\t-\n"),
+                       self.mlmodel.title)
+        self.assertEqual(
+            sorted(Edge.objects.values_list('gene1_id', 'gene2_id',
+                                            'weight')),
+            [(genes[0].id, genes[1].id, 0.5),
+             (genes[0].id, genes[2].id, 0.3),
+             (genes[1].id, genes[2].id, -0.25)])
+
+    def test_import_signature_gene_network(self):
+        """
+        import_signature_gene_network loads the participations of known
+        genes, and rejects existing ones.
+        """
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        genes = self.create_genes(3)
+        signatures = [Signature.objects.create(name="Node%d" % i,
+                                               mlmodel=self.mlmodel)
+                      for i in range(2)]
+        p_type = ParticipationType.objects.create(name="High-weight genes")
+        lines = ["Node0\tPA0000\tPA9999\tPA0001\n",
+                 "\n",
+                 "Node1\tPA0002\n"]
+        import_participations(io.StringIO(''.join(lines)),
+                              self.mlmodel.title, p_type.name)
+        self.assertEqual(
+            sorted(Participation.objects.values_list('signature_id',
+                                                     'gene_id')),
+            [(signatures[0].id, genes[0].id), (signatures[0].id, genes[1].id),
+             (signatures[1].id, genes[2].id)])
+        # The Jaccard indexes of the (published) model are rebuilt.
+        correlations = SignatureCorrelationStore(self.mlmodel.id).load()
+        self.assertEqual(list(correlations.signature_ids),
+                         [sig.id for sig in signatures])
+        self.assertEqual(correlations.jaccard[0, 1], 0.0)
+
+        with self.assertRaisesRegexp(Exception, 'line #2: .* already exists'):
+            import_participations(
+                io.StringIO("Node1\tPA0000\nNode0\tPA0002\tPA0001\n"),
+                self.mlmodel.title, p_type.name)
+        with self.assertRaisesRegexp(Exception, 'line #1: .* not found'):
+            import_participations(io.StringIO("Node9\tPA0000\n"),
+                                  self.mlmodel.title, p_type.name)
+        self.assertEqual(Participation.objects.count(), 3)
+
+    def test_compressed_input(self):
+        """
+        Import commands read gzip and bzip2 compressed files, including
+        concatenated compressed streams.
+        """
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        Sample.objects.create(name="sample 0", ml_data_source="sample_0.CEL")
+        data = b"data_source\tNode1\tNode2\nsample_0.CEL\t0.5\t-0.5\n"
+        gz_file = os.path.join(self.cache_dir, 'activity.txt.gz')
+        with gzip.open(gz_file, 'wb') as f:
+            f.write(data)
+        call_command('import_activity', gz_file, self.mlmodel.title,
+                     stdout=io.BytesIO())
+        self.assertEqual(sorted(Activity.objects.values_list(
+            'signature__name', 'value')), [('Node1', 0.5), ('Node2', -0.5)])
+
+        bz2_file = os.path.join(self.cache_dir, 'lines.bz2')
+        with open(bz2_file, 'wb') as f:
+            f.write(bz2.compress(data) + bz2.compress(data))
+        self.assertEqual(list(open_input(bz2_file)), data.splitlines(True) * 2)
+        self.assertEqual(open_input(gz_file).readline(), data.split(b'\n')[0] +
+                         b'\n')
+
+    def test_truncated_compressed_input(self):
+        """
+        A truncated compressed file raises IOError instead of being read
+        as a shorter file, so nothing is imported from it.
+        """
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        Sample.objects.create(name="sample 0", ml_data_source="sample_0.CEL")
+        data = b"data_source\tNode1\tNode2\nsample_0.CEL\t0.5\t-0.5\n"
+        gz_data = io.BytesIO()
+        with gzip.GzipFile(fileobj=gz_data, mode='wb') as f:
+            f.write(data)
+        for extension, compressed in (('gz', gz_data.getvalue()),
+                                      ('bz2', bz2.compress(data))):
+            path = os.path.join(self.cache_dir, 'activity.' + extension)
+            with open(path, 'wb') as f:
+                f.write(compressed[:len(compressed) - 4])
+            with self.assertRaisesRegexp(IOError, 'truncated'):
+                list(open_input(path))
+            with self.assertRaises(CommandError):
+                call_command('import_activity', path, self.mlmodel.title,
+                             stdout=io.BytesIO())
+        self.assertFalse(Activity.objects.filter(
+            signature__mlmodel=self.mlmodel).exists())
+
+    def test_import_stats_file(self):
+        """
+        Instrumented import commands write a JSON summary of their
+        statistics, whether they succeed or fail.
+        """
+        self.mlmodel.title = "test model"
+        self.mlmodel.save()
+        Sample.objects.create(name="sample 0", ml_data_source="sample_0.CEL")
+        activity_file = os.path.join(self.cache_dir, 'activity.txt')
+        stats_file = os.path.join(self.cache_dir, 'stats.json')
+        with open(activity_file, 'wb') as f:
+            f.write(b"data_source\tNode1\tNode2\nsample_0.CEL\t0.5\t-0.5\n")
+        output = io.BytesIO()
+        call_command('import_activity', activity_file, self.mlmodel.title,
+                     stats_file=stats_file, stdout=output)
+        self.assertIn(b"2 lines parsed, 2 rows written", output.getvalue())
+        with open(stats_file) as f:
+            summary = json.load(f)
+        self.assertEqual(summary['command'], 'import_activity')
+        self.assertEqual(summary['status'], 'succeeded')
+        self.assertEqual((summary['lines'], summary['rows_written']), (2, 2))
+        self.assertEqual(sorted(summary['phase_seconds']),
+                         ['parse', 'rebuild', 'validate', 'write'])
+        # The rate leaves out the time spent rebuilding the stores.
+        self.assertAlmostEqual(
+            summary['rows_per_second'],
+            2 / (summary['elapsed_seconds'] -
+                 summary['phase_seconds']['rebuild']))
+        self.assertGreater(summary['peak_rss_bytes'], 0)
+
+        # Signatures already exist, so importing the file again fails.
+        with self.assertRaises(CommandError):
+            call_command('import_activity', activity_file,
+                         self.mlmodel.title, stats_file=stats_file,
+                         stdout=io.BytesIO())
+        with open(stats_file) as f:
+            self.assertEqual(json.load(f)['status'], 'failed')
+
+    def test_copy_text(self):
+        """
+        copy_text() formats values for PostgreSQL's COPY text format.
+        """
+        self.assertEqual(copy_text(None), '\\N')
+        self.assertEqual(copy_text(42), '42')
+        self.assertEqual(float(copy_text(0.1 + 0.2)), 0.1 + 0.2)
+        self.assertEqual(copy_text(True), 't')
+        self.assertEqual(copy_text('a\tb\\c\nd\u00e9'),
+                         'a\\tb\\\\c\\nd\u00e9')
+
+
+class MatrixStoreTestCase(TestCase):
+    """
+    Test the stores in analyze/matrix_store.py.
+    """
+    def setUp(self):
+        super(MatrixStoreTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            DATA_CACHE_DIR=self.cache_dir)
+        self.settings_override.enable()
+        factory.create(Sample, 12)
+        APIResourceTestCase.create_activities(20)
+        self.mlmodel = MLModel.objects.first()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_dir)
+        super(MatrixStoreTestCase, self).tearDown()
+
+    def test_activity_matrix(self):
+        """
+        ActivityMatrixStore holds the same values as the Activity table.
+        """
+        store = ActivityMatrixStore(self.mlmodel.id)
+        self.assertIsNone(store.load())
+        store.build()
+        matrix = store.load()
+        self.assertEqual(matrix.values.shape, (12, 10))
+        self.assertEqual(matrix.values.dtype, numpy.float32)
+
+        samples = random.sample(Sample.objects.all(), 5)
+        signatures = random.sample(
+            Signature.objects.filter(mlmodel=self.mlmodel), 3)
+        row_ids, col_ids, values = matrix.slice(
+            [s.id for s in samples], [sig.id for sig in signatures])
+        self.assertEqual(list(row_ids), [s.id for s in samples])
+        self.assertEqual(list(col_ids), [sig.id for sig in signatures])
+        for i, sample in enumerate(samples):
+            for j, signature in enumerate(signatures):
+                self.assertAlmostEqual(
+                    values[i, j],
+                    Activity.objects.get(sample=sample,
+                                         signature=signature).value,
+                    places=6)
+
+        # Signatures of other models are dropped from the slice.
+        other_signature = Signature.objects.exclude(
+            mlmodel=self.mlmodel).first()
+        row_ids, col_ids, values = matrix.slice(
+            col_ids=[other_signature.id])
+        self.assertEqual(values.shape, (12, 0))
+
+    def test_activity_matrix_in_api(self):
+        """
+        ActivityResource.get_activity_matrix() returns the same matrix
+        whether or not the ActivityMatrixStore has been built.
+        """
+        sample_ids = [s.id for s in random.sample(Sample.objects.all(), 4)]
+        signature_ids = list(Signature.objects.filter(
+            mlmodel=self.mlmodel).values_list('id', flat=True))
+        # Include an unknown sample, whose activity should be NaN.
+        sample_ids.append(Sample.objects.order_by('-id').first().id + 1)
+        from_db = ActivityResource.get_activity_matrix(
+            self.mlmodel.id, sample_ids, signature_ids)
+        ActivityMatrixStore(self.mlmodel.id).build()
+        from_store = ActivityResource.get_activity_matrix(
+            self.mlmodel.id, sample_ids, signature_ids)
+        self.assertTrue(numpy.allclose(from_db, from_store, equal_nan=True))
+        self.assertTrue(numpy.isnan(from_store[-1]).all())
+
+    def test_activity_list_is_exact(self):
+        """
+        ActivityResource lists the exact values of the Activity table, in
+        the same order, whether or not the ActivityMatrixStore has been
+        built.
+        """
+        samples = list(Sample.objects.all())
+        params = {'mlmodel': self.mlmodel.id,
+                  'sample__in': ','.join(str(s.id) for s in samples[:4])}
+
+        def get_activity():
+            resp = self.client.get('/api/v0/activity/', data=params)
+            self.assertEqual(resp.status_code, 200)
+            return [(a['id'], a['sample'], a['signature'], a['value'])
+                    for a in json.loads(response_content(resp))['objects']]
+
+        from_db = get_activity()
+        ActivityMatrixStore(self.mlmodel.id).build()
+        self.assertEqual(get_activity(), from_db)
+        self.assertEqual(sorted(from_db), sorted(Activity.objects.filter(
+            signature__mlmodel=self.mlmodel, sample__in=samples[:4]
+        ).values_list('id', 'sample', 'signature', 'value')))
+
+    def test_rebuild(self):
+        """
+        A rebuilt store replaces the previous version in this process.
+        """
+        store = ActivityMatrixStore(self.mlmodel.id)
+        store.build()
+        activity = Activity.objects.filter(
+            signature__mlmodel=self.mlmodel).first()
+        activity.value = 42.0
+        activity.save()
+        store.build()
+        row_ids, col_ids, values = store.load().slice(
+            [activity.sample_id], [activity.signature_id])
+        self.assertEqual(values[0, 0], 42.0)
+        self.assertEqual(len(os.listdir(os.path.dirname(store.path))), 2)
+
+        store.delete()
+        self.assertIsNone(store.load())
+
+    def get_edges(self, **params):
+        resp = self.client.get('/api/v0/edge/', data=params)
+        self.assertEqual(resp.status_code, 200)
+        edges = json.loads(response_content(resp))['objects']
+        return sorted((e['gene1'], e['gene2'], e['weight'], e['id'])
+                      for e in edges)
+
+    def test_gene_network_in_api(self):
+        """
+        EdgeResource returns the same neighborhood subgraphs whether or not
+        the GeneNetworkStore has been built, and reads them from the store
+        when it has.
+        """
+        organism = Organism.objects.first()
+        genes = [Gene.objects.create(entrezid=(i + 1),
+                                     systematic_name="sys_name #%d" % i,
+                                     organism=organism)
+                 for i in range(40)]
+        pairs = random.sample([(g1, g2) for g1 in genes for g2 in genes
+                               if g1.id < g2.id], 120)
+        Edge.objects.bulk_create([
+            Edge(mlmodel=self.mlmodel, gene1=g1, gene2=g2,
+                 weight=random.uniform(-1, 1))
+            for g1, g2 in pairs])
+
+        queries = [
+            {'genes': genes[0].id},
+            {'genes': ','.join(str(g.id) for g in random.sample(genes, 3))},
+            {'genes': '%d,%d' % (genes[1].id, genes[2].id),
+             'min_weight': 0.5},
+            {'genes': genes[3].id, 'sign': 'negative'},
+            {'genes': genes[4].id, 'sign': 'positive', 'min_weight': 0.2},
+            {'genes': 999999},
+        ]
+        for params in queries:
+            params['mlmodel'] = self.mlmodel.id
+        from_db = [self.get_edges(**params) for params in queries]
+        GeneNetworkStore(self.mlmodel.id).build()
+        with self.assertNumQueries(1):  # IDs of the staged mlmodels
+            self.client.get('/api/v0/edge/', data=queries[1])
+        from_store = [self.get_edges(**params) for params in queries]
+        self.assertEqual(from_db, from_store)
+        self.assertTrue(from_db[0])
+        self.assertEqual(from_db[-1], [])
+        for gene1, gene2, weight, edge_id in from_store[2]:
+            self.assertGreaterEqual(abs(weight), 0.5)
+        for gene1, gene2, weight, edge_id in from_store[3]:
+            self.assertLess(weight, 0)
+
+        # Stored subgraphs can be sorted by weight.
+        resp = self.client.get('/api/v0/edge/', data=dict(
+            queries[1], order_by='-weight', format='columnar'))
+        weights = json.loads(b''.join(resp.streaming_content))['weight']
+        self.assertEqual(weights, sorted(weights, reverse=True))
+        self.assertEqual(len(weights), len(from_store[1]))
+
+        # The edges of a staged model are hidden, even from its store.
+        self.mlmodel.published = False
+        self.mlmodel.save()
+        self.assertEqual(self.get_edges(**queries[1]), [])
+
+    def test_expression_matrix_in_api(self):
+        """
+        ExpressionValueResource lists the exact values of the
+        ExpressionValue table, in the same order, whether or not the
+        ExpressionMatrixStore has been built.
+        """
+        organism = Organism.objects.first()
+        genes = [Gene.objects.create(entrezid=(i + 1),
+                                     systematic_name="sys_name #%d" % i,
+                                     organism=organism)
+                 for i in range(30)]
+        samples = list(Sample.objects.all())
+        ExpressionValue.objects.bulk_create([
+            ExpressionValue(gene=gene, sample=sample,
+                            value=random.random())
+            for gene in genes for sample in samples
+            if random.random() < 0.8])
+
+        def get_values(**params):
+            resp = self.client.post('/api/v0/expressionvalue/', data=params)
+            self.assertEqual(resp.status_code, 200)
+            result = json.loads(response_content(resp))
+            return result['meta']['total_count'], [
+                (v['gene'], v['sample'], v['id'], v['value'])
+                for v in result['objects']]
+
+        queries = [
+            {'gene__in': ','.join(str(g.id) for g in genes[:5]),
+             'sample__in': ','.join(str(s.id) for s in samples[:8]),
+             'order_by': 'gene'},
+            # More genes than samples: read from the sample-major layout.
+            {'gene__in': ','.join(str(g.id) for g in genes[3:25]),
+             'sample__in': ','.join(str(s.id) for s in samples[:2])},
+            {'gene': genes[7].id, 'order_by': 'sample'},
+            {'gene': 999999},
+        ]
+        from_db = [get_values(**params) for params in queries]
+        ExpressionMatrixStore(organism.id).build()
+        self.assertEqual([get_values(**params) for params in queries],
+                         from_db)
+        self.assertEqual(sorted(from_db[2][1]), sorted(
+            (genes[7].id, sample_id, value_id, value)
+            for value_id, sample_id, value in ExpressionValue.objects.filter(
+                gene=genes[7]).values_list('id', 'sample', 'value')))
+        self.assertEqual(from_db[-1], (0, []))
+
+        # Both layouts are float32.
+        matrix = ExpressionMatrixStore(organism.id).load()
+        self.assertEqual(matrix.values.dtype, numpy.float32)
+        self.assertEqual(matrix.sample_values.dtype, numpy.float32)
+
+        resp = self.client.get('/api/v0/expressionvalue/', data={
+            'gene__in': queries[1]['gene__in'], 'format': 'npy'})
+        records = numpy.load(io.BytesIO(resp.content))
+        self.assertEqual(len(records), ExpressionValue.objects.filter(
+            gene__in=genes[3:25]).count())
+
+
 @override_settings(HAYSTACK_CONNECTIONS=TEST_INDEX)
 class SearchIndexTestCase(ResourceTestCaseMixin, TestCase):
     searchURI = '/api/v0/search/'
@@ -1187,5 +2702,31 @@ class SearchIndexTestCase(ResourceTestCaseMixin, TestCase):
             frozenset([u'GSM596626 1', u'GSM596819 1'])
         )
 
+    @unittest.skipUnless(USES_ELASTICSEARCH,
+                         "the search backend is not Elasticsearch")
+    def testModelsParam(self):
+        """
+        The "models" param restricts the search to the given item types,
+        and the results are paginated by Elasticsearch.
+        """
+        resp = self.api_client.get(
+            self.searchURI, data={'q': 'E-GEOD-24262', 'models': 'sample'})
+        self.assertValidJSONResponse(resp)
+        objects = self.deserialize(resp)['objects']
+        self.assertEqual(len(objects), 2)
+        self.assertTrue(all(item['item_type'] == 'sample'
+                            for item in objects))
+
+        resp = self.api_client.get(
+            self.searchURI, data={'q': 'E-GEOD-24262', 'limit': 1})
+        self.assertValidJSONResponse(resp)
+        content = self.deserialize(resp)
+        self.assertEqual(len(content['objects']), 1)
+        self.assertGreaterEqual(content['meta']['total_count'], 3)
+
+        resp = self.api_client.get(
+            self.searchURI, data={'q': 'mexR', 'models': 'gene'})
+        self.assertHttpBadRequest(resp)
+
     def tearDown(self):
         call_command('clear_index', interactive=False, verbosity=0)
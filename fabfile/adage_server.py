@@ -217,12 +217,8 @@ def import_data_and_index():
         "cutoff": 0.2
     }
 
-    # If the gene-gene network file has ".gz" extension, unzip it.
+    # The import commands read compressed (e.g. ".gz") files directly.
     gene_gene_network_file = CONFIG['data']['gene_network_file']
-    basename, extension = os.path.splitext(gene_gene_network_file)
-    if extension == '.gz':
-        run('gunzip "%s"' % gene_gene_network_file)
-        gene_gene_network_file = basename
 
     # Create two ML models and related records separately:
     for mlmodel in [mlmodel_basic, mlmodel_complex]:
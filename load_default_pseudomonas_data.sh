@@ -53,10 +53,10 @@ python manage.py genes_load_gene_history \
     --discontinued_id_col=3 \
     --discontinued_symbol_col=4
 
-# Decompress and import gene-gene network data into the database:
-gunzip ../data/gene_gene_network_cutoff_0.2.txt.gz
+# Import gene-gene network data into the database (the import commands
+# read gzip-compressed files directly):
 python manage.py import_gene_network \
-    ../data/gene_gene_network_cutoff_0.2.txt \
+    ../data/gene_gene_network_cutoff_0.2.txt.gz \
     "Ensemble ADAGE 300"
 
 # Note that the ParticipationType "High-weight genes" has been